@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmark: query latency and chunk throughput of the pluggable RAG embedding backends
+
+Embeds the same synthetic questions one at a time (the `/query` path) and the same synthetic
+~1024-token chunks in batches (the ingestion path) with
+    hash      HashEmbedding        (deterministic feature hashing, always available)
+    local     LocalOnnxEmbedding   (--model-dir with tokenizer.json + an ONNX encoder)
+    openai    OpenAIEmbedding      (--openai, needs OPENAI_API_KEY and network)
+and reports p50 / p95 single-query latency and chunks/sec.
+
+Usage:
+    python scripts/bench_embedding_backends.py [--model-dir models/bge-small-en-v1.5] [--threads 4]
+                                               [--queries 200] [--chunks 256] [--openai]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, List
+
+import numpy as np
+
+project_root = Path(__file__).resolve().parent.parent
+rag_service_dir = project_root / "server" / "python-services" / "rag-service"
+sys.path.insert(0, str(rag_service_dir))
+
+from embedding_backends import HashEmbedding, LocalOnnxEmbedding
+
+WORDS = (
+    "backpropagation computes the gradient of the loss with respect to every weight by "
+    "applying the chain rule layer by layer from the output back to the input while "
+    "batch normalization rescales activations to stabilize training"
+).split()
+
+
+def synthetic_texts(count: int, words: int, seed: int) -> List[str]:
+    rng = np.random.default_rng(seed)
+    return [" ".join(rng.choice(WORDS, size=words)) for _ in range(count)]
+
+
+def bench(label: str, model: Any, queries: List[str], chunks: List[str]) -> None:
+    model.get_query_embedding(queries[0])
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        model.get_query_embedding(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    start = time.perf_counter()
+    vectors = model.get_text_embedding_batch(chunks)
+    seconds = time.perf_counter() - start
+    print(f"{label:<10}{len(vectors[0]):>6}{statistics.median(latencies):>12.2f}{p95:>12.2f}"
+          f"{len(chunks) / seconds:>14.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--chunks", type=int, default=256)
+    parser.add_argument("--chunk-words", type=int, default=700, help="~1024 tokens per chunk")
+    parser.add_argument("--model-dir", default="", help="local ONNX model directory")
+    parser.add_argument("--pooling", default="cls", choices=["cls", "mean"])
+    parser.add_argument("--threads", type=int, default=0, help="onnxruntime threads (0 = cpu count)")
+    parser.add_argument("--batch-size", type=int, default=32, help="local inference batch size")
+    parser.add_argument("--openai", action="store_true", help="also measure the OpenAI API")
+    args = parser.parse_args()
+
+    queries = synthetic_texts(args.queries, 12, seed=1)
+    chunks = synthetic_texts(args.chunks, args.chunk_words, seed=2)
+    print(f"{args.queries} single queries, {args.chunks} chunks x {args.chunk_words} words "
+          f"(cpu_count={os.cpu_count()})\n")
+    print(f"{'backend':<10}{'dims':>6}{'p50 ms':>12}{'p95 ms':>12}{'chunks/s':>14}")
+
+    bench("hash", HashEmbedding(), queries, chunks)
+    if args.model_dir:
+        local = LocalOnnxEmbedding(
+            model_dir=args.model_dir,
+            pooling=args.pooling,
+            threads=args.threads,
+            infer_batch_size=args.batch_size,
+        )
+        bench("local", local, queries, chunks)
+    if args.openai:
+        from llama_index.embeddings.openai import OpenAIEmbedding
+
+        bench("openai", OpenAIEmbedding(model="text-embedding-3-large"), queries[:20], chunks)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Benchmark: ingestion throughput (chunks/sec) with the rate-limit-aware embedding scheduler
+
+Starts a local fake OpenAI `/v1/embeddings` server that behaves like the real one under load:
+per-request latency proportional to the batch size, a token-per-minute and request-per-minute
+budget, `x-ratelimit-*` headers on every response, and HTTP 429 with `retry-after-ms` once a
+budget is exhausted. Then N "students" upload synthetic materials at the same time, each
+through rag-service's StreamingIngestor (SentenceSplitter, no-op vector store), with
+    baseline    LlamaIndex OpenAIEmbedding (the previous ingestion embed model)
+    scheduler   EmbeddingScheduler (token-bounded batches, adaptive concurrency, jittered backoff)
+and reports chunks/sec, requests, 429s and failed uploads.
+
+Runs fully offline.
+
+Usage:
+    python scripts/bench_embedding_scheduler.py [--students 10] [--pages 30] [--tpm 6000000] [--rpm 3000]
+"""
+import argparse
+import base64
+import hashlib
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+
+project_root = Path(__file__).resolve().parent.parent
+rag_service_dir = project_root / "server" / "python-services" / "rag-service"
+sys.path.insert(0, str(rag_service_dir))
+
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import Document
+from llama_index.embeddings.openai import OpenAIEmbedding
+
+from embedding_scheduler import EmbeddingScheduler
+from ingestion import StreamingIngestor
+
+EMBED_DIM = 64
+MODEL = "text-embedding-3-small"
+WORDS = (
+    "entropy measures the expected information content of a random variable and the cross "
+    "entropy between the empirical distribution and the model is minimized by maximum "
+    "likelihood estimation under mild regularity conditions"
+).split()
+
+
+class RateLimitedEmbeddingServer:
+    """Token / request budgets refill continuously; at most `burst_seconds` worth of budget accumulates"""
+
+    def __init__(
+        self,
+        *,
+        tpm: int,
+        rpm: int,
+        burst_seconds: float,
+        base_latency: float,
+        latency_per_1k_tokens: float,
+    ) -> None:
+        self.tpm, self.rpm, self.burst_seconds = tpm, rpm, burst_seconds
+        self.base_latency, self.latency_per_1k_tokens = base_latency, latency_per_1k_tokens
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Full budgets and zeroed counters, so every mode starts from the same state"""
+        with self.lock:
+            self.tokens = self.tpm / 60 * self.burst_seconds
+            self.requests = self.rpm / 60 * self.burst_seconds
+            self.updated = time.monotonic()
+            self.counters = {"ok": 0, "rate_limited": 0, "tokens": 0}
+
+    def reserve(self, tokens: int) -> Dict[str, Any]:
+        with self.lock:
+            now = time.monotonic()
+            elapsed, self.updated = now - self.updated, now
+            self.tokens = min(self.tpm / 60 * self.burst_seconds, self.tokens + elapsed * self.tpm / 60)
+            self.requests = min(self.rpm / 60 * self.burst_seconds, self.requests + elapsed * self.rpm / 60)
+            allowed = self.tokens >= tokens and self.requests >= 1
+            if allowed:
+                self.tokens -= tokens
+                self.requests -= 1
+                self.counters["ok"] += 1
+                self.counters["tokens"] += tokens
+            else:
+                self.counters["rate_limited"] += 1
+            token_wait = max(0.0, tokens - self.tokens) / (self.tpm / 60)
+            request_wait = max(0.0, 1 - self.requests) / (self.rpm / 60)
+            return {
+                "allowed": allowed,
+                "headers": {
+                    "x-ratelimit-limit-requests": str(self.rpm),
+                    "x-ratelimit-limit-tokens": str(self.tpm),
+                    "x-ratelimit-remaining-requests": str(int(self.requests)),
+                    "x-ratelimit-remaining-tokens": str(int(self.tokens)),
+                    "x-ratelimit-reset-requests": f"{int(request_wait * 1000)}ms",
+                    "x-ratelimit-reset-tokens": f"{int(token_wait * 1000)}ms",
+                },
+                "retry_after": max(token_wait, request_wait),
+            }
+
+    def start(self) -> ThreadingHTTPServer:
+        state = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args: Any) -> None:
+                pass
+
+            def do_POST(self) -> None:
+                body = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))) or b"{}")
+                inputs = body.get("input") or []
+                inputs = [inputs] if isinstance(inputs, str) else inputs
+                tokens = sum(max(1, len(text) // 4) for text in inputs)
+                decision = state.reserve(tokens)
+                if not decision["allowed"]:
+                    payload = json.dumps({"error": {
+                        "message": "Rate limit reached", "type": "tokens", "code": "rate_limit_exceeded",
+                    }}).encode()
+                    self.send_response(429)
+                    self.send_header("retry-after-ms", str(int(decision["retry_after"] * 1000) + 1))
+                    for name, value in decision["headers"].items():
+                        self.send_header(name, value)
+                    self.send_header("content-type", "application/json")
+                    self.send_header("content-length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
+
+                time.sleep(state.base_latency + state.latency_per_1k_tokens * tokens / 1000)
+                data = []
+                for index, text in enumerate(inputs):
+                    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:4], "little")
+                    vector = np.random.default_rng(seed).standard_normal(EMBED_DIM).astype(np.float32)
+                    embedding: Any = vector.tolist()
+                    if body.get("encoding_format") == "base64":
+                        embedding = base64.b64encode(vector.tobytes()).decode()
+                    data.append({"object": "embedding", "index": index, "embedding": embedding})
+                payload = json.dumps({
+                    "object": "list", "data": data, "model": body.get("model"),
+                    "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+                }).encode()
+                self.send_response(200)
+                for name, value in decision["headers"].items():
+                    self.send_header(name, value)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class NullVectorStore:
+    def add(self, nodes: List[Any]) -> List[str]:
+        return [node.node_id for node in nodes]
+
+
+def synthetic_pages(student: int, pages: int, words_per_page: int) -> List[Document]:
+    rng = np.random.default_rng(student)
+    return [
+        Document(
+            text=f"Student {student} page {page}. " + " ".join(rng.choice(WORDS, size=words_per_page)),
+            metadata={"page_label": str(page)},
+        )
+        for page in range(1, pages + 1)
+    ]
+
+
+def run_mode(label: str, embed_model: Any, server: RateLimitedEmbeddingServer, args: argparse.Namespace) -> None:
+    server.reset()
+    ingestor = StreamingIngestor(
+        node_parser=SentenceSplitter(chunk_size=1024, chunk_overlap=200),
+        embed_model=embed_model,
+        vector_store=NullVectorStore(),
+        batch_size=args.batch_size,
+        max_in_flight=args.max_in_flight,
+    )
+
+    def upload(student: int):
+        try:
+            return ingestor.run(synthetic_pages(student, args.pages, args.words)).chunk_count, None
+        except Exception as err:
+            return 0, err
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.students) as pool:
+        results = list(pool.map(upload, range(args.students)))
+    seconds = time.perf_counter() - start
+
+    chunks = sum(count for count, _ in results)
+    failures = [err for _, err in results if err is not None]
+    print(f"{label:<12}{chunks:>8}{seconds:>10.2f}{chunks / seconds:>12.1f}"
+          f"{server.counters['ok']:>10}{server.counters['rate_limited']:>8}{len(failures):>8}")
+    if failures:
+        print(f"{'':<12}first failure: {type(failures[0]).__name__}: {str(failures[0])[:120]}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=10, help="concurrent uploads")
+    parser.add_argument("--pages", type=int, default=30, help="pages per upload")
+    parser.add_argument("--words", type=int, default=900, help="words per page")
+    parser.add_argument("--tpm", type=int, default=6_000_000, help="fake server tokens per minute")
+    parser.add_argument("--rpm", type=int, default=3_000, help="fake server requests per minute")
+    parser.add_argument("--burst-seconds", type=float, default=10.0, help="budget that may accumulate")
+    parser.add_argument("--latency", type=float, default=0.15, help="fake server base latency (seconds)")
+    parser.add_argument("--latency-per-1k", type=float, default=0.01, help="extra latency per 1k tokens")
+    parser.add_argument("--batch-size", type=int, default=64, help="RAG_INGEST_BATCH_SIZE")
+    parser.add_argument("--max-in-flight", type=int, default=2, help="RAG_INGEST_MAX_IN_FLIGHT")
+    parser.add_argument("--concurrency", type=int, default=4, help="RAG_EMBED_CONCURRENCY")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="RAG_EMBED_MAX_CONCURRENCY")
+    args = parser.parse_args()
+
+    server = RateLimitedEmbeddingServer(
+        tpm=args.tpm,
+        rpm=args.rpm,
+        burst_seconds=args.burst_seconds,
+        base_latency=args.latency,
+        latency_per_1k_tokens=args.latency_per_1k,
+    )
+    http_server = server.start()
+    base_url = f"http://127.0.0.1:{http_server.server_address[1]}/v1"
+    print(f"Fake embedding server {base_url}: {args.tpm} TPM, {args.rpm} RPM, "
+          f"{args.students} concurrent uploads x {args.pages} pages\n")
+    print(f"{'mode':<12}{'chunks':>8}{'seconds':>10}{'chunks/s':>12}{'requests':>10}{'429s':>8}{'failed':>8}")
+
+    run_mode(
+        "baseline",
+        OpenAIEmbedding(model=MODEL, api_key="bench", api_base=base_url, embed_batch_size=100),
+        server,
+        args,
+    )
+    scheduler = EmbeddingScheduler(
+        model=MODEL,
+        api_key="bench",
+        base_url=base_url,
+        concurrency=args.concurrency,
+        max_concurrency=args.max_concurrency,
+    )
+    run_mode("scheduler", scheduler, server, args)
+    print(f"\nScheduler stats: {scheduler.stats()}")
+    scheduler.shutdown()
+    http_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
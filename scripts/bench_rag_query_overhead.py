@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: per-query Python overhead of the RAG query path
+
+Compares the old per-request construction
+    StorageContext.from_defaults → VectorStoreIndex.from_vector_store → as_query_engine
+against the path rag-service actually serves with RAG_VECTOR_BACKEND=llamaindex:
+LlamaIndexBackend.search on the cached QueryLayer (index + synthesizer built once,
+a retriever created per call), then QueryLayer.synthesizer.asynthesize on the
+retrieved nodes, as RAGPipeline._synthesize does. Both sides run on one event loop.
+
+Runs fully offline: an in-memory vector store, MockEmbedding and MockLLM stand in
+for MongoDB Atlas and OpenAI, so only framework overhead is measured.
+
+Usage:
+    python scripts/bench_rag_query_overhead.py [--iterations 2000] [--chunks 200]
+"""
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+from typing import Any, List
+
+project_root = Path(__file__).resolve().parent.parent
+python_services_dir = project_root / "server" / "python-services"
+rag_service_dir = python_services_dir / "rag-service"
+sys.path.insert(0, str(python_services_dir))
+sys.path.insert(0, str(rag_service_dir))
+
+from llama_index.core import QueryBundle, Settings, StorageContext, VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import MockLLM
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores import MetadataFilters
+from llama_index.core.vector_stores.types import BasePydanticVectorStore, VectorStoreQuery, VectorStoreQueryResult
+
+from query_layer import QueryLayer
+from vector_backends import LlamaIndexBackend, metadata_filters
+
+EMBED_DIM = 64
+
+
+class InMemoryTextVectorStore(BasePydanticVectorStore):
+    """Tiny text-storing vector store so only framework overhead is measured."""
+
+    stores_text: bool = True
+    nodes: List[Any] = []
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    def add(self, nodes: List[Any], **kwargs: Any) -> List[str]:
+        self.nodes.extend(nodes)
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **kwargs: Any) -> None:
+        pass
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        top = self.nodes[: query.similarity_top_k]
+        return VectorStoreQueryResult(
+            nodes=top,
+            similarities=[1.0] * len(top),
+            ids=[node.node_id for node in top],
+        )
+
+
+def build_store(chunks: int) -> InMemoryTextVectorStore:
+    store = InMemoryTextVectorStore()
+    store.add([
+        TextNode(
+            text=f"Chunk {i}: lecture notes about topic {i % 17}.",
+            metadata={"user_id": "u1", "material_id": f"m{i % 4}"},
+            embedding=[0.1] * EMBED_DIM,
+        )
+        for i in range(chunks)
+    ])
+    return store
+
+
+def legacy_query_engine(store: InMemoryTextVectorStore, filters: MetadataFilters, top_k: int):
+    storage_context = StorageContext.from_defaults(vector_store=store)
+    index = VectorStoreIndex.from_vector_store(vector_store=store, storage_context=storage_context)
+    return index.as_query_engine(similarity_top_k=top_k, filters=filters)
+
+
+def timed(label: str, iterations: int, fn) -> float:
+    for _ in range(min(50, iterations)):
+        fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    per_call_us = (time.perf_counter() - start) / iterations * 1e6
+    print(f"  {label:<42} {per_call_us:10.1f} µs/query")
+    return per_call_us
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--chunks", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    Settings.embed_model = MockEmbedding(embed_dim=EMBED_DIM)
+    Settings.llm = MockLLM(max_tokens=8)
+
+    store = build_store(args.chunks)
+    material_ids = ["m1", "m2"]
+    filters = metadata_filters("u1", material_ids)
+    bundle = QueryBundle(query_str="What is topic 3?", embedding=[0.1] * EMBED_DIM)
+    layer = QueryLayer(store)
+    backend = LlamaIndexBackend(layer)
+    loop = asyncio.new_event_loop()
+
+    def run(coro_fn):
+        return lambda: loop.run_until_complete(coro_fn())
+
+    async def service_retrieve():
+        return await backend.search(bundle, user_id="u1", material_ids=material_ids, top_k=args.top_k)
+
+    async def service_query():
+        nodes = await service_retrieve()
+        return await layer.synthesizer.asynthesize(bundle, nodes)
+
+    print("=" * 72)
+    print(f"RAG query overhead  (iterations={args.iterations}, chunks={args.chunks}, top_k={args.top_k})")
+    print("=" * 72)
+
+    print("\n[1] Construction only")
+    legacy_build = timed("legacy: from_vector_store + as_query_engine", args.iterations,
+                         lambda: legacy_query_engine(store, filters, args.top_k))
+    cached_build = timed("service: QueryLayer.retriever", args.iterations,
+                         lambda: layer.retriever(top_k=args.top_k, filters=filters))
+
+    print("\n[2] Construction + query (MockLLM synthesis)")
+    legacy_total = timed("legacy: as_query_engine().aquery", args.iterations,
+                         run(lambda: legacy_query_engine(store, filters, args.top_k).aquery(bundle)))
+    cached_total = timed("service: backend.search + asynthesize", args.iterations, run(service_query))
+
+    print("\n[3] Retrieval only")
+    legacy_retrieve = timed("legacy: rebuild index + as_retriever", args.iterations,
+                            lambda: VectorStoreIndex.from_vector_store(vector_store=store)
+                            .as_retriever(similarity_top_k=args.top_k, filters=filters).retrieve(bundle))
+    cached_retrieve = timed("service: LlamaIndexBackend.search", args.iterations, run(service_retrieve))
+    loop.close()
+
+    print("\nSummary")
+    print(f"  construction speedup: {legacy_build / cached_build:6.1f}x  (saves {legacy_build - cached_build:.1f} µs)")
+    print(f"  end-to-end speedup:   {legacy_total / cached_total:6.1f}x  (saves {legacy_total - cached_total:.1f} µs)")
+    print(f"  retrieval speedup:    {legacy_retrieve / cached_retrieve:6.1f}x  (saves {legacy_retrieve - cached_retrieve:.1f} µs)")
+
+
+if __name__ == "__main__":
+    main()
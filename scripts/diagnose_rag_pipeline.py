@@ -100,14 +100,33 @@ if sample and 'metadata' in sample:
 
 # Step 5: Check for Vector Search Index
 print("\n[5] Vector Search Index Status")
-print(f"    ⚠ Atlas Vector Search indexes are NOT visible via PyMongo")
-print(f"    ⚠ You MUST create the index in MongoDB Atlas UI")
-print(f"\n    Steps to verify:")
-print(f"    1. Go to: https://cloud.mongodb.com/")
-print(f"    2. Navigate to: Clusters → Browse Collections")
-print(f"    3. Select: {MONGODB_VECTOR_DB}.{MONGODB_VECTOR_COLLECTION}")
-print(f"    4. Click: Search Indexes tab")
-print(f"    5. Verify: Index named '{MONGODB_VECTOR_INDEX}' exists and is Active")
+REQUIRED_FILTER_PATHS = ["metadata.user_id", "metadata.material_id", "metadata.file_hash"]
+try:
+    indexes = list(collection.list_search_indexes(MONGODB_VECTOR_INDEX))
+except Exception as e:
+    indexes = None
+    print(f"    ✗ Could not list search indexes (not an Atlas cluster?): {e}")
+
+if indexes == []:
+    print(f"    ✗ Index '{MONGODB_VECTOR_INDEX}' does not exist")
+    print(f"      rag-service creates it at startup when RAG_VECTOR_INDEX_PROVISION=create (needs createSearchIndexes)")
+elif indexes:
+    index = indexes[0]
+    fields = (index.get("latestDefinition") or {}).get("fields", [])
+    print(f"    Type: {index.get('type')}  Status: {index.get('status')}  Queryable: {index.get('queryable')}")
+    for field in fields:
+        details = ", ".join(f"{key}={value}" for key, value in field.items() if key not in ("type", "path"))
+        print(f"      - {field.get('type'):<7} {field.get('path')} {details}")
+    filter_paths = {field.get("path") for field in fields if field.get("type") == "filter"}
+    missing = [path for path in REQUIRED_FILTER_PATHS if path not in filter_paths]
+    if missing:
+        print(f"    ✗ Missing filter fields: {missing} (filtered $vectorSearch queries will be rejected)")
+    else:
+        print(f"    ✓ All filter fields are declared")
+    if index.get("status") == "READY" and index.get("queryable"):
+        print(f"    ✓ Index is ready")
+    else:
+        print(f"    ⚠ Index is not queryable yet (rag-service /ready returns 503 until it is)")
 
 # Step 6: Simulate RAG query (metadata filter)
 print("\n[6] Simulated RAG Query (Metadata Filter)")
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Migrate rag_vectors chunks to the compact chunk schema
+
+Rewrites every chunk that still carries LlamaIndex's serialized node (`metadata._node_content`):
+    text      -> kept once at the top level (recovered from `_node_content` if it was only stored there)
+    metadata  -> user_id / material_id / filename (str), page / chunk (int), page_label (only if non-numeric)
+
+`_node_content`, `_node_type`, `doc_id`, `document_id`, `ref_doc_id` and any other loader metadata
+are dropped. Chunks are processed one material at a time and get a per-material `chunk` ordinal
+in reading order (page, then offset within the page). Embeddings are not touched.
+
+Only chunks that still have `_node_content` are selected, so the migration can be interrupted and
+re-run at any time; chunks of a partially migrated material are numbered after its existing ordinals.
+
+Usage:
+    python scripts/migrate_rag_chunks_compact.py [--batch-size 500] [--dry-run]
+"""
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+from pymongo import DESCENDING, MongoClient, UpdateOne
+
+project_root = Path(__file__).resolve().parent.parent
+rag_service_dir = project_root / "server" / "python-services" / "rag-service"
+sys.path.insert(0, str(rag_service_dir))
+
+from chunk_schema import compact_metadata
+from ingestion import CHUNK_ORDINAL_KEY, PAGE_NUMBER_KEY
+
+load_dotenv(project_root / ".env")
+
+MONGODB_URI = os.getenv('MONGODB_URI')
+MONGODB_VECTOR_DB = os.getenv('MONGODB_VECTOR_DB', 'AIAssistant')
+MONGODB_VECTOR_COLLECTION = os.getenv('MONGODB_VECTOR_COLLECTION', 'rag_vectors')
+
+PENDING_FILTER = {"metadata._node_content": {"$exists": True}}
+
+
+def collection_stats(db, name: str) -> dict:
+    stats = db.command("collStats", name)
+    return {"size": int(stats.get("size", 0)), "avg": int(stats.get("avgObjSize", 0))}
+
+
+def format_mb(size: int) -> str:
+    return f"{size / (1024 * 1024):.1f} MB"
+
+
+def parse_node_content(metadata: dict) -> dict:
+    try:
+        return json.loads(metadata.get("_node_content") or "{}")
+    except (TypeError, ValueError):
+        return {}
+
+
+def reading_order(doc: dict) -> tuple:
+    """Sort key for a legacy chunk: numeric page, then character offset inside the page"""
+    metadata = doc.get("metadata") or {}
+    page = compact_metadata(metadata).get(PAGE_NUMBER_KEY)
+    offset = doc["_node"].get("start_char_idx") or 0
+    return (page is None, page or 0, offset, str(doc["_id"]))
+
+
+def next_ordinal(collection, material_id) -> int:
+    """Ordinals already assigned to this material's migrated chunks (from an interrupted run)"""
+    latest = collection.find_one(
+        {
+            "metadata.material_id": material_id,
+            "metadata._node_content": {"$exists": False},
+            f"metadata.{CHUNK_ORDINAL_KEY}": {"$type": "number"},
+        },
+        {f"metadata.{CHUNK_ORDINAL_KEY}": 1},
+        sort=[(f"metadata.{CHUNK_ORDINAL_KEY}", DESCENDING)],
+    )
+    return latest["metadata"][CHUNK_ORDINAL_KEY] + 1 if latest else 0
+
+
+def migrate_material(collection, material_id, batch_size: int) -> int:
+    docs = list(collection.find(
+        {**PENDING_FILTER, "metadata.material_id": material_id},
+        {"text": 1, "metadata": 1},
+    ))
+    for doc in docs:
+        doc["_node"] = parse_node_content(doc.get("metadata") or {})
+    docs.sort(key=reading_order)
+
+    ordinal = next_ordinal(collection, material_id)
+    operations = []
+    for doc in docs:
+        metadata = dict(doc.get("metadata") or {})
+        metadata[CHUNK_ORDINAL_KEY] = ordinal
+        ordinal += 1
+        update = {"metadata": compact_metadata(metadata)}
+        if not doc.get("text") and doc["_node"].get("text"):
+            update["text"] = doc["_node"]["text"]
+        # re-check the filter so a chunk rewritten concurrently is never renumbered
+        operations.append(UpdateOne({"_id": doc["_id"], **PENDING_FILTER}, {"$set": update}))
+
+    modified = 0
+    for start in range(0, len(operations), batch_size):
+        result = collection.bulk_write(operations[start:start + batch_size], ordered=True)
+        modified += result.modified_count
+    return modified
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="only report how many chunks would be rewritten")
+    args = parser.parse_args()
+
+    client = MongoClient(MONGODB_URI)
+    db = client[MONGODB_VECTOR_DB]
+    collection = db[MONGODB_VECTOR_COLLECTION]
+
+    pending = collection.count_documents(PENDING_FILTER)
+    before = collection_stats(db, MONGODB_VECTOR_COLLECTION)
+    print(f"Collection: {MONGODB_VECTOR_DB}.{MONGODB_VECTOR_COLLECTION}")
+    print(f"Chunks to migrate: {pending}  (collection size {format_mb(before['size'])}, "
+          f"average chunk {before['avg']} bytes)")
+    if args.dry_run or pending == 0:
+        client.close()
+        return
+
+    material_ids = sorted(collection.distinct("metadata.material_id", PENDING_FILTER), key=str)
+    migrated = 0
+    for position, material_id in enumerate(material_ids, start=1):
+        migrated += migrate_material(collection, material_id, max(1, args.batch_size))
+        print(f"  [{position}/{len(material_ids)}] material {material_id}: migrated {migrated}/{pending}")
+
+    after = collection_stats(db, MONGODB_VECTOR_COLLECTION)
+    saved = before["size"] - after["size"]
+    print(f"\nDone: {migrated} chunks rewritten")
+    print(f"Collection size: {format_mb(before['size'])} -> {format_mb(after['size'])} "
+          f"(saved {format_mb(saved)}, {saved / before['size'] * 100 if before['size'] else 0:.0f}%)")
+    print(f"Average chunk: {before['avg']} -> {after['avg']} bytes")
+    print("Run `compact` on the collection to return freed space to the OS.")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Migrate rag_vectors to compact embedding storage
+
+Rewrites every chunk whose `embedding` is still a plain array of doubles:
+    embedding       -> truncated (Matryoshka) and optionally int8 / binary quantized BSON vector
+    embedding_full  -> full-precision float32 BSON vector (only with --rescore-factor > 1)
+
+Only array-typed embeddings are selected, so the migration is idempotent and can be
+interrupted and re-run at any time. Use the same values as the rag-service
+RAG_VECTOR_DIMENSIONS / RAG_VECTOR_QUANTIZATION / RAG_VECTOR_RESCORE_FACTOR settings,
+and update the Atlas vector index `numDimensions` to match --dimensions.
+
+Usage:
+    python scripts/migrate_rag_vectors_compact.py --dimensions 256 --quantization int8 [--dry-run]
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+
+project_root = Path(__file__).resolve().parent.parent
+rag_service_dir = project_root / "server" / "python-services" / "rag-service"
+sys.path.insert(0, str(rag_service_dir))
+
+from vector_codec import QUANTIZATION_MODES, VectorCodec
+
+load_dotenv(project_root / ".env")
+
+MONGODB_URI = os.getenv('MONGODB_URI')
+MONGODB_VECTOR_DB = os.getenv('MONGODB_VECTOR_DB', 'AIAssistant')
+MONGODB_VECTOR_COLLECTION = os.getenv('MONGODB_VECTOR_COLLECTION', 'rag_vectors')
+
+PENDING_FILTER = {"embedding": {"$type": "array"}}
+
+
+def collection_size(db, name: str) -> int:
+    return int(db.command("collStats", name).get("size", 0))
+
+
+def format_mb(size: int) -> str:
+    return f"{size / (1024 * 1024):.1f} MB"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dimensions", type=int, default=int(os.getenv('RAG_VECTOR_DIMENSIONS', '0')))
+    parser.add_argument("--quantization", choices=QUANTIZATION_MODES, default=os.getenv('RAG_VECTOR_QUANTIZATION', 'none'))
+    parser.add_argument("--rescore-factor", type=int, default=int(os.getenv('RAG_VECTOR_RESCORE_FACTOR', '4')))
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="only report how many chunks would be rewritten")
+    args = parser.parse_args()
+
+    codec = VectorCodec(
+        dimensions=args.dimensions,
+        quantization=args.quantization,
+        keep_full=args.rescore_factor > 1,
+    )
+    if not codec.enabled:
+        parser.error("nothing to do: set --dimensions and/or --quantization")
+
+    client = MongoClient(MONGODB_URI)
+    db = client[MONGODB_VECTOR_DB]
+    collection = db[MONGODB_VECTOR_COLLECTION]
+
+    pending = collection.count_documents(PENDING_FILTER)
+    size_before = collection_size(db, MONGODB_VECTOR_COLLECTION)
+    print(f"Collection: {MONGODB_VECTOR_DB}.{MONGODB_VECTOR_COLLECTION}")
+    print(f"Target: dimensions={args.dimensions or 'unchanged'}, quantization={args.quantization}, "
+          f"full-precision copy={'yes' if codec.keep_full else 'no'}")
+    print(f"Chunks to migrate: {pending}  (collection size {format_mb(size_before)})")
+    if args.dry_run or pending == 0:
+        client.close()
+        return
+
+    migrated = 0
+    last_id = None
+    while True:
+        query = dict(PENDING_FILTER)
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = list(
+            collection.find(query, {"embedding": 1})
+            .sort("_id", 1)
+            .limit(args.batch_size)
+        )
+        if not batch:
+            break
+
+        operations = []
+        for doc in batch:
+            update = {"embedding": codec.encode(doc["embedding"])}
+            if codec.keep_full:
+                update["embedding_full"] = codec.encode_full(doc["embedding"])
+            # re-check the array type so a concurrent writer's compact doc is never re-encoded
+            operations.append(UpdateOne({"_id": doc["_id"], **PENDING_FILTER}, {"$set": update}))
+        result = collection.bulk_write(operations, ordered=False)
+
+        migrated += result.modified_count
+        last_id = batch[-1]["_id"]
+        print(f"  migrated {migrated}/{pending}")
+
+    size_after = collection_size(db, MONGODB_VECTOR_COLLECTION)
+    saved = size_before - size_after
+    print(f"\nDone: {migrated} chunks rewritten")
+    print(f"Collection size: {format_mb(size_before)} -> {format_mb(size_after)} "
+          f"(saved {format_mb(saved)}, {saved / size_before * 100 if size_before else 0:.0f}%)")
+    print("Run `compact` on the collection to return freed space to the OS.")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import { requireAuth } from '~/server/utils/auth'
 import { connectDB } from '~/server/utils/mongodb'
 import { LearningMaterial } from '~/server/models/LearningMaterial'
 import { deleteFromR2 } from '~/server/utils/r2'
+import { deleteMaterialFromRag } from '~/server/utils/rag'
 
 export default defineEventHandler(async (event) => {
   const { userId } = await requireAuth(event)
@@ -37,6 +38,14 @@ export default defineEventHandler(async (event) => {
       }
     }
 
+    // Delete the material's chunks from the vector store
+    try {
+      await deleteMaterialFromRag(id, userId)
+    } catch (error) {
+      console.error('[Delete] Failed to delete RAG vectors:', error)
+      // Continue anyway - orphaned chunks can be removed later via POST /compact
+    }
+
     // Delete from database
     await LearningMaterial.findByIdAndDelete(id)
 
@@ -6,7 +6,7 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional
 import sys
 from pathlib import Path
 
@@ -20,6 +20,7 @@ for extra_path in (service_dir, python_services_dir):
         sys.path.append(path_str)
 
 from shared.config import settings
+from shared.metrics import metrics_response
 from service import create_orchestrator
 
 # 创建 FastAPI 应用
@@ -56,6 +57,7 @@ class ChatRequest(BaseModel):
     user_id: str
     history: Optional[List[ChatMessage]] = None
     material_ids: Optional[List[str]] = None
+    rag_mode: Optional[Literal["retrieve", "query"]] = None  # 默认取 AGENT_RAG_MODE
 
 
 # ===== API 端点 =====
@@ -70,6 +72,12 @@ async def health_check():
     }
 
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 指标：RAG 调用 / 网页搜索 / LLM 耗时直方图与 token 计数"""
+    return metrics_response()
+
+
 @app.post("/chat")
 async def chat(request: ChatRequest):
     """
@@ -85,6 +93,7 @@ async def chat(request: ChatRequest):
             user_id=request.user_id,
             history=history,
             material_ids=request.material_ids,
+            rag_mode=request.rag_mode,
         )
 
         return StreamingResponse(stream, media_type="text/event-stream")
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-import json
+import time
 from dataclasses import dataclass
 from typing import Any, AsyncGenerator, Dict, List, Optional
 
@@ -8,6 +8,9 @@ import aiohttp
 from openai import AsyncOpenAI
 
 from shared.config import settings
+from shared.context_packing import pack_sources
+from shared.metrics import ServiceMetrics
+from shared.sse import format_sse
 
 SYSTEM_PROMPT = """
 You are StudyBuddy, a friendly AI teaching assistant that helps students master their coursework.
@@ -23,6 +26,14 @@ Guidelines:
 - If you cannot find a relevant answer, say so and suggest how the student could gather the info.
 """.strip()
 
+# 只取格式化来源时用到的元数据键，避免传输完整 metadata
+RAG_SOURCE_FIELDS = ["filename", "material_id", "page_label"]
+
+RAG_MODE_ENDPOINTS = {
+    "query": "/query",
+    "retrieve": "/retrieve",
+}
+
 WEB_SEARCH_KEYWORDS = [
     "current",
     "latest",
@@ -37,6 +48,9 @@ WEB_SEARCH_KEYWORDS = [
 ]
 
 
+metrics = ServiceMetrics("agent-service")
+
+
 @dataclass
 class ToolCall:
     name: str
@@ -58,9 +72,11 @@ class AgentOrchestrator:
         user_id: str,
         history: Optional[List[Dict[str, str]]] = None,
         material_ids: Optional[List[str]] = None,
+        rag_mode: Optional[str] = None,
     ) -> AsyncGenerator[bytes, None]:
         history = history or []
         material_ids = material_ids or []
+        rag_mode = rag_mode or settings.AGENT_RAG_MODE
 
         (
             rag_result,
@@ -71,6 +87,7 @@ class AgentOrchestrator:
             message=message,
             user_id=user_id,
             material_ids=material_ids,
+            rag_mode=rag_mode,
         )
 
         accumulated_chunks: List[str] = []
@@ -86,6 +103,14 @@ class AgentOrchestrator:
 
         final_message = "".join(accumulated_chunks).strip()
         metadata["message"] = final_message
+        metrics.log(
+            "agent.chat",
+            user_id=user_id,
+            rag_mode=rag_mode,
+            materials=len(material_ids),
+            tool_calls={call.name: call.status for call in tool_calls},
+            answer_chars=len(final_message),
+        )
 
         yield format_sse(
             "metadata",
@@ -103,21 +128,34 @@ class AgentOrchestrator:
             },
         )
 
-    async def _query_rag(self, *, question: str, user_id: str, material_ids: List[str]) -> Dict[str, Any]:
+    async def _query_rag(
+        self,
+        *,
+        question: str,
+        user_id: str,
+        material_ids: List[str],
+        rag_mode: str,
+    ) -> Dict[str, Any]:
+        endpoint = RAG_MODE_ENDPOINTS.get(rag_mode)
+        if endpoint is None:
+            raise ValueError(f"Unsupported RAG mode: {rag_mode}")
+
         payload = {
             "question": question,
             "user_id": user_id,
             "material_ids": material_ids,
             "top_k": 5,
+            "fields": RAG_SOURCE_FIELDS,
         }
 
         timeout = aiohttp.ClientTimeout(total=40)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(f"{settings.RAG_SERVICE_URL}/query", json=payload) as resp:
-                if resp.status >= 400:
-                    text = await resp.text()
-                    raise RuntimeError(f"RAG query failed ({resp.status}): {text}")
-                return await resp.json()
+        with metrics.time("rag_http"):
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.post(f"{settings.RAG_SERVICE_URL}{endpoint}", json=payload) as resp:
+                    if resp.status >= 400:
+                        text = await resp.text()
+                        raise RuntimeError(f"RAG query failed ({resp.status}): {text}")
+                    return await resp.json()
 
     async def _search_web(self, query: str) -> Optional[List[Dict[str, str]]]:
         if not settings.BRAVE_SEARCH_API_KEY:
@@ -134,24 +172,25 @@ class AgentOrchestrator:
         }
 
         timeout = aiohttp.ClientTimeout(total=15)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get("https://api.search.brave.com/res/v1/web/search", params=params, headers=headers) as resp:
-                if resp.status >= 400:
-                    text = await resp.text()
-                    raise RuntimeError(f"Brave search failed ({resp.status}): {text}")
-
-                data = await resp.json()
-                web_results = data.get("web", {}).get("results", [])
-                formatted = []
-                for item in web_results[:3]:
-                    formatted.append(
-                        {
-                            "title": item.get("title"),
-                            "url": item.get("url"),
-                            "snippet": item.get("description") or item.get("snippet"),
-                        }
-                    )
-                return formatted
+        with metrics.time("web_search"):
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.get("https://api.search.brave.com/res/v1/web/search", params=params, headers=headers) as resp:
+                    if resp.status >= 400:
+                        text = await resp.text()
+                        raise RuntimeError(f"Brave search failed ({resp.status}): {text}")
+
+                    data = await resp.json()
+                    web_results = data.get("web", {}).get("results", [])
+                    formatted = []
+                    for item in web_results[:3]:
+                        formatted.append(
+                            {
+                                "title": item.get("title"),
+                                "url": item.get("url"),
+                                "snippet": item.get("description") or item.get("snippet"),
+                            }
+                        )
+                    return formatted
 
     async def _prepare_context(
         self,
@@ -159,6 +198,7 @@ class AgentOrchestrator:
         message: str,
         user_id: str,
         material_ids: List[str],
+        rag_mode: str,
     ) -> tuple[Optional[Dict[str, Any]], Optional[List[Dict[str, str]]], List[ToolCall], Dict[str, Any]]:
         tool_calls: List[ToolCall] = []
         metadata: Dict[str, Any] = {
@@ -172,8 +212,10 @@ class AgentOrchestrator:
                     question=message,
                     user_id=user_id,
                     material_ids=material_ids,
+                    rag_mode=rag_mode,
                 )
                 metadata["rag_used"] = True
+                metadata["rag_mode"] = rag_mode
                 metadata["rag_sources"] = rag_result.get("sources", [])
                 tool_calls.append(
                     ToolCall(
@@ -234,19 +276,29 @@ class AgentOrchestrator:
             web_results=web_results,
         )
 
+        started = time.perf_counter()
+        first_token = True
         stream = await self._llm.chat.completions.create(
             model=settings.OPENAI_COMPLETION_MODEL,
             temperature=0.2,
             messages=messages,
             stream=True,
+            # 最后一个分块带本次请求的 token 用量（choices 为空）
+            stream_options={"include_usage": True},
         )
 
         async for chunk in stream:
+            if chunk.usage is not None:
+                metrics.usage(settings.OPENAI_COMPLETION_MODEL, chunk.usage)
             if not chunk.choices:
                 continue
             delta = chunk.choices[0].delta.content
             if delta:
+                if first_token:
+                    metrics.time_to_first_token(time.perf_counter() - started)
+                    first_token = False
                 yield delta
+        metrics.observe("llm_synthesis", time.perf_counter() - started)
 
     def _build_messages(
         self,
@@ -260,9 +312,13 @@ class AgentOrchestrator:
 
         if rag_result:
             sources_text = self._format_rag_sources(rag_result.get("sources", []))
-            context_sections.append(
-                f"Course materials summary:\n{rag_result.get('answer', '').strip()}\n\nSources:\n{sources_text}"
-            )
+            summary_text = (rag_result.get("answer") or "").strip()
+            if summary_text:
+                context_sections.append(
+                    f"Course materials summary:\n{summary_text}\n\nSources:\n{sources_text}"
+                )
+            else:
+                context_sections.append(f"Course materials:\n{sources_text}")
 
         if web_results:
             web_lines = []
@@ -297,27 +353,28 @@ class AgentOrchestrator:
         if not sources:
             return "(no vector matches)"
 
-        lines = []
-        for idx, source in enumerate(sources[:3], start=1):
-            metadata = source.get("metadata", {})
-            filename = metadata.get("filename") or metadata.get("material_id")
-            score = source.get("score")
-            snippet = (source.get("snippet") or "").strip().replace("\n\n", "\n")
-            if isinstance(score, (int, float)):
-                score_display = f"{score:.2f}"
-            else:
-                score_display = "n/a"
+        packed = pack_sources(
+            sources,
+            token_budget=settings.AGENT_CONTEXT_TOKEN_BUDGET,
+            render=self._render_rag_source,
+            model=settings.OPENAI_COMPLETION_MODEL,
+            separator="\n\n",
+        )
+        return "\n\n".join(self._render_rag_source(idx, source) for idx, source in enumerate(packed, start=1))
+
+    @staticmethod
+    def _render_rag_source(idx: int, source: Dict[str, Any]) -> str:
+        metadata = source.get("metadata", {})
+        filename = metadata.get("filename") or metadata.get("material_id")
+        score = source.get("score")
+        snippet = (source.get("snippet") or "").strip().replace("\n\n", "\n")
+        if isinstance(score, (int, float)):
+            score_display = f"{score:.2f}"
+        else:
+            score_display = "n/a"
 
-            lines.append(
-                f"[{idx}] {filename or 'Material'} (score: {score_display})\n{snippet[:400]}"
-            )
-        return "\n\n".join(lines)
+        return f"[{idx}] {filename or 'Material'} (score: {score_display})\n{snippet}"
 
 
 def create_orchestrator() -> AgentOrchestrator:
     return AgentOrchestrator()
-
-
-def format_sse(event: str, data: Dict[str, Any]) -> bytes:
-    payload = json.dumps(data, ensure_ascii=False)
-    return f"event: {event}\ndata: {payload}\n\n".encode("utf-8")
@@ -1,12 +1,17 @@
 from __future__ import annotations
 
 import json
+import logging
 from typing import Any, Dict, List, Optional
 
 import aiohttp
 from openai import AsyncOpenAI
 
 from shared.config import settings
+from shared.context_packing import pack_sources
+from shared.metrics import ServiceMetrics
+
+metrics = ServiceMetrics("quiz-service")
 
 QUESTION_TYPE_LABELS = {
     "multiple_choice": "multiple-choice",
@@ -14,6 +19,14 @@ QUESTION_TYPE_LABELS = {
     "short_answer": "short answer",
 }
 
+# 只取格式化来源时用到的元数据键，避免传输完整 metadata
+RAG_SOURCE_FIELDS = ["filename", "material_id", "page_label"]
+
+RAG_MODE_ENDPOINTS = {
+    "query": "/query",
+    "retrieve": "/retrieve",
+}
+
 DIFFICULTY_TONES = {
     "easy": "friendly and confidence-building",
     "medium": "balanced and skills-focused",
@@ -37,11 +50,16 @@ class QuizGenerator:
         question_type: str,
         difficulty: str,
         count: int,
+        rag_mode: Optional[str] = None,
     ) -> Dict[str, Any]:
         if not material_ids:
             raise ValueError("material_ids is required for quiz generation")
 
-        context = await self._fetch_material_context(material_ids=material_ids, user_id=user_id)
+        context = await self._fetch_material_context(
+            material_ids=material_ids,
+            user_id=user_id,
+            rag_mode=rag_mode or settings.QUIZ_RAG_MODE,
+        )
         sources = context.get("sources", [])
         if not sources:
             raise ValueError("无法从学习资料中检索到内容，请先上传并处理 PDF 文件。")
@@ -57,7 +75,7 @@ class QuizGenerator:
             count=count,
         )
 
-        completion = await self._client.chat.completions.create(
+        completion = await self._complete(
             model=settings.OPENAI_COMPLETION_MODEL,
             temperature=0.3,
             response_format={"type": "json_object"},
@@ -128,7 +146,7 @@ class QuizGenerator:
             context_summary=context_summary,
         )
 
-        completion = await self._client.chat.completions.create(
+        completion = await self._complete(
             model=settings.OPENAI_COMPLETION_MODEL,
             temperature=0.2,
             response_format={"type": "json_object"},
@@ -209,7 +227,7 @@ class QuizGenerator:
             "请直接输出解释文本，不要重复题目。"
         )
 
-        completion = await self._client.chat.completions.create(
+        completion = await self._complete(
             model=settings.OPENAI_COMPLETION_MODEL,
             temperature=0.2,
             messages=[
@@ -224,27 +242,56 @@ class QuizGenerator:
             return "Explanation unavailable. Review the study notes."
         return explanation_text
 
-    async def _fetch_material_context(self, *, material_ids: List[str], user_id: str) -> Dict[str, Any]:
+    async def _fetch_material_context(
+        self,
+        *,
+        material_ids: List[str],
+        user_id: str,
+        rag_mode: str,
+    ) -> Dict[str, Any]:
         if not settings.RAG_SERVICE_URL:
             return {}
 
         timeout = aiohttp.ClientTimeout(total=30)
         async with aiohttp.ClientSession(timeout=timeout) as session:
-            context = await self._rag_query(session, material_ids=material_ids, user_id=user_id, top_k=8)
+            context = await self._rag_query(
+                session,
+                material_ids=material_ids,
+                user_id=user_id,
+                top_k=8,
+                rag_mode=rag_mode,
+            )
             sources = context.get("sources") or []
             summary_text = context.get("answer") or ""
 
-            print(f"[Quiz Generator Debug] Initial RAG query for materials={material_ids}, user={user_id}")
-            print(f"[Quiz Generator Debug] Initial sources count: {len(sources)}")
-            print(f"[Quiz Generator Debug] Summary length: {len(summary_text)}")
+            metrics.log(
+                "quiz.context",
+                rag_mode=rag_mode,
+                material_ids=material_ids,
+                user_id=user_id,
+                sources=len(sources),
+                summary_chars=len(summary_text),
+            )
 
             if not sources:
                 fallback_sources: List[Dict[str, Any]] = []
                 summary_parts: List[str] = [summary_text] if summary_text else []
 
                 for material_id in material_ids:
-                    extra = await self._rag_query(session, material_ids=[material_id], user_id=user_id, top_k=6)
-                    print(f"[Quiz Generator Debug] Fallback query for material={material_id}: {len(extra.get('sources', []))} sources")
+                    extra = await self._rag_query(
+                        session,
+                        material_ids=[material_id],
+                        user_id=user_id,
+                        top_k=6,
+                        rag_mode=rag_mode,
+                    )
+                    metrics.log(
+                        "quiz.context.per_material_fallback",
+                        level=logging.WARNING,
+                        material_id=material_id,
+                        user_id=user_id,
+                        sources=len(extra.get("sources", [])),
+                    )
                     if extra.get("sources"):
                         fallback_sources.extend(extra["sources"])
                     if extra.get("answer"):
@@ -258,10 +305,14 @@ class QuizGenerator:
                     context["answer"] = " \n".join(part.strip() for part in summary_parts if part.strip())
 
             if not context.get("sources"):
-                print(f"[Quiz Generator Debug] FATAL: No sources found after fallback!")
-                print(f"[Quiz Generator Debug] This means MongoDB Atlas Vector Search Index is missing.")
-                print(f"[Quiz Generator Debug] Run: python3 diagnose_rag_pipeline.py")
-                print(f"[Quiz Generator Debug] See: ATLAS_VECTOR_SEARCH_SETUP.md")
+                # 通常说明向量索引缺失或未就绪：检查 rag-service 的 GET /ready 或运行 scripts/diagnose_rag_pipeline.py
+                metrics.log(
+                    "quiz.context.no_sources",
+                    level=logging.ERROR,
+                    rag_mode=rag_mode,
+                    material_ids=material_ids,
+                    user_id=user_id,
+                )
                 raise ValueError(
                     "无法从学习资料中检索到内容。"
                     "可能原因：MongoDB Atlas Vector Search Index 未创建或未激活。"
@@ -277,19 +328,33 @@ class QuizGenerator:
         material_ids: List[str],
         user_id: str,
         top_k: int,
+        rag_mode: str,
     ) -> Dict[str, Any]:
+        endpoint = RAG_MODE_ENDPOINTS.get(rag_mode)
+        if endpoint is None:
+            raise ValueError(f"Unsupported RAG mode: {rag_mode}")
+
         payload = {
             "question": "Summarize the most important concepts for quiz generation.",
             "material_ids": material_ids,
             "user_id": user_id,
             "top_k": top_k,
+            "fields": RAG_SOURCE_FIELDS,
         }
 
-        async with session.post(f"{settings.RAG_SERVICE_URL}/query", json=payload) as resp:
-            if resp.status >= 400:
-                text = await resp.text()
-                raise RuntimeError(f"Failed to fetch material context ({resp.status}): {text}")
-            return await resp.json()
+        with metrics.time("rag_http"):
+            async with session.post(f"{settings.RAG_SERVICE_URL}{endpoint}", json=payload) as resp:
+                if resp.status >= 400:
+                    text = await resp.text()
+                    raise RuntimeError(f"Failed to fetch material context ({resp.status}): {text}")
+                return await resp.json()
+
+    async def _complete(self, **params: Any) -> Any:
+        """chat.completions.create，并记录 LLM 耗时与 token 用量"""
+        with metrics.time("llm_synthesis"):
+            completion = await self._client.chat.completions.create(**params)
+        metrics.usage(params["model"], completion.usage)
+        return completion
 
     def _build_generation_prompt(
         self,
@@ -373,13 +438,20 @@ class QuizGenerator:
     def _format_sources(self, sources: List[Dict[str, Any]]) -> str:
         if not sources:
             return "(no additional sources)"
-        lines = []
-        for idx, source in enumerate(sources[:5], start=1):
-            meta = source.get("metadata", {})
-            filename = meta.get("filename") or meta.get("material_id") or "material"
-            snippet = (source.get("snippet") or "").strip().replace("\n", " ")
-            lines.append(f"[{idx}] {filename}: {snippet[:500]}")
-        return "\n".join(lines)
+        packed = pack_sources(
+            sources,
+            token_budget=settings.QUIZ_CONTEXT_TOKEN_BUDGET,
+            render=self._render_source,
+            model=settings.OPENAI_COMPLETION_MODEL,
+        )
+        return "\n".join(self._render_source(idx, source) for idx, source in enumerate(packed, start=1))
+
+    @staticmethod
+    def _render_source(idx: int, source: Dict[str, Any]) -> str:
+        meta = source.get("metadata", {})
+        filename = meta.get("filename") or meta.get("material_id") or "material"
+        snippet = (source.get("snippet") or "").strip().replace("\n", " ")
+        return f"[{idx}] {filename}: {snippet}"
 
     def _normalize_answer(self, value: str) -> str:
         return (value or "").strip().lower()
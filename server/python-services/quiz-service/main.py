@@ -5,7 +5,7 @@ Quiz 服务 - 主入口
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Literal, Optional
 import sys
 from pathlib import Path
 
@@ -19,6 +19,7 @@ for extra_path in (service_dir, python_services_dir):
         sys.path.append(path_str)
 
 from shared.config import settings
+from shared.metrics import metrics_response
 from generator import QuizGenerator
 
 # 创建 FastAPI 应用
@@ -47,6 +48,7 @@ class GenerateQuizRequest(BaseModel):
     question_type: str  # 'multiple_choice', 'true_false', 'short_answer'
     difficulty: str  # 'easy', 'medium', 'hard'
     count: int = Field(default=5, ge=1, le=10)
+    rag_mode: Optional[Literal["retrieve", "query"]] = None  # 默认取 QUIZ_RAG_MODE
 
 
 class Question(BaseModel):
@@ -96,6 +98,12 @@ async def health_check():
     }
 
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 指标：RAG 调用与 LLM 耗时直方图、token 计数"""
+    return metrics_response()
+
+
 generator = QuizGenerator()
 
 
@@ -114,6 +122,7 @@ async def generate_quiz(request: GenerateQuizRequest):
             question_type=request.question_type,
             difficulty=request.difficulty,
             count=request.count,
+            rag_mode=request.rag_mode,
         )
         questions = [Question(**item) for item in result.get("questions", [])]
         return GenerateQuizResponse(
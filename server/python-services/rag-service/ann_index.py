@@ -0,0 +1,530 @@
+"""按用户分区的 IVF 近似最近邻索引（内存映射持久化）
+
+每个用户一个分区目录：
+    manifest.json          维度 / 条数 / 聚类数 / 当前代号与构建标识（最后写入，读者以它为准）
+    vectors.<gen>.f32      行归一化的 float32 向量，按写入顺序追加
+    assign.<gen>.i32       每行所属的倒排列表编号
+    rows.<gen>.jsonl       每行的 (chunk _id, material_id)
+    centroids.<gen>.f32    IVF 聚类中心
+
+向量文件通过 np.memmap 只读映射，重启后的 worker 直接从页缓存读取，不需要重建，
+也不会把向量复制到 Python 堆上。process_document 写入新 chunk 时只追加行并分配到
+最近的聚类中心；条数翻倍后才重新训练聚类中心。写入方在进程内保留每个分区已有的
+chunk _id 集合与 rows 文件偏移，追加时只读取其他进程新写入的行，批次只与这个集合比对去重。
+
+读者每次检索前读取 manifest，(代号, 构建标识, 条数) 变化即重新打开分区，同一目录下
+其他进程的写入立即可见（不依赖 mtime 精度）。分区目录通常在各 pod 本地，其他 pod 的写入
+不会落到这里：manifest 记录分区最后一次从 MongoDB 完整构建的时间，超过 ttl 后重新构建。
+"""
+from __future__ import annotations
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core import QueryBundle
+from llama_index.core.schema import NodeWithScore
+
+from vector_backends import PrivateScopes, hydrate_nodes, load_user_vectors, normalize_rows, row_key, top_k_indices
+
+MANIFEST_NAME = "manifest.json"
+ASSIGN_BLOCK_ROWS = 8192
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_ROWS = 20000
+MAX_LISTS = 1024
+
+
+def list_count_for(rows: int, min_train_rows: int) -> int:
+    if rows < min_train_rows:
+        return 1
+    return max(1, min(MAX_LISTS, int(math.sqrt(rows))))
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, *, seed: int = 0) -> np.ndarray:
+    """球面 k-means（输入已归一化），只在采样行上训练"""
+    rng = np.random.default_rng(seed)
+    rows = vectors.shape[0]
+    if rows > KMEANS_SAMPLE_ROWS:
+        sample = np.asarray(vectors[np.sort(rng.choice(rows, KMEANS_SAMPLE_ROWS, replace=False))])
+    else:
+        sample = np.asarray(vectors)
+
+    nlist = min(nlist, sample.shape[0])
+    centroids = sample[rng.choice(sample.shape[0], nlist, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = ~sums.any(axis=1)
+        sums[empty] = centroids[empty]
+        centroids = normalize_rows(sums)
+    return np.ascontiguousarray(centroids, dtype=np.float32)
+
+
+def assign_to_lists(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assign = np.empty(vectors.shape[0], dtype=np.int32)
+    for start in range(0, vectors.shape[0], ASSIGN_BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + ASSIGN_BLOCK_ROWS])
+        assign[start:start + block.shape[0]] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+def manifest_version(manifest: Dict[str, Any]) -> Tuple[Any, Any, int]:
+    return manifest["generation"], manifest.get("build"), int(manifest["count"])
+
+
+class AnnPartition:
+    """一个分区的只读视图（向量为 memmap）"""
+
+    def __init__(self, directory: Path, manifest: Dict[str, Any]) -> None:
+        self.directory = directory
+        self.manifest = manifest
+        self.count = int(manifest["count"])
+        self.dim = int(manifest["dim"])
+        self.nlist = int(manifest["nlist"])
+        generation = manifest["generation"]
+        self.version = manifest_version(manifest)
+        # 最后一次从 MongoDB 完整构建的时间（epoch 秒）；旧版本的分区没有该字段，视为已过期
+        self.synced_at = float(manifest.get("synced_at", 0.0))
+
+        self.vectors = np.memmap(
+            directory / f"vectors.{generation}.f32", dtype=np.float32, mode="r", shape=(self.count, self.dim)
+        )
+        self.centroids = np.fromfile(directory / f"centroids.{generation}.f32", dtype=np.float32).reshape(
+            self.nlist, self.dim
+        )
+        assign = np.fromfile(directory / f"assign.{generation}.i32", dtype=np.int32, count=self.count)
+        self._order = np.argsort(assign, kind="stable").astype(np.int64)
+        self._offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=self.nlist))))
+
+        self.ids: List[Any] = []
+        material_ids: List[str] = []
+        with open(directory / f"rows.{generation}.jsonl", "r", encoding="utf-8") as rows_file:
+            for line in rows_file:
+                if len(self.ids) >= self.count:
+                    break
+                doc_id, material_id = json.loads(line)
+                self.ids.append(doc_id)
+                material_ids.append(material_id)
+        self.material_ids = np.asarray(material_ids)
+
+    def search(
+        self,
+        query: np.ndarray,
+        *,
+        material_ids: Optional[Sequence[str]],
+        top_k: int,
+        nprobe: int,
+    ) -> List[Tuple[Any, float]]:
+        if self.count == 0 or top_k <= 0:
+            return []
+
+        if self.nlist == 1:
+            probe_order = np.zeros(1, dtype=np.int64)
+        else:
+            probe_order = np.argsort(-(self.centroids @ query))
+
+        probes = max(1, min(nprobe, self.nlist))
+        while True:
+            rows = np.concatenate([
+                self._order[self._offsets[list_id]:self._offsets[list_id + 1]]
+                for list_id in probe_order[:probes]
+            ])
+            if material_ids:
+                rows = rows[np.isin(self.material_ids[rows], list(material_ids))]
+            # 过滤后候选不足时扩大探测范围，避免预过滤导致结果过少
+            if rows.size >= top_k or probes >= self.nlist:
+                break
+            probes = min(self.nlist, probes * 2)
+
+        if rows.size == 0:
+            return []
+
+        rows.sort()
+        scores = self.vectors[rows] @ query
+        best = top_k_indices(scores, top_k)
+        return [(self.ids[rows[i]], float(scores[i])) for i in best]
+
+
+class _WriterState:
+    """写入方缓存的分区状态：与 manifest 的 (generation, build) 一致时有效"""
+
+    __slots__ = ("version", "count", "rows_bytes", "ids", "centroids")
+
+    def __init__(self, version: Tuple[Any, Any], centroids: np.ndarray) -> None:
+        self.version = version
+        self.count = 0
+        self.rows_bytes = 0
+        self.ids: set = set()
+        self.centroids = centroids
+
+
+class AnnIndexStore:
+    """管理磁盘上的分区，并缓存已打开的分区"""
+
+    def __init__(self, root: str, *, min_train_rows: int = 5000, max_open: int = 256) -> None:
+        self._root = Path(root)
+        self._min_train_rows = max(1, min_train_rows)
+        self._max_open = max(1, max_open)
+        self._open: "OrderedDict[str, AnnPartition]" = OrderedDict()
+        self._writers: "OrderedDict[str, _WriterState]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def partition_dir(self, user_id: str) -> Path:
+        digest = hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:32]
+        return self._root / digest
+
+    def open(self, user_id: str) -> Optional[AnnPartition]:
+        """打开分区；manifest 与缓存的版本不一致（其他进程写入过）时重新打开"""
+        directory = self.partition_dir(user_id)
+        try:
+            manifest = self._read_manifest(directory)
+        except FileNotFoundError:
+            with self._lock:
+                self._open.pop(user_id, None)
+            return None
+
+        with self._lock:
+            cached = self._open.get(user_id)
+            if cached is not None and cached.version == manifest_version(manifest):
+                self._open.move_to_end(user_id)
+                return cached
+
+        partition = AnnPartition(directory, manifest)
+        with self._lock:
+            self._open[user_id] = partition
+            self._open.move_to_end(user_id)
+            while len(self._open) > self._max_open:
+                self._open.popitem(last=False)
+        return partition
+
+    def build(self, user_id: str, ids: Sequence[Any], material_ids: Sequence[str], vectors: np.ndarray) -> None:
+        """用完整数据（重新）生成分区，训练新的聚类中心"""
+        directory = self.partition_dir(user_id)
+        directory.mkdir(parents=True, exist_ok=True)
+        with self._write_lock(directory):
+            self._write_generation(directory, ids, material_ids, vectors, synced_at=time.time())
+
+    def drop(self, user_id: str) -> None:
+        """删除整个分区（MongoDB 中已没有该用户的 chunk）"""
+        directory = self.partition_dir(user_id)
+        if not (directory / MANIFEST_NAME).exists():
+            return
+        with self._write_lock(directory):
+            if (directory / MANIFEST_NAME).exists():
+                self._drop_locked(user_id, directory, self._read_manifest(directory))
+
+    def add(self, user_id: str, ids: Sequence[Any], material_ids: Sequence[str], vectors: np.ndarray) -> int:
+        """追加新 chunk；分区尚不存在时跳过（首次检索时会从 MongoDB 完整构建）"""
+        directory = self.partition_dir(user_id)
+        if not (directory / MANIFEST_NAME).exists() or len(ids) == 0:
+            return 0
+
+        vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        with self._write_lock(directory):
+            manifest = self._read_manifest(directory)
+            state = self._writer_state(user_id, directory, manifest)
+            seen = set()
+            keep = []
+            for i, doc_id in enumerate(ids):
+                if doc_id not in state.ids and doc_id not in seen:
+                    seen.add(doc_id)
+                    keep.append(i)
+            if not keep:
+                return 0
+
+            new_ids = [ids[i] for i in keep]
+            new_materials = [str(material_ids[i]) for i in keep]
+            new_vectors = np.ascontiguousarray(vectors[keep])
+            count = state.count
+            total = count + len(keep)
+
+            if total >= 2 * max(int(manifest["trained_count"]), self._min_train_rows // 2):
+                # 条数翻倍才重新训练，整体读取分区的开销按追加行数摊销
+                partition = AnnPartition(directory, manifest)
+                all_vectors = np.concatenate([np.asarray(partition.vectors), new_vectors])
+                self._write_generation(
+                    directory,
+                    partition.ids + new_ids,
+                    list(partition.material_ids) + new_materials,
+                    all_vectors,
+                    synced_at=partition.synced_at,
+                )
+                return len(keep)
+
+            generation = manifest["generation"]
+            dim = int(manifest["dim"])
+            self._append_exact(directory / f"vectors.{generation}.f32", count * dim * 4, new_vectors.tobytes())
+            self._append_exact(directory / f"assign.{generation}.i32", count * 4,
+                               assign_to_lists(new_vectors, state.centroids).tobytes())
+            rows_bytes = self._append_rows(
+                directory / f"rows.{generation}.jsonl", state.rows_bytes, new_ids, new_materials
+            )
+
+            manifest["count"] = total
+            self._write_manifest(directory, manifest)
+            state.ids.update(new_ids)
+            state.count = total
+            state.rows_bytes = rows_bytes
+            return len(keep)
+
+    def _writer_state(self, user_id: str, directory: Path, manifest: Dict[str, Any]) -> _WriterState:
+        """取（或重建）写入方状态，并补读其他进程追加的行；调用方持有分区写锁"""
+        version = (manifest["generation"], manifest.get("build"))
+        count = int(manifest["count"])
+        with self._lock:
+            state = self._writers.get(user_id)
+        if state is None or state.version != version or state.count > count:
+            centroids = np.fromfile(directory / f"centroids.{version[0]}.f32", dtype=np.float32).reshape(
+                int(manifest["nlist"]), int(manifest["dim"])
+            )
+            state = _WriterState(version, centroids)
+        if state.count < count:
+            with open(directory / f"rows.{version[0]}.jsonl", "rb") as rows_file:
+                rows_file.seek(state.rows_bytes)
+                for _ in range(count - state.count):
+                    state.ids.add(json.loads(rows_file.readline())[0])
+                state.rows_bytes = rows_file.tell()
+            state.count = count
+        with self._lock:
+            self._writers[user_id] = state
+            self._writers.move_to_end(user_id)
+            while len(self._writers) > self._max_open:
+                self._writers.popitem(last=False)
+        return state
+
+    def remove(self, user_id: str, ids: Sequence[Any]) -> int:
+        """删除 chunk：用剩余行重写一代分区（删空时移除分区，下次检索从 MongoDB 构建）"""
+        directory = self.partition_dir(user_id)
+        if not (directory / MANIFEST_NAME).exists() or len(ids) == 0:
+            return 0
+
+        removed_ids = set(ids)
+        with self._write_lock(directory):
+            manifest = self._read_manifest(directory)
+            partition = AnnPartition(directory, manifest)
+            keep = [row for row, doc_id in enumerate(partition.ids) if doc_id not in removed_ids]
+            removed = partition.count - len(keep)
+            if removed == 0:
+                return 0
+            if not keep:
+                self._drop_locked(user_id, directory, manifest)
+                return removed
+            self._write_generation(
+                directory,
+                [partition.ids[row] for row in keep],
+                [partition.material_ids[row] for row in keep],
+                np.asarray(partition.vectors[keep]),
+                synced_at=partition.synced_at,
+            )
+            return removed
+
+    def _drop_locked(self, user_id: str, directory: Path, manifest: Dict[str, Any]) -> None:
+        with self._lock:
+            self._writers.pop(user_id, None)
+            self._open.pop(user_id, None)
+        (directory / MANIFEST_NAME).unlink()
+        for name in ("vectors", "centroids", "assign", "rows"):
+            for stale in directory.glob(f"{name}.{manifest['generation']}.*"):
+                stale.unlink()
+
+    def _write_generation(
+        self,
+        directory: Path,
+        ids: Sequence[Any],
+        material_ids: Sequence[str],
+        vectors: np.ndarray,
+        *,
+        synced_at: float,
+    ) -> None:
+        vectors = np.ascontiguousarray(normalize_rows(np.asarray(vectors, dtype=np.float32)))
+        previous = self._read_manifest(directory) if (directory / MANIFEST_NAME).exists() else None
+        generation = (previous["generation"] + 1) if previous else 1
+
+        nlist = list_count_for(vectors.shape[0], self._min_train_rows)
+        if nlist == 1:
+            centroids = np.zeros((1, vectors.shape[1]), dtype=np.float32)
+        else:
+            centroids = train_centroids(vectors, nlist)
+            nlist = centroids.shape[0]
+        assign = assign_to_lists(vectors, centroids) if nlist > 1 else np.zeros(vectors.shape[0], dtype=np.int32)
+
+        vectors.tofile(directory / f"vectors.{generation}.f32")
+        centroids.tofile(directory / f"centroids.{generation}.f32")
+        assign.tofile(directory / f"assign.{generation}.i32")
+        self._append_rows(directory / f"rows.{generation}.jsonl", 0, list(ids), [str(m) for m in material_ids])
+
+        self._write_manifest(directory, {
+            "generation": generation,
+            # 分区删空后重建时代号会从 1 重新开始，写入方靠构建标识识别新分区
+            "build": uuid.uuid4().hex,
+            "dim": int(vectors.shape[1]),
+            "count": int(vectors.shape[0]),
+            "nlist": int(nlist),
+            "trained_count": int(vectors.shape[0]),
+            "synced_at": synced_at,
+        })
+
+        if previous:
+            for name in ("vectors", "centroids", "assign", "rows"):
+                for stale in directory.glob(f"{name}.{previous['generation']}.*"):
+                    try:
+                        stale.unlink()
+                    except OSError:
+                        pass
+
+    @staticmethod
+    def _append_exact(path: Path, expected_size: int, payload: bytes) -> None:
+        """截掉上次中断写入留下的尾部字节后再追加"""
+        with open(path, "r+b") as handle:
+            handle.truncate(expected_size)
+            handle.seek(expected_size)
+            handle.write(payload)
+
+    @staticmethod
+    def _append_rows(path: Path, offset: int, ids: Sequence[Any], material_ids: Sequence[str]) -> int:
+        """从字节偏移 offset 处写入（截掉中断写入留下的尾部），返回写入后的文件长度"""
+        payload = "".join(
+            json.dumps([doc_id, material_id]) + "\n" for doc_id, material_id in zip(ids, material_ids)
+        ).encode("utf-8")
+        mode = "r+b" if path.exists() else "wb"
+        with open(path, mode) as handle:
+            handle.truncate(offset)
+            handle.seek(offset)
+            handle.write(payload)
+        return offset + len(payload)
+
+    @staticmethod
+    def _read_manifest(directory: Path) -> Dict[str, Any]:
+        with open(directory / MANIFEST_NAME, "r", encoding="utf-8") as handle:
+            return json.load(handle)
+
+    @staticmethod
+    def _write_manifest(directory: Path, manifest: Dict[str, Any]) -> None:
+        tmp_path = directory / f"{MANIFEST_NAME}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as handle:
+            json.dump(manifest, handle)
+        os.replace(tmp_path, directory / MANIFEST_NAME)
+
+    @contextmanager
+    def _write_lock(self, directory: Path) -> Iterator[None]:
+        """跨进程写锁（多个 uvicorn worker 可能同时写同一分区）"""
+        with open(directory / ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class AnnVectorBackend:
+    """RAG_VECTOR_BACKEND=ann：在用户分区上做 IVF 检索，分区缺失或超过 ttl_seconds 时从 MongoDB 构建
+
+    ttl_seconds=0 表示不过期（所有写入方共用同一个分区目录时）。
+    """
+
+    def __init__(
+        self,
+        collection: Any,
+        store: AnnIndexStore,
+        *,
+        nprobe: int = 32,
+        ttl_seconds: float = 3600.0,
+        embedding_key: str = "embedding",
+        text_key: str = "text",
+        vector_transform: Optional[Callable[[List[float]], np.ndarray]] = None,
+        scopes: Optional[PrivateScopes] = None,
+    ) -> None:
+        self._collection = collection
+        self._scopes = scopes or PrivateScopes()
+        self._store = store
+        self._nprobe = max(1, nprobe)
+        self._ttl_seconds = ttl_seconds
+        # 库里存的是截断 / 量化向量时，新 chunk 需转换成同样的表示再追加
+        self._vector_transform = vector_transform
+        self._embedding_key = embedding_key
+        self._text_key = text_key
+        self._build_locks: Dict[str, asyncio.Lock] = {}
+
+    @property
+    def store(self) -> AnnIndexStore:
+        return self._store
+
+    async def search(
+        self,
+        query_bundle: QueryBundle,
+        *,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+    ) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            raise ValueError("AnnVectorBackend requires a precomputed query embedding")
+
+        partition = await asyncio.to_thread(self._store.open, user_id)
+        if partition is None or self._stale(partition):
+            partition = await self._bootstrap(user_id)
+            if partition is None:
+                return []
+
+        query = np.asarray(query_bundle.embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm:
+            query = query / query_norm
+
+        # memmap 读取可能触发缺页 IO，放到线程中执行
+        ranked = await asyncio.to_thread(
+            partition.search,
+            query,
+            material_ids=await self._scopes.row_keys(user_id, material_ids),
+            top_k=top_k,
+            nprobe=self._nprobe,
+        )
+        return await hydrate_nodes(self._collection, ranked, text_key=self._text_key)
+
+    def add_nodes(self, user_id: str, nodes: Sequence[Any]) -> int:
+        """摄取线程回调：把刚写入的 chunk 追加到用户分区"""
+        if not nodes:
+            return 0
+        ids = [node.node_id for node in nodes]
+        material_ids = [row_key(node.metadata) for node in nodes]
+        if self._vector_transform is not None:
+            vectors = np.stack([self._vector_transform(node.embedding) for node in nodes]).astype(np.float32)
+        else:
+            vectors = np.asarray([node.embedding for node in nodes], dtype=np.float32)
+        return self._store.add(user_id, ids, material_ids, vectors)
+
+    def _stale(self, partition: AnnPartition) -> bool:
+        return self._ttl_seconds > 0 and time.time() - partition.synced_at > self._ttl_seconds
+
+    async def _bootstrap(self, user_id: str) -> Optional[AnnPartition]:
+        lock = self._build_locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            # 同目录下的其他 worker 可能刚重建过
+            partition = await asyncio.to_thread(self._store.open, user_id)
+            if partition is None or self._stale(partition):
+                ids, material_ids, vectors = await load_user_vectors(
+                    self._collection,
+                    user_id,
+                    embedding_key=self._embedding_key,
+                    query=await self._scopes.user_filter(user_id),
+                )
+                if ids:
+                    await asyncio.to_thread(self._store.build, user_id, ids, material_ids, vectors)
+                    partition = await asyncio.to_thread(self._store.open, user_id)
+                elif partition is not None:
+                    await asyncio.to_thread(self._store.drop, user_id)
+                    partition = None
+            self._build_locks.pop(user_id, None)
+        return partition
@@ -0,0 +1,108 @@
+"""材料级 chunk 维护：增量重新处理、删除材料、清理重复与孤立 chunk
+
+全部是同步 pymongo 批量操作（delete_many / bulk_write），由摄取线程或
+asyncio.to_thread 调用。
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+
+from pymongo import UpdateOne
+
+from ingestion import CHUNK_ORDINAL_KEY, CONTENT_HASH_KEY, DOCUMENT_ID_KEY, PAGE_NUMBER_KEY
+
+BULK_BATCH_SIZE = 1000
+
+
+def material_filter(user_id: str, material_id: Optional[str] = None) -> Dict[str, Any]:
+    query: Dict[str, Any] = {"metadata.user_id": user_id}
+    if material_id is not None:
+        query["metadata.material_id"] = material_id
+    return query
+
+
+def document_filter(document_id: str) -> Dict[str, Any]:
+    """跨用户共享存储的文档 chunk（见 document_store.py）"""
+    return {f"metadata.{DOCUMENT_ID_KEY}": document_id}
+
+
+def load_chunk_ordinals(collection: Any, query: Dict[str, Any]) -> Dict[str, Optional[int]]:
+    """材料（或共享文档）已有 chunk 的 _id → 序号（旧数据没有序号时为 None）"""
+    cursor = collection.find(query, {f"metadata.{CHUNK_ORDINAL_KEY}": 1})
+    return {
+        str(doc["_id"]): (doc.get("metadata") or {}).get(CHUNK_ORDINAL_KEY)
+        for doc in cursor
+    }
+
+
+def load_document_chunks(collection: Any, document_id: str, *, embedding_key: str = "embedding") -> List[Dict[str, Any]]:
+    """共享文档的全部 chunk（文本、元数据和库中存储的向量），用于更新新引用用户的进程内索引"""
+    return list(collection.find(
+        document_filter(document_id),
+        {"text": 1, "metadata": 1, embedding_key: 1},
+    ))
+
+
+def renumber_chunks(collection: Any, ordinals: Mapping[str, int], *, batch_size: int = BULK_BATCH_SIZE) -> int:
+    """内容未变但位置变化的 chunk 只更新序号，不重新向量化"""
+    operations = [
+        UpdateOne({"_id": doc_id}, {"$set": {f"metadata.{CHUNK_ORDINAL_KEY}": ordinal}})
+        for doc_id, ordinal in ordinals.items()
+    ]
+    modified = 0
+    for start in range(0, len(operations), batch_size):
+        modified += collection.bulk_write(operations[start:start + batch_size], ordered=False).modified_count
+    return modified
+
+
+def delete_chunks(collection: Any, ids: Sequence[Any], *, batch_size: int = BULK_BATCH_SIZE) -> int:
+    deleted = 0
+    for start in range(0, len(ids), batch_size):
+        deleted += collection.delete_many({"_id": {"$in": list(ids[start:start + batch_size])}}).deleted_count
+    return deleted
+
+
+def find_orphan_chunks(collection: Any, user_id: str, keep_material_ids: Sequence[str]) -> Dict[str, List[Any]]:
+    """用户名下不属于 keep_material_ids 的 chunk（材料已删除但向量还在）"""
+    cursor = collection.find(
+        {"metadata.user_id": user_id, "metadata.material_id": {"$nin": list(keep_material_ids)}},
+        {"metadata.material_id": 1},
+    )
+    orphans: Dict[str, List[Any]] = defaultdict(list)
+    for doc in cursor:
+        orphans[str((doc.get("metadata") or {}).get("material_id", ""))].append(doc["_id"])
+    return dict(orphans)
+
+
+def find_duplicate_chunks(
+    collection: Any,
+    user_id: str,
+    material_ids: Optional[Sequence[str]] = None,
+) -> Dict[str, List[Any]]:
+    """同一材料内内容相同的多余副本（重复处理材料时追加的旧 chunk）
+
+    有内容哈希的按哈希比较，旧数据按文本 + 页码比较；每组保留一个（优先保留带哈希的）。
+    """
+    match: Dict[str, Any] = {"metadata.user_id": user_id}
+    if material_ids:
+        match["metadata.material_id"] = {"$in": list(material_ids)}
+    pipeline = [
+        {"$match": match},
+        {"$sort": {f"metadata.{CONTENT_HASH_KEY}": -1, "_id": 1}},
+        {"$group": {
+            "_id": {
+                "material_id": "$metadata.material_id",
+                "content": {"$ifNull": [f"$metadata.{CONTENT_HASH_KEY}", "$text"]},
+                "page": {"$ifNull": [f"$metadata.{PAGE_NUMBER_KEY}", "$metadata.page_label"]},
+            },
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1},
+        }},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$project": {"ids": {"$slice": ["$ids", 1, {"$subtract": ["$count", 1]}]}}},
+    ]
+    duplicates: Dict[str, List[Any]] = defaultdict(list)
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        duplicates[str(group["_id"].get("material_id", ""))].extend(group["ids"])
+    return dict(duplicates)
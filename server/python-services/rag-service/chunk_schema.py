@@ -0,0 +1,134 @@
+"""rag_vectors 的紧凑 chunk 文档结构
+
+MongoDBAtlasVectorSearch 默认把整个节点序列化进 `metadata._node_content`（旧版本
+连同文本一起），再附上 `_node_type` / `doc_id` / `document_id` / `ref_doc_id` 等
+关系字段，每个 chunk 多出 1KB 以上。紧凑结构只保留检索和展示需要的字段：
+
+    {
+        "_id": "<node id>",
+        "embedding": [...] 或 BSON vector,
+        "text": "<chunk 文本，只存一份>",
+        "metadata": {
+            "user_id": str, "material_id": str, "filename": str,
+            # 或者跨用户共享存储时只有 "file_hash": str（见 document_store.py）
+            "page": int,        # 从 1 开始的物理页序号
+            "chunk": int,       # 材料内的 chunk 序号
+            "hash": str,        # 内容哈希，重新处理材料时据此只写入变化的 chunk
+            "page_label": str,  # 仅当 PDF 自定义页码（如 "iv"）与 page 不同时保存
+        },
+    }
+
+读取侧全部按 `text` + `metadata` 构造节点，LlamaIndex 检索器对没有 `_node_content`
+的文档走其兼容分支，两种结构可以在同一集合中共存。
+"""
+from __future__ import annotations
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.vector_stores.mongodb import MongoDBAtlasVectorSearch
+from pydantic import PrivateAttr
+from pymongo import ReplaceOne
+
+from ingestion import CHUNK_ORDINAL_KEY, CONTENT_HASH_KEY, DOCUMENT_ID_KEY, PAGE_NUMBER_KEY
+from vector_codec import VectorCodec
+
+CHUNK_SCHEMAS = ("compact", "llamaindex")
+
+COMPACT_STRING_FIELDS = ("user_id", "material_id", "filename", DOCUMENT_ID_KEY, CONTENT_HASH_KEY)
+PAGE_LABEL_KEY = "page_label"
+
+
+def _as_int(value: Any) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    return None
+
+
+def compact_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """只保留业务字段并统一类型；没有物理页序号的旧数据用数字页码标签代替"""
+    compact: Dict[str, Any] = {
+        key: str(metadata[key])
+        for key in COMPACT_STRING_FIELDS
+        if metadata.get(key) is not None
+    }
+    page_label = metadata.get(PAGE_LABEL_KEY)
+    page = _as_int(metadata.get(PAGE_NUMBER_KEY))
+    if page is None:
+        page = _as_int(page_label)
+    if page is not None:
+        compact[PAGE_NUMBER_KEY] = page
+    if page_label is not None and str(page_label) != str(page):
+        compact[PAGE_LABEL_KEY] = str(page_label)
+    ordinal = _as_int(metadata.get(CHUNK_ORDINAL_KEY))
+    if ordinal is not None:
+        compact[CHUNK_ORDINAL_KEY] = ordinal
+    return compact
+
+
+def expand_page_label(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """紧凑结构省略了与页序号相同的 page_label，对外返回时补回"""
+    if PAGE_LABEL_KEY not in metadata and metadata.get(PAGE_NUMBER_KEY) is not None:
+        return {**metadata, PAGE_LABEL_KEY: str(metadata[PAGE_NUMBER_KEY])}
+    return metadata
+
+
+class CompactMongoVectorStore(MongoDBAtlasVectorSearch):
+    """按紧凑结构写入 chunk，并按 VectorCodec 改写向量字段
+
+    compact_schema=False 时文档结构与 MongoDBAtlasVectorSearch 一致。写入按 _id
+    批量 upsert：chunk _id 由内容哈希决定，重试或并发处理同一材料不会产生重复文档。
+    """
+
+    _codec: Optional[VectorCodec] = PrivateAttr()
+    _compact_schema: bool = PrivateAttr()
+    _full_embedding_key: str = PrivateAttr()
+
+    def __init__(
+        self,
+        *args: Any,
+        codec: Optional[VectorCodec] = None,
+        compact_schema: bool = True,
+        full_embedding_key: str = "embedding_full",
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self._codec = codec if codec is not None and codec.enabled else None
+        self._compact_schema = compact_schema
+        self._full_embedding_key = full_embedding_key
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        ids, entries = self._create_data_to_insert(nodes)
+        if entries:
+            self._collection.bulk_write(
+                [ReplaceOne({self._id_key: entry[self._id_key]}, entry, upsert=True) for entry in entries],
+                ordered=False,
+            )
+        return ids
+
+    def _create_data_to_insert(self, nodes: List[BaseNode]) -> Tuple[List[str], List[dict]]:
+        if self._compact_schema:
+            ids = [node.node_id for node in nodes]
+            entries = [
+                {
+                    self._id_key: node.node_id,
+                    self._embedding_key: node.get_embedding(),
+                    self._text_key: node.get_content(metadata_mode=MetadataMode.NONE) or "",
+                    self._metadata_key: compact_metadata(node.metadata),
+                }
+                for node in nodes
+            ]
+        else:
+            ids, entries = super()._create_data_to_insert(nodes)
+
+        if self._codec is not None:
+            for entry in entries:
+                embedding = entry[self._embedding_key]
+                entry[self._embedding_key] = self._codec.encode(embedding)
+                if self._codec.keep_full:
+                    entry[self._full_embedding_key] = self._codec.encode_full(embedding)
+        return ids, entries
@@ -0,0 +1,199 @@
+"""摄取路径上的快速切分器
+
+FastSentenceSplitter 与 `SentenceSplitter(chunk_size=1024, chunk_overlap=200)` 的切分规则
+（段落 → 句子 → 子句 → 空格 → 字符，按句合并并带 token 重叠）和输出逐 chunk 一致，
+只替换其中的热点：
+
+- 句子边界：单遍扫描候选句末标点，复刻 punkt `span_tokenize` 的切片与标点回补规则；
+  普通词后的句末标点直接判定，缩写 / 首字母 / 数字 / 搭配词等少数情况交给 punkt 本身判定
+- token 计数：每个切分片段只 tokenize 一次（超长片段递归细分时沿用已知长度，不重复计算）
+- 合并与重叠：chunk 始终是切分片段的连续区间，长度由前缀和得到，重叠窗口按下标回退，
+  不再逐段插入 / 弹出列表
+"""
+from __future__ import annotations
+
+import re
+from itertools import accumulate
+from typing import Any, Callable, List, Optional, Tuple
+
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.utils import globals_helper
+
+CHUNKERS = ("fast", "llamaindex")
+
+# punkt 的 `_get_last_whitespace_index` 只认 ASCII 空白
+_LAST_ASCII_WHITESPACE = re.compile(r"[\s\S]*[ \t\n\r\x0b\x0c]")
+_LETTERS = re.compile(r"[^\W\d_]+")
+
+# (文本, 是否完整句子, token 数)
+Split = Tuple[str, bool, int]
+
+
+class SentenceBoundaryScanner:
+    """与 punkt 英文模型切出相同句子的单遍扫描器（可作为 SentenceSplitter 的 chunking_tokenizer_fn）"""
+
+    def __init__(self, punkt: Any = None) -> None:
+        self._punkt = punkt if punkt is not None else globals_helper.punkt_tokenizer
+        lang_vars = self._punkt._lang_vars
+        params = self._punkt._params
+        self._period_context = lang_vars.period_context_re()
+        self._realignment = lang_vars.re_boundary_realignment
+        self._abbrev_types = params.abbrev_types
+        self._collocation_heads = {first for first, _ in params.collocations}
+
+    def __call__(self, text: str) -> List[str]:
+        starts = [start for start, _ in self.spans(text)]
+        return [
+            text[start:starts[index + 1] if index + 1 < len(starts) else len(text)]
+            for index, start in enumerate(starts)
+        ]
+
+    def spans(self, text: str) -> List[Tuple[int, int]]:
+        return self._realign(text, self._slices(text))
+
+    def _slices(self, text: str) -> List[Tuple[int, int]]:
+        slices: List[Tuple[int, int]] = []
+        last_break = 0
+        previous: Optional[Tuple[Any, int, int]] = None  # (match, 前一个词的起止)
+        for match in self._period_context.finditer(text):
+            word_start = previous[1] if previous else 0
+            lower = previous[2] if previous else 0
+            whitespace = _LAST_ASCII_WHITESPACE.match(text, lower, match.start())
+            if whitespace is not None and whitespace.end() - 1 > lower:
+                word_start = whitespace.end()
+            # 与上一个候选的词重叠时（如 "acting!!!"）只保留后一个
+            if previous is not None and previous[2] <= word_start:
+                last_break = self._decide(text, previous, slices, last_break)
+            previous = (match, word_start, match.start())
+        if previous is not None:
+            last_break = self._decide(text, previous, slices, last_break)
+        slices.append((last_break, len(text.rstrip())))
+        return slices
+
+    def _decide(
+        self,
+        text: str,
+        candidate: Tuple[Any, int, int],
+        slices: List[Tuple[int, int]],
+        last_break: int,
+    ) -> int:
+        match, word_start, word_stop = candidate
+        if not self._is_break(text[word_start:word_stop], match):
+            return last_break
+        slices.append((last_break, match.end()))
+        return match.start("next_tok") if match.group("next_tok") else match.end()
+
+    def _is_break(self, word: str, match: Any) -> bool:
+        next_token = match.group("next_tok")
+        end = match.group()
+        if next_token and _LETTERS.fullmatch(word):
+            if end != ".":
+                return True
+            # 两个以上字母的普通词 + 句点：不是缩写、首字母或数字，也不是已知搭配的前半部分
+            lowered = word.lower()
+            if len(word) > 1 and lowered not in self._abbrev_types and lowered not in self._collocation_heads:
+                return True
+        return self._punkt.text_contains_sentbreak(word + end + match.group("after_tok"))
+
+    def _realign(self, text: str, slices: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        spans: List[Tuple[int, int]] = []
+        realign = 0
+        for index, (start, stop) in enumerate(slices):
+            start += realign
+            if index + 1 == len(slices):
+                if start < stop:
+                    spans.append((start, stop))
+                continue
+            next_start, next_stop = slices[index + 1]
+            closing = self._realignment.match(text[next_start:next_stop])
+            if closing:
+                spans.append((start, next_start + len(closing.group(0).rstrip())))
+                realign = closing.end()
+            else:
+                realign = 0
+                if start < stop:
+                    spans.append((start, stop))
+        return spans
+
+
+class FastSentenceSplitter(SentenceSplitter):
+    """SentenceSplitter 的快速实现：相同参数下输出相同的 chunk（含 metadata 感知的有效长度）"""
+
+    def __init__(self, **kwargs: Any) -> None:
+        kwargs.setdefault("chunking_tokenizer_fn", SentenceBoundaryScanner())
+        super().__init__(**kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FastSentenceSplitter"
+
+    def _split_text(self, text: str, chunk_size: int) -> List[str]:
+        if text == "":
+            return [text]
+
+        with self.callback_manager.event(
+            CBEventType.CHUNKING, payload={EventPayload.CHUNKS: [text]}
+        ) as event:
+            tokenizer = self._tokenizer
+            splits = self._split_sized(text, len(tokenizer(text)), chunk_size, tokenizer)
+            chunks = self._merge_splits(splits, chunk_size)
+            event.on_end(payload={EventPayload.CHUNKS: chunks})
+
+        return chunks
+
+    def _split_sized(self, text: str, token_size: int, chunk_size: int, tokenizer: Callable) -> List[Split]:
+        """与 SentenceSplitter._split 相同的递归切分，已知长度的片段不再重新 tokenize"""
+        if token_size <= chunk_size:
+            return [(text, True, token_size)]
+
+        pieces, is_sentence = self._get_splits_by_fns(text)
+        splits: List[Split] = []
+        for piece in pieces:
+            size = len(tokenizer(piece))
+            if size <= chunk_size or len(pieces) == 1:
+                # 无法再细分的超长片段原样保留，合并时报 "Single token exceeded chunk size"
+                splits.append((piece, is_sentence, size))
+            else:
+                splits.extend(self._split_sized(piece, size, chunk_size, tokenizer))
+        return splits
+
+    def _merge_splits(self, splits: List[Split], chunk_size: int) -> List[str]:
+        """SentenceSplitter._merge 的下标版本：当前 chunk 为 splits[low:index]"""
+        texts = [text for text, _, _ in splits]
+        prefix = [0, *accumulate(size for _, _, size in splits)]
+        chunks: List[str] = []
+        low = index = 0
+        new_chunk = True
+
+        while index < len(splits):
+            size = splits[index][2]
+            if size > chunk_size:
+                raise ValueError("Single token exceeded chunk size")
+            if prefix[index] - prefix[low] + size > chunk_size and not new_chunk:
+                chunks.append("".join(texts[low:index]))
+                # 从上一个 chunk 末尾向前取不超过 chunk_overlap 的片段作为重叠
+                overlap_low = index
+                while overlap_low > low and prefix[index] - prefix[overlap_low - 1] <= self.chunk_overlap:
+                    overlap_low -= 1
+                low = overlap_low
+                new_chunk = True
+                continue
+            if new_chunk:
+                # 重叠加上当前片段超长时，从前面丢弃重叠片段
+                while low < index and prefix[index] - prefix[low] + size > chunk_size:
+                    low += 1
+            index += 1
+            new_chunk = False
+
+        if not new_chunk:
+            chunks.append("".join(texts[low:index]))
+        return self._postprocess_chunks(chunks)
+
+
+def create_node_parser(chunker: str, *, chunk_size: int = 1024, chunk_overlap: int = 200) -> SentenceSplitter:
+    if chunker == "fast":
+        return FastSentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    if chunker == "llamaindex":
+        return SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    raise ValueError(f"Unknown RAG_CHUNKER: {chunker}")
@@ -0,0 +1,313 @@
+"""跨用户共享的内容寻址文档存储
+
+同一份 PDF（按整个文件的 sha256 + 向量版本识别）只解析、切分、向量化并存储一次：
+
+    rag_documents       {_id: <文件 sha256>:<向量版本哈希>, status: processing | ready, lease_until, 统计信息}
+    rag_material_refs   {_id: "<user_id>/<material_id>", user_id, material_id, document_id, filename}
+    rag_vectors         共享 chunk 的 metadata 只有 file_hash（= document_id）/ page / chunk / hash，
+                        不带 user_id / material_id；_id 由 file_hash + 内容哈希决定
+
+向量版本（embedding 模型与存储格式）是文档键的一部分：更换模型后重新处理材料会写入一份
+新文档，材料引用改指新文档，旧文档在最后一个引用移走后删除。
+
+检索时先把 (user_id, material_ids) 经引用表解析成 document_id 集合，过滤条件同时
+匹配按用户存储的 chunk（metadata.user_id / material_id）和共享 chunk
+（metadata.file_hash）；返回前再按引用把 material_id / filename 填回节点。回答缓存
+同样按文档建键，引用同一文件的用户共享命中，缓存的 source 返回前按读者自己的引用重新填写。
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from llama_index.core import QueryBundle
+from llama_index.core.schema import NodeWithScore
+from pymongo.errors import DuplicateKeyError
+
+from ingestion import DOCUMENT_ID_KEY
+from instrumentation import metrics
+from query_cache import LocalCacheGenerations, TTLCache, document_scope, material_scope, refs_scope, user_scope
+from vector_backends import PrivateScopes
+
+DOCUMENT_STORAGE_MODES = ("shared", "private")
+
+DOCUMENT_PROCESSING = "processing"
+DOCUMENT_READY = "ready"
+
+FILE_DIGEST_BLOCK_BYTES = 1024 * 1024
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(FILE_DIGEST_BLOCK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def document_key(file_sha256: str, embedding_version: str) -> str:
+    version = hashlib.sha256(embedding_version.encode("utf-8")).hexdigest()[:16]
+    return f"{file_sha256}:{version}"
+
+
+def ref_id(user_id: str, material_id: str) -> str:
+    return f"{user_id}/{material_id}"
+
+
+class DocumentRegistry:
+    """文档与引用表的同步读写（摄取线程中使用）"""
+
+    def __init__(self, documents: Any, refs: Any, *, lease_seconds: float = 600.0) -> None:
+        self._documents = documents
+        self._refs = refs
+        self._lease_seconds = lease_seconds
+        self._indexes_ready = False
+
+    def get_ref(self, user_id: str, material_id: str) -> Optional[Dict[str, Any]]:
+        self._ensure_indexes()
+        return self._refs.find_one({"_id": ref_id(user_id, material_id)})
+
+    def put_ref(self, user_id: str, material_id: str, document_id: str, filename: str) -> None:
+        self._ensure_indexes()
+        self._refs.replace_one(
+            {"_id": ref_id(user_id, material_id)},
+            {
+                "user_id": user_id,
+                "material_id": material_id,
+                "document_id": document_id,
+                "filename": filename,
+                "updated_at": datetime.now(timezone.utc),
+            },
+            upsert=True,
+        )
+
+    def remove_ref(self, user_id: str, material_id: str) -> Optional[Dict[str, Any]]:
+        self._ensure_indexes()
+        return self._refs.find_one_and_delete({"_id": ref_id(user_id, material_id)})
+
+    def user_refs(self, user_id: str) -> List[Dict[str, Any]]:
+        self._ensure_indexes()
+        return list(self._refs.find({"user_id": user_id}))
+
+    def user_references(self, user_id: str, document_id: str) -> bool:
+        return self._refs.count_documents({"user_id": user_id, "document_id": document_id}, limit=1) > 0
+
+    def claim(self, document_id: str) -> Optional[str]:
+        """返回 ready（已可直接引用）、claimed（由当前调用方处理）或 None（其他 worker 正在处理）"""
+        self._ensure_indexes()
+        now = time.time()
+        try:
+            self._documents.insert_one({
+                "_id": document_id,
+                "status": DOCUMENT_PROCESSING,
+                "lease_until": now + self._lease_seconds,
+                "created_at": datetime.now(timezone.utc),
+            })
+            return "claimed"
+        except DuplicateKeyError:
+            pass
+
+        document = self._documents.find_one({"_id": document_id})
+        if document is None:
+            return self.claim(document_id)
+        if document.get("status") == DOCUMENT_READY:
+            return DOCUMENT_READY
+        if document.get("lease_until", 0) > now:
+            return None
+        # 处理者的租约已过期（进程崩溃），接手重新处理；chunk 按 _id upsert，重复写入无副作用
+        taken = self._documents.update_one(
+            {"_id": document_id, "status": DOCUMENT_PROCESSING, "lease_until": document.get("lease_until")},
+            {"$set": {"lease_until": now + self._lease_seconds}},
+        )
+        return "claimed" if taken.modified_count else None
+
+    def renew(self, document_id: str) -> bool:
+        """处理者延长租约（每写入一批 chunk 调用一次），大文件处理超过 lease_seconds 时不会被其他 worker 接手"""
+        renewed = self._documents.update_one(
+            {"_id": document_id, "status": DOCUMENT_PROCESSING},
+            {"$set": {"lease_until": time.time() + self._lease_seconds}},
+        )
+        return renewed.matched_count > 0
+
+    def wait_ready(self, document_id: str, *, poll_seconds: float = 1.0) -> str:
+        """等待其他 worker 处理同一文件；对方失败或租约过期时由当前调用方接手"""
+        while True:
+            status = self.claim(document_id)
+            if status is not None:
+                return status
+            time.sleep(poll_seconds)
+
+    def mark_ready(self, document_id: str, *, page_count: int, chunk_count: int, char_count: int) -> None:
+        self._documents.update_one(
+            {"_id": document_id},
+            {
+                "$set": {
+                    "status": DOCUMENT_READY,
+                    "page_count": page_count,
+                    "chunk_count": chunk_count,
+                    "char_count": char_count,
+                    "ready_at": datetime.now(timezone.utc),
+                },
+                "$unset": {"lease_until": ""},
+            },
+        )
+
+    def release(self, document_id: str) -> None:
+        """处理失败：删除未完成的文档记录，等待中的 worker 会接手"""
+        self._documents.delete_one({"_id": document_id, "status": DOCUMENT_PROCESSING})
+
+    def get_document(self, document_id: str) -> Optional[Dict[str, Any]]:
+        return self._documents.find_one({"_id": document_id})
+
+    def delete_if_unreferenced(self, document_id: str) -> bool:
+        """没有任何引用时删除文档记录，返回调用方是否应删除其 chunk
+
+        先删记录再复查引用：并发上传同一文件的 worker 先写引用、后检查文档，
+        看到记录已删除时会重新处理，因此这里复查到新引用就保留 chunk。
+        """
+        if self._refs.count_documents({"document_id": document_id}, limit=1):
+            return False
+        self._documents.delete_one({"_id": document_id})
+        return self._refs.count_documents({"document_id": document_id}, limit=1) == 0
+
+    def _ensure_indexes(self) -> None:
+        if self._indexes_ready:
+            return
+        self._refs.create_index("user_id")
+        self._refs.create_index("document_id")
+        self._indexes_ready = True
+
+
+class MaterialScopes(PrivateScopes):
+    """RAG_DOCUMENT_STORAGE=shared：检索范围经 rag_material_refs 解析成 document_id
+
+    每个用户的引用缓存在进程内，并记下读取时该用户引用表的写入代号（与回答缓存共用
+    MongoCacheGenerations）。任一 worker 修改引用后递增代号，其他 worker 下次检索读到新代号即
+    重新读取引用，不会在 TTL 内继续检索已删除材料的共享 chunk。
+    """
+
+    def __init__(
+        self,
+        refs: Any,
+        *,
+        ttl_seconds: float = 30.0,
+        max_users: int = 4096,
+        generations: Optional[Any] = None,
+    ) -> None:
+        self._refs = refs
+        self._generations = generations or LocalCacheGenerations()
+        self._cache: TTLCache[Tuple[int, List[Dict[str, Any]]]] = TTLCache(
+            max_entries=max_users, ttl_seconds=ttl_seconds
+        )
+
+    async def user_refs(self, user_id: str) -> List[Dict[str, Any]]:
+        try:
+            generation: Optional[int] = (await self._generations.current([refs_scope(user_id)]))[0]
+        except Exception as err:
+            # 代号读不到时无法判断缓存是否过期，直接读引用表
+            metrics.log("rag.material_refs.generation_lookup_failed", level=logging.WARNING, error=str(err))
+            generation = None
+        cached = self._cache.get(user_id)
+        if cached is not None and generation is not None and cached[0] == generation:
+            return cached[1]
+        refs = await self._refs.find(
+            {"user_id": user_id},
+            {"material_id": 1, "document_id": 1, "filename": 1},
+        ).to_list(length=None)
+        if generation is not None:
+            self._cache.set(user_id, (generation, refs))
+        return refs
+
+    def invalidate(self, user_id: str) -> None:
+        """修改引用后调用（摄取线程）：本进程立即失效，其他 worker 经代号失效"""
+        self._cache.pop(user_id)
+        self._generations.bump([refs_scope(user_id)])
+
+    async def _documents(self, user_id: str, material_ids: Optional[Sequence[str]]) -> List[str]:
+        refs = await self.user_refs(user_id)
+        wanted = set(material_ids) if material_ids else None
+        return list(dict.fromkeys(
+            ref["document_id"] for ref in refs if wanted is None or ref["material_id"] in wanted
+        ))
+
+    async def vector_filter(self, user_id: str, material_ids: Optional[Sequence[str]]) -> Dict[str, Any]:
+        private = await super().vector_filter(user_id, material_ids)
+        documents = await self._documents(user_id, material_ids)
+        if not documents:
+            return private
+        return {"$or": [private, {f"metadata.{DOCUMENT_ID_KEY}": {"$in": documents}}]}
+
+    async def user_filter(self, user_id: str) -> Dict[str, Any]:
+        private = await super().user_filter(user_id)
+        documents = await self._documents(user_id, None)
+        if not documents:
+            return private
+        return {"$or": [private, {f"metadata.{DOCUMENT_ID_KEY}": {"$in": documents}}]}
+
+    async def row_keys(self, user_id: str, material_ids: Optional[Sequence[str]]) -> Optional[List[str]]:
+        if not material_ids:
+            return None
+        return list(material_ids) + await self._documents(user_id, material_ids)
+
+    async def cache_scopes(self, user_id: str, material_ids: Optional[Sequence[str]]) -> List[str]:
+        """有引用的材料解析成文档（文件哈希）范围，引用同一文件的用户共用回答缓存；
+        没有引用的材料（切换到共享存储前写入）仍按用户 / 材料区分"""
+        refs = await self.user_refs(user_id)
+        if not material_ids:
+            return [user_scope(user_id), *sorted({document_scope(ref["document_id"]) for ref in refs})]
+        documents = {ref["material_id"]: ref["document_id"] for ref in refs}
+        return sorted({
+            document_scope(documents[material_id]) if material_id in documents
+            else material_scope(user_id, material_id)
+            for material_id in material_ids
+        })
+
+    async def annotate_metadata(
+        self,
+        user_id: str,
+        material_ids: Optional[Sequence[str]],
+        metadatas: List[Dict[str, Any]],
+    ) -> None:
+        """共享 chunk 不带 material_id / filename，按用户的引用填回（优先取请求范围内的材料）"""
+        if not any(DOCUMENT_ID_KEY in metadata for metadata in metadatas):
+            return
+        wanted = set(material_ids) if material_ids else None
+        by_document: Dict[str, Dict[str, Any]] = {}
+        for ref in await self.user_refs(user_id):
+            if wanted is not None and ref["material_id"] not in wanted:
+                continue
+            by_document.setdefault(ref["document_id"], ref)
+        for metadata in metadatas:
+            ref = by_document.get(metadata.get(DOCUMENT_ID_KEY))
+            if ref is not None and "material_id" not in metadata:
+                metadata.update({
+                    "user_id": user_id,
+                    "material_id": ref["material_id"],
+                    "filename": ref.get("filename", ""),
+                })
+
+
+class ScopedBackend:
+    """最外层包装：检索结果中的共享 chunk 按用户引用补上 material_id / filename"""
+
+    def __init__(self, inner: Any, scopes: PrivateScopes) -> None:
+        self._inner = inner
+        self._scopes = scopes
+
+    @property
+    def inner(self) -> Any:
+        return self._inner
+
+    async def search(
+        self,
+        query_bundle: QueryBundle,
+        *,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+    ) -> List[NodeWithScore]:
+        nodes = await self._inner.search(query_bundle, user_id=user_id, material_ids=material_ids, top_k=top_k)
+        return await self._scopes.annotate(user_id, material_ids, nodes)
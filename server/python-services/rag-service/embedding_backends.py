@@ -0,0 +1,248 @@
+"""可插拔的 Embedding 后端
+
+RAG_EMBED_BACKEND 选择问题与 chunk 共用的向量模型：
+
+    openai   OpenAIEmbedding（默认）；chunk 向量化经 EmbeddingScheduler 批量发送
+    local    本地 CPU 上的 ONNX 句向量模型（可用量化版），按长度分桶批量推理，
+             onnxruntime 线程池并行；问题向量在进程内计算，不需要网络往返
+    hash     确定性的特征哈希 embedder（词 + 相邻词对），不依赖模型文件和网络，
+             用于离线开发、基准测试与冒烟测试
+
+不同后端的向量空间互不兼容：切换后端（或本地模型）后需要重新处理材料，
+并按新的维度重建 Atlas 向量索引。各缓存的键与 chunk _id 都包含 `embedding_model_id`，
+不会混用，重新处理时全部 chunk 重新向量化。
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import hashlib
+import os
+import re
+from typing import Any, Awaitable, Callable, List, Optional
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from pydantic import PrivateAttr
+
+EMBED_BACKENDS = ("openai", "local", "hash")
+LOCAL_POOLING_MODES = ("cls", "mean")
+
+# 目录中按顺序查找的 ONNX 文件（优先量化版）
+ONNX_CANDIDATES = (
+    "model_quantized.onnx",
+    "model_int8.onnx",
+    "model.onnx",
+    "onnx/model_quantized.onnx",
+    "onnx/model.onnx",
+)
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _feature_digest(feature: str) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class HashEmbedding(BaseEmbedding):
+    """确定性的特征哈希 embedder：同一文本在任何进程、任何机器上得到同一向量
+
+    小写的词和相邻词对经 blake2b 映射到固定维度并带符号累加，最后 L2 归一化；
+    词面重叠越多的文本余弦相似度越高，足以让检索链路产生有意义的排序。
+    """
+
+    dimensions: int = 256
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashEmbedding"
+
+    @property
+    def model_id(self) -> str:
+        return f"hash-{self.dimensions}"
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = _TOKEN_PATTERN.findall(text.lower())
+            features = words + [f"{left} {right}" for left, right in zip(words, words[1:])]
+            for feature in features:
+                digest = _feature_digest(feature)
+                vectors[row, digest % self.dimensions] += 1.0 if digest >> 63 else -1.0
+            if not features:
+                vectors[row, 0] = 1.0
+        return _normalize(vectors)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self.embed([query])[0].tolist()
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self.embed([text])[0].tolist()
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self.embed(texts).tolist()
+
+    async def aget_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        return self.embed(queries).tolist()
+
+
+class LocalOnnxEmbedding(BaseEmbedding):
+    """本地 CPU 句向量模型（ONNX Runtime + HuggingFace tokenizers）
+
+    model_dir 中需要 tokenizer.json 和 ONNX 模型（如 bge-small / all-MiniLM 的导出与量化版本）。
+    同一批输入按 token 数排序后切成 `infer_batch_size` 条的小批，减少 padding；
+    onnxruntime 的算子线程数由 `threads` 控制，InferenceSession 可被多个摄取线程同时调用。
+    """
+
+    model_dir: str
+    onnx_file: str = ""
+    pooling: str = "cls"
+    max_length: int = 512
+    threads: int = 0
+    query_prefix: str = ""
+    infer_batch_size: int = 32
+
+    _model_file: str = PrivateAttr()
+    _session: Any = PrivateAttr()
+    _tokenizer: Any = PrivateAttr()
+    _input_names: List[str] = PrivateAttr()
+    _pad_id: int = PrivateAttr()
+
+    def __init__(self, **data: Any) -> None:
+        super().__init__(**data)
+        if self.pooling not in LOCAL_POOLING_MODES:
+            raise ValueError(f"Unknown local embedding pooling: {self.pooling}")
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as err:
+            raise RuntimeError(
+                "RAG_EMBED_BACKEND=local requires `pip install -r requirements-local-embed.txt` (onnxruntime, tokenizers)"
+            ) from err
+
+        model_path = self._resolve_model_path()
+        self._model_file = os.path.relpath(model_path, self.model_dir)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.threads if self.threads > 0 else (os.cpu_count() or 1)
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self._session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self._input_names = [item.name for item in self._session.get_inputs()]
+
+        self._tokenizer = Tokenizer.from_file(os.path.join(self.model_dir, "tokenizer.json"))
+        self._tokenizer.no_padding()
+        self._tokenizer.enable_truncation(max_length=self.max_length)
+        padding = getattr(self._tokenizer, "padding", None) or {}
+        self._pad_id = int(padding.get("pad_id", 0))
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LocalOnnxEmbedding"
+
+    @property
+    def model_id(self) -> str:
+        # 实际加载的 ONNX 文件与截断长度都会改变向量，一并写入标识（缓存键与 chunk _id 使用）
+        model_name = os.path.basename(os.path.normpath(self.model_dir))
+        return f"local:{model_name}/{self._model_file}/{self.pooling}/{self.max_length}"
+
+    def _resolve_model_path(self) -> str:
+        candidates = (self.onnx_file,) if self.onnx_file else ONNX_CANDIDATES
+        for candidate in candidates:
+            path = os.path.join(self.model_dir, candidate)
+            if os.path.isfile(path):
+                return path
+        raise FileNotFoundError(f"No ONNX model ({', '.join(candidates)}) in {self.model_dir}")
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        encodings = self._tokenizer.encode_batch(texts)
+        order = sorted(range(len(texts)), key=lambda index: len(encodings[index].ids))
+        vectors: List[Optional[np.ndarray]] = [None] * len(texts)
+        step = max(1, self.infer_batch_size)
+        for start in range(0, len(order), step):
+            batch = order[start:start + step]
+            for index, vector in zip(batch, self._run([encodings[index] for index in batch])):
+                vectors[index] = vector
+        return np.stack(vectors)
+
+    def _run(self, encodings: List[Any]) -> np.ndarray:
+        width = max(len(encoding.ids) for encoding in encodings)
+        input_ids = np.full((len(encodings), width), self._pad_id, dtype=np.int64)
+        attention_mask = np.zeros((len(encodings), width), dtype=np.int64)
+        for row, encoding in enumerate(encodings):
+            input_ids[row, :len(encoding.ids)] = encoding.ids
+            attention_mask[row, :len(encoding.ids)] = 1
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+        hidden = self._session.run(None, {name: feeds[name] for name in self._input_names if name in feeds})[0]
+
+        if hidden.ndim == 2:
+            # 导出时已包含池化层（输出 sentence_embedding）
+            pooled = hidden
+        elif self.pooling == "cls":
+            pooled = hidden[:, 0]
+        else:
+            mask = attention_mask[:, :, None].astype(hidden.dtype)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return _normalize(pooled.astype(np.float32))
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self.embed([self.query_prefix + query])[0].tolist()
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await asyncio.to_thread(self._get_query_embedding, query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self.embed([text])[0].tolist()
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self.embed(texts).tolist()
+
+    async def aget_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        prefixed = [self.query_prefix + query for query in queries]
+        return (await asyncio.to_thread(self.embed, prefixed)).tolist()
+
+
+def create_embed_model(config: Any, *, query_batch_size: int = 100) -> BaseEmbedding:
+    """按 RAG_EMBED_BACKEND 创建问题 / chunk 共用的 embedding 模型"""
+    backend = config.RAG_EMBED_BACKEND
+    if backend == "openai":
+        from llama_index.embeddings.openai import OpenAIEmbedding
+
+        return OpenAIEmbedding(model=config.OPENAI_EMBEDDING_MODEL, embed_batch_size=query_batch_size)
+    if backend == "local":
+        return LocalOnnxEmbedding(
+            model_dir=config.RAG_LOCAL_EMBED_MODEL_DIR,
+            onnx_file=config.RAG_LOCAL_EMBED_ONNX_FILE,
+            pooling=config.RAG_LOCAL_EMBED_POOLING,
+            max_length=config.RAG_LOCAL_EMBED_MAX_LENGTH,
+            threads=config.RAG_LOCAL_EMBED_THREADS,
+            query_prefix=config.RAG_LOCAL_EMBED_QUERY_PREFIX,
+            infer_batch_size=config.RAG_LOCAL_EMBED_BATCH_SIZE,
+            embed_batch_size=query_batch_size,
+        )
+    if backend == "hash":
+        return HashEmbedding(dimensions=config.RAG_HASH_EMBED_DIMENSIONS, embed_batch_size=query_batch_size)
+    raise ValueError(f"Unknown RAG_EMBED_BACKEND: {backend}")
+
+
+def embedding_model_id(embed_model: Any) -> str:
+    """缓存键中使用的模型标识（OpenAI 沿用模型名，已有缓存继续有效）"""
+    model_id = getattr(embed_model, "model_id", None)
+    return model_id if isinstance(model_id, str) else embed_model.model_name
+
+
+def query_embedding_batch(embed_model: Any) -> Callable[[List[str]], Awaitable[List[List[float]]]]:
+    """批量问题向量化：本地后端带查询前缀，OpenAI 的问题与文本向量相同，直接走批量文本接口"""
+    return getattr(embed_model, "aget_query_embedding_batch", embed_model.aget_text_embedding_batch)
@@ -0,0 +1,236 @@
+"""内容寻址的持久化 chunk embedding 缓存
+
+键为 sha256(模型名 + chunk 文本)，向量以 float32 存入本地 SQLite。
+同一份讲义重复上传时，相同 chunk 不会再次调用 Embedding API。
+缓存总大小超过上限时按最近使用时间淘汰。
+
+总字节数与条目数由触发器维护在 cache_meta 表中（多进程写入同样计入），
+写入时不再对整张表求和；读取只在内存中记录 last_used，按批写回。
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+EVICT_TARGET_RATIO = 0.9
+# last_used 的精度：距上次记录不足该秒数的命中不再更新（LRU 只需要粗粒度的时间）
+TOUCH_RESOLUTION_SECONDS = 60.0
+# 内存中待写回的 last_used 达到该数量或等待超过该秒数时写回一次
+TOUCH_FLUSH_SIZE = 512
+TOUCH_FLUSH_SECONDS = 30.0
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS embeddings ("
+    " key TEXT PRIMARY KEY,"
+    " vector BLOB NOT NULL,"
+    " size INTEGER NOT NULL,"
+    " last_used REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)",
+    "CREATE TABLE IF NOT EXISTS cache_meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+    "CREATE TRIGGER IF NOT EXISTS embeddings_size_insert AFTER INSERT ON embeddings BEGIN"
+    " UPDATE cache_meta SET value = value + NEW.size WHERE name = 'bytes';"
+    " UPDATE cache_meta SET value = value + 1 WHERE name = 'entries'; END",
+    "CREATE TRIGGER IF NOT EXISTS embeddings_size_delete AFTER DELETE ON embeddings BEGIN"
+    " UPDATE cache_meta SET value = value - OLD.size WHERE name = 'bytes';"
+    " UPDATE cache_meta SET value = value - 1 WHERE name = 'entries'; END",
+    "CREATE TRIGGER IF NOT EXISTS embeddings_size_update AFTER UPDATE OF size ON embeddings BEGIN"
+    " UPDATE cache_meta SET value = value + NEW.size - OLD.size WHERE name = 'bytes'; END",
+)
+
+
+def embedding_cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """SQLite 后端（WAL 模式，可被同一主机上的多个 worker 进程共享）"""
+
+    def __init__(self, path: str, *, max_bytes: int) -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._max_bytes = max(0, max_bytes)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._touches: Dict[str, float] = {}
+        self._touches_since = 0.0
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # 建表、触发器与计数初始化在同一个写事务中完成，其他进程的写入不会漏计
+        self._conn.execute("BEGIN IMMEDIATE")
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+        if self._conn.execute("SELECT 1 FROM cache_meta WHERE name = 'bytes'").fetchone() is None:
+            # 旧版本留下的缓存文件：只在这里全表统计一次
+            entries, total_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM embeddings"
+            ).fetchone()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache_meta (name, value) VALUES (?, ?)",
+                [("bytes", total_bytes), ("entries", entries)],
+            )
+        self._conn.commit()
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, List[float]]:
+        if not keys:
+            return {}
+
+        found: Dict[str, List[float]] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        now = time.time()
+        with self._lock:
+            # SQLite 默认最多 999 个绑定参数
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector, last_used FROM embeddings WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                for key, blob, last_used in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                    if now - last_used >= TOUCH_RESOLUTION_SECONDS:
+                        self._touch_locked(key, now)
+
+            if self._touches and (
+                len(self._touches) >= TOUCH_FLUSH_SIZE or now - self._touches_since >= TOUCH_FLUSH_SECONDS
+            ):
+                self._flush_touches_locked()
+                self._conn.commit()
+
+            hits = sum(1 for key in keys if key in found)
+            self._hits += hits
+            self._misses += len(keys) - hits
+        return found
+
+    def put_many(self, items: Iterable[tuple[str, Sequence[float]]]) -> None:
+        now = time.time()
+        rows = []
+        for key, vector in items:
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            rows.append((key, blob, len(blob), now))
+        if not rows:
+            return
+
+        with self._lock:
+            # 未写回的 last_used 随本次写入一起提交，淘汰前 LRU 顺序是最新的
+            self._flush_touches_locked()
+            # UPSERT 而非 INSERT OR REPLACE：REPLACE 删除旧行时不触发 DELETE 触发器，计数会偏大
+            self._conn.executemany(
+                "INSERT INTO embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(key) DO UPDATE SET"
+                " vector = excluded.vector, size = excluded.size, last_used = excluded.last_used",
+                rows,
+            )
+            self._conn.commit()
+            self._evict_locked()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, total_bytes = self._totals_locked()
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": (self._hits / lookups) if lookups else 0.0,
+                "evictions": self._evictions,
+                "entries": entries,
+                "bytes": total_bytes,
+                "max_bytes": self._max_bytes,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touches_locked()
+            self._conn.commit()
+            self._conn.close()
+
+    def _touch_locked(self, key: str, now: float) -> None:
+        if not self._touches:
+            self._touches_since = now
+        self._touches[key] = now
+
+    def _flush_touches_locked(self) -> None:
+        """写回内存中的 last_used（不提交，由调用方提交）；已被其他进程淘汰的行不受影响"""
+        if not self._touches:
+            return
+        self._conn.executemany(
+            "UPDATE embeddings SET last_used = MAX(last_used, ?) WHERE key = ?",
+            [(used, key) for key, used in self._touches.items()],
+        )
+        self._touches.clear()
+
+    def _totals_locked(self) -> tuple[int, int]:
+        rows = dict(self._conn.execute("SELECT name, value FROM cache_meta").fetchall())
+        return int(rows.get("entries", 0)), int(rows.get("bytes", 0))
+
+    def _evict_locked(self) -> None:
+        if not self._max_bytes:
+            return
+
+        _, total_bytes = self._totals_locked()
+        if total_bytes <= self._max_bytes:
+            return
+
+        target = int(self._max_bytes * EVICT_TARGET_RATIO)
+        to_free = total_bytes - target
+        freed = 0
+        victims: List[str] = []
+        for key, size in self._conn.execute("SELECT key, size FROM embeddings ORDER BY last_used ASC"):
+            victims.append(key)
+            freed += size
+            if freed >= to_free:
+                break
+
+        self._conn.executemany("DELETE FROM embeddings WHERE key = ?", [(key,) for key in victims])
+        self._conn.commit()
+        self._evictions += len(victims)
+
+
+class CachedEmbeddingModel:
+    """在任意提供 `get_text_embedding_batch` 的 embedding 模型外包一层缓存
+
+    只有缓存未命中的文本才会发送给底层模型，结果按输入顺序返回。
+    """
+
+    def __init__(self, embed_model: Any, cache: EmbeddingCache, *, model_name: str) -> None:
+        self._embed_model = embed_model
+        self._cache = cache
+        self._model_name = model_name
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    def get_text_embedding_batch(self, texts: List[str], **kwargs: Any) -> List[List[float]]:
+        keys = [embedding_cache_key(self._model_name, text) for text in texts]
+        cached = self._cache.get_many(keys)
+
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        if missing:
+            fresh = self._embed_model.get_text_embedding_batch(list(missing.values()), **kwargs)
+            fresh_items = list(zip(missing.keys(), fresh))
+            self._cache.put_many(fresh_items)
+            cached.update(fresh_items)
+
+        return [cached[key] for key in keys]
+
+
+def create_embedding_cache(path: str, max_mb: int) -> Optional[EmbeddingCache]:
+    if not path or max_mb <= 0:
+        return None
+    return EmbeddingCache(path, max_bytes=max_mb * 1024 * 1024)
@@ -0,0 +1,557 @@
+"""限流感知的 chunk 批量向量化调度
+
+每个进程内所有摄取线程共用一个 EmbeddingScheduler，各进程（uvicorn worker / Pod）的调度器
+再经 MongoLimiterState 共用同一份 AIMD 状态：
+
+- 打包：各摄取线程提交的文本进入同一个 FIFO 队列（按 tiktoken 计数），并发名额空出时
+  取出尽量多的文本组成一个请求（不超过 token / 条数上限），多份材料的 chunk 可以合并发送
+- 自适应并发：AIMD。请求成功后按响应头 `x-ratelimit-remaining-*` 判断剩余额度，
+  额度充足时并发上限缓慢增加；额度不足或收到 429 时上限减半，并让所有线程暂停到
+  `x-ratelimit-reset-*` / `retry-after` 给出的时间
+- 重试：429、5xx、连接错误按带抖动的指数退避重试；400 / 422 等请求错误把批次对半拆开
+  分别重发，最终只有出错的文本失败，同批的其他文本照常返回；其余错误直接抛出
+
+跨进程协调：共享文档保存全局并发上限、慢启动标志与暂停截止时间，任一进程遇到 429 或额度
+不足时全局减半并让所有进程暂停；正在向量化的进程定期心跳，各自的并发上限为全局上限除以
+存活进程数。共享状态不可用时退回进程内独立的 AIMD（总并发最多为各进程上限之和）。
+"""
+from __future__ import annotations
+
+import logging
+import os
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Deque, Dict, List, Mapping, Optional, Tuple
+
+import openai
+import tiktoken
+
+from instrumentation import metrics
+
+# OpenAI embeddings 单次请求最多 2048 条输入，总 token 不超过 300k
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_TOKENS_PER_REQUEST = 300_000
+
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 30.0
+# 均分排队文本时每个请求至少装这么多 token，避免队列较浅时拆出大量小请求消耗 RPM
+MIN_SPLIT_BATCH_TOKENS = 8192
+# 两次并发减半之间的最短间隔（约一个请求往返）
+DECREASE_INTERVAL_SECONDS = 1.0
+# 共享限流状态读取失败后，隔这么久再重试
+SHARED_RETRY_SECONDS = 30.0
+# 请求本身有问题（如输入超长）时返回的状态码：拆分批次找出出错的文本
+SPLITTABLE_STATUS_CODES = (400, 413, 422)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset_seconds(value: Optional[str]) -> Optional[float]:
+    """解析 `x-ratelimit-reset-*`（如 "20ms"、"1.5s"、"6m0s"）"""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def retry_after_seconds(headers: Mapping[str, str]) -> Optional[float]:
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) * scale
+            except ValueError:
+                continue
+    return None
+
+
+def _header_int(headers: Mapping[str, str], name: str) -> Optional[int]:
+    value = headers.get(name)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def backoff_seconds(attempt: int, retry_after: Optional[float] = None) -> float:
+    """服务端给出等待时间时在其上加少量抖动，否则用 full jitter 指数退避"""
+    if retry_after is not None:
+        return retry_after * (1.0 + random.uniform(0.0, 0.2))
+    return random.uniform(0.0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+class MongoLimiterState:
+    """所有进程共用的 AIMD 状态（同步集合，在调度线程中调用）
+
+        {_id: key, limit, slow_start, last_decrease, paused_until}     全局状态（时间为 epoch 秒）
+        {_id: "<key>/<进程>", key, expires_at}                           进程心跳，TTL 索引清除退出的进程
+
+    key 取 embedding 模型名（OpenAI 限流按组织 + 模型计）。加减在服务端用聚合管道更新，
+    多个进程同时上报不会互相覆盖。
+    """
+
+    def __init__(
+        self,
+        collection: Any,
+        *,
+        key: str,
+        initial: int,
+        maximum: int,
+        member_ttl: float = 30.0,
+    ) -> None:
+        self._collection = collection
+        self._key = key
+        self._initial = max(1, initial)
+        self._maximum = max(1, maximum)
+        self._member_ttl = member_ttl
+        self._member_id = f"{key}/{socket.gethostname()}/{os.getpid()}/{uuid.uuid4().hex[:8]}"
+        self._ready = False
+
+    def snapshot(self) -> Tuple[float, int, float]:
+        """续期本进程心跳，返回 (全局上限, 存活进程数, 暂停截止 epoch 秒)"""
+        self._ensure_ready()
+        now = datetime.now(timezone.utc)
+        self._collection.update_one(
+            {"_id": self._member_id},
+            {"$set": {"key": self._key, "expires_at": now + timedelta(seconds=self._member_ttl)}},
+            upsert=True,
+        )
+        state = self._collection.find_one({"_id": self._key}) or {}
+        members = self._collection.count_documents({"key": self._key, "expires_at": {"$gt": now}})
+        return float(state.get("limit", self._initial)), max(1, members), float(state.get("paused_until", 0.0))
+
+    def increase(self) -> None:
+        self._ensure_ready()
+        step = {"$cond": ["$slow_start", 1.0, {"$divide": [1.0, "$limit"]}]}
+        self._collection.update_one(
+            {"_id": self._key},
+            [{"$set": {"limit": {"$min": [float(self._maximum), {"$add": ["$limit", step]}]}}}],
+        )
+
+    def decrease(self, pause_seconds: Optional[float]) -> None:
+        self._ensure_ready()
+        now = time.time()
+        # 一个减半间隔内多个进程陆续上报的限流信号只减半一次
+        self._collection.update_one(
+            {"_id": self._key, "last_decrease": {"$lte": now - DECREASE_INTERVAL_SECONDS}},
+            [{"$set": {"limit": {"$max": [1.0, {"$divide": ["$limit", 2.0]}]}, "last_decrease": now}}],
+        )
+        self._collection.update_one(
+            {"_id": self._key},
+            {"$set": {"slow_start": False}, "$max": {"paused_until": now + (pause_seconds or 0.0)}},
+        )
+
+    def _ensure_ready(self) -> None:
+        if self._ready:
+            return
+        self._collection.create_index("expires_at", expireAfterSeconds=0)
+        self._collection.update_one(
+            {"_id": self._key},
+            {"$setOnInsert": {
+                "limit": float(self._initial),
+                "slow_start": True,
+                "last_decrease": 0.0,
+                "paused_until": 0.0,
+            }},
+            upsert=True,
+        )
+        self._ready = True
+
+
+class AdaptiveLimiter:
+    """AIMD 并发上限 + 全局暂停（所有线程共用）
+
+    与 TCP 拥塞控制相同：第一次遇到限流信号之前每个成功请求上限 +1（每轮翻倍），
+    之后每轮 +1；遇到限流信号时减半（同一轮内已发出的请求陆续返回的信号只减半一次）。
+
+    给出 shared 时加减同时上报到共享状态，并每隔 sync_seconds 用共享状态覆盖本地上限
+    （全局上限 / 存活进程数）与暂停时间；共享状态读写失败时按本地状态继续。
+    """
+
+    def __init__(
+        self,
+        *,
+        initial: int,
+        maximum: int,
+        shared: Optional[MongoLimiterState] = None,
+        sync_seconds: float = 1.0,
+    ) -> None:
+        self._maximum = max(1, maximum)
+        self._limit = float(min(max(1, initial), self._maximum))
+        self._active = 0
+        self._paused_until = 0.0
+        self._slow_start = True
+        self._last_decrease = float("-inf")
+        self._cond = threading.Condition()
+        self._shared = shared
+        self._sync_seconds = sync_seconds
+        self._next_sync = 0.0
+        self._sync_lock = threading.Lock()
+        self._shared_failed = False
+        self.processes = 1
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def sync(self, *, force: bool = False) -> None:
+        """从共享状态刷新本地上限与暂停时间（在锁外做 I/O）"""
+        if self._shared is None:
+            return
+        if not force and time.monotonic() < self._next_sync:
+            return
+        # 同一时刻只有一个线程读共享状态，其他线程沿用本地状态
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            snapshot = self._shared_call(self._shared.snapshot)
+            # 共享状态不可用时放慢重试，避免每次取名额都等待连接超时
+            delay = self._sync_seconds if snapshot is not None else max(self._sync_seconds, SHARED_RETRY_SECONDS)
+            self._next_sync = time.monotonic() + delay
+        finally:
+            self._sync_lock.release()
+        if snapshot is None:
+            return
+        global_limit, processes, paused_until = snapshot
+        with self._cond:
+            self.processes = processes
+            self._limit = min(float(self._maximum), max(1.0, global_limit / processes))
+            pause = paused_until - time.time()
+            if pause > 0:
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            self._cond.notify_all()
+
+    def acquire(self) -> None:
+        self.sync()
+        with self._cond:
+            while True:
+                wait = self._paused_until - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                elif self._active < int(self._limit):
+                    self._active += 1
+                    return
+                else:
+                    self._cond.wait()
+
+    def release(self) -> None:
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def on_success(self, headers: Mapping[str, str], batch_tokens: int) -> None:
+        remaining_requests = _header_int(headers, "x-ratelimit-remaining-requests")
+        remaining_tokens = _header_int(headers, "x-ratelimit-remaining-tokens")
+        with self._cond:
+            in_flight = max(1, self._active) * self.processes
+            pause: Optional[float] = None
+            if remaining_tokens is not None and remaining_tokens < batch_tokens * in_flight:
+                # 剩余 token 不够当前并发再发一轮：降并发，等到 token 额度重置
+                decrease = True
+                pause = parse_reset_seconds(headers.get("x-ratelimit-reset-tokens"))
+            elif remaining_requests is not None and remaining_requests < in_flight:
+                decrease = True
+                pause = parse_reset_seconds(headers.get("x-ratelimit-reset-requests"))
+            else:
+                decrease = False
+            if decrease:
+                self._decrease(pause)
+            else:
+                step = 1.0 if self._slow_start else 1.0 / self._limit
+                self._limit = min(float(self._maximum), self._limit + step)
+            self._cond.notify_all()
+        # 共享状态不可用期间只按本地状态调整，由 sync 定期重试恢复
+        if self._shared is not None and not self._shared_failed:
+            if decrease:
+                self._shared_call(lambda: self._shared.decrease(pause))
+                self.sync(force=True)
+            else:
+                self._shared_call(self._shared.increase)
+
+    def on_rate_limited(self, delay: float) -> None:
+        with self._cond:
+            self._decrease(delay)
+            self._cond.notify_all()
+        if self._shared is not None and not self._shared_failed:
+            self._shared_call(lambda: self._shared.decrease(delay))
+            self.sync(force=True)
+
+    def _shared_call(self, call: Any) -> Any:
+        try:
+            result = call()
+        except Exception as err:
+            # 只在首次失败时记录，恢复后再次失败重新记录
+            if not self._shared_failed:
+                metrics.log("rag.embed.shared_limiter_failed", level=logging.WARNING, error=str(err))
+            self._shared_failed = True
+            return None
+        self._shared_failed = False
+        return result
+
+    def _decrease(self, pause_seconds: Optional[float]) -> None:
+        now = time.monotonic()
+        self._slow_start = False
+        if now - self._last_decrease >= DECREASE_INTERVAL_SECONDS:
+            self._limit = max(1.0, self._limit / 2.0)
+            self._last_decrease = now
+        if pause_seconds:
+            self._paused_until = max(self._paused_until, now + pause_seconds)
+
+
+@dataclass
+class _PendingText:
+    text: str
+    tokens: int
+    future: Future = field(default_factory=Future)
+
+
+class EmbeddingScheduler:
+    """实现 `get_text_embedding_batch`，可直接作为 StreamingIngestor / CachedEmbeddingModel 的底层模型
+
+    调用线程把文本放入共享队列后等待结果；max_concurrency 个分发线程在拿到并发名额后
+    从队列取一批发送，失败的批次在退避期间让出名额。
+    """
+
+    def __init__(
+        self,
+        *,
+        model: str,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        dimensions: Optional[int] = None,
+        max_batch_tokens: int = 100_000,
+        max_batch_inputs: int = MAX_INPUTS_PER_REQUEST,
+        concurrency: int = 4,
+        max_concurrency: int = 16,
+        max_retries: int = 8,
+        timeout: float = 60.0,
+        result_timeout: float = 900.0,
+        shared_state: Optional[MongoLimiterState] = None,
+        client: Any = None,
+    ) -> None:
+        self._model = model
+        self._dimensions = dimensions
+        self._max_batch_tokens = max(1, min(max_batch_tokens, MAX_TOKENS_PER_REQUEST))
+        self._max_batch_inputs = max(1, min(max_batch_inputs, MAX_INPUTS_PER_REQUEST))
+        self._max_concurrency = max(1, max_concurrency)
+        self._max_retries = max(0, max_retries)
+        self._result_timeout = result_timeout
+        self._client = client
+        self._client_kwargs: Dict[str, Any] = {"api_key": api_key, "base_url": base_url, "timeout": timeout}
+        self._client_lock = threading.Lock()
+        self._limiter = AdaptiveLimiter(initial=concurrency, maximum=self._max_concurrency, shared=shared_state)
+        try:
+            self._encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self._encoding = tiktoken.get_encoding("cl100k_base")
+
+        self._queue: Deque[_PendingText] = deque()
+        self._queued_tokens = 0
+        self._queue_cond = threading.Condition()
+        self._dispatchers: List[threading.Thread] = []
+        self._closed = False
+
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._retries = 0
+        self._rate_limited = 0
+        self._embedded_texts = 0
+        self._embedded_tokens = 0
+
+    def get_text_embedding_batch(self, texts: List[str], **kwargs: Any) -> List[List[float]]:
+        if not texts:
+            return []
+        token_counts = [len(tokens) for tokens in self._encoding.encode_ordinary_batch(list(texts))]
+        pending = [_PendingText(text, count) for text, count in zip(texts, token_counts)]
+        with self._queue_cond:
+            if self._closed:
+                raise RuntimeError("EmbeddingScheduler has been shut down")
+            self._start_dispatchers()
+            self._queue.extend(pending)
+            self._queued_tokens += sum(token_counts)
+            self._queue_cond.notify_all()
+
+        # 排队 + 限流暂停 + 重试的总等待上限；超时后撤回仍在排队的文本
+        deadline = time.monotonic() + self._result_timeout
+        try:
+            return [item.future.result(timeout=max(0.0, deadline - time.monotonic())) for item in pending]
+        except FutureTimeoutError:
+            for item in pending:
+                item.future.cancel()
+            raise TimeoutError(
+                f"Embedding {len(texts)} texts did not finish within {self._result_timeout:g}s"
+            ) from None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "requests": self._requests,
+                "retries": self._retries,
+                "rate_limited": self._rate_limited,
+                "embedded_texts": self._embedded_texts,
+                "embedded_tokens": self._embedded_tokens,
+                "avg_batch_texts": (self._embedded_texts / (self._requests - self._retries))
+                if self._requests > self._retries else 0.0,
+                "concurrency_limit": self._limiter.limit,
+                "processes": self._limiter.processes,
+                "queued": len(self._queue),
+            }
+
+    def shutdown(self) -> None:
+        with self._queue_cond:
+            self._closed = True
+            abandoned = list(self._queue)
+            self._queue.clear()
+            self._queued_tokens = 0
+            self._queue_cond.notify_all()
+        for item in abandoned:
+            item.future.set_exception(RuntimeError("EmbeddingScheduler has been shut down"))
+
+    def _start_dispatchers(self) -> None:
+        if self._dispatchers:
+            return
+        for index in range(self._max_concurrency):
+            thread = threading.Thread(target=self._dispatch, name=f"rag-embed-{index}", daemon=True)
+            thread.start()
+            self._dispatchers.append(thread)
+
+    def _dispatch(self) -> None:
+        while True:
+            with self._queue_cond:
+                while not self._queue and not self._closed:
+                    self._queue_cond.wait()
+                if self._closed:
+                    return
+            # 先拿名额再取批次：等待名额期间新提交的文本会并入同一个请求
+            self._limiter.acquire()
+            batch = self._take_batch()
+            if batch:
+                self._send(batch)
+            else:
+                self._limiter.release()
+
+    def _take_batch(self) -> List[_PendingText]:
+        """排队的文本按当前并发上限均分：不受限时多个请求并行，限流收紧（上限降到 1）时每批装满"""
+        batch: List[_PendingText] = []
+        tokens = 0
+        with self._queue_cond:
+            share = -(-self._queued_tokens // self._limiter.limit)
+            target = min(self._max_batch_tokens, max(share, MIN_SPLIT_BATCH_TOKENS))
+            taken = 0
+            while self._queue and len(batch) < self._max_batch_inputs:
+                if batch and tokens + self._queue[0].tokens > target:
+                    break
+                item = self._queue.popleft()
+                taken += item.tokens
+                # 调用方已超时撤回的文本不再发送
+                if not item.future.set_running_or_notify_cancel():
+                    continue
+                batch.append(item)
+                tokens += item.tokens
+            self._queued_tokens -= taken
+        return batch
+
+    def _send(self, batch: List[_PendingText]) -> None:
+        """发送一个批次（调用时已持有并发名额，返回前释放）"""
+        texts = [item.text for item in batch]
+        batch_tokens = sum(item.tokens for item in batch)
+        attempt = 0
+        while True:
+            try:
+                self._count(requests=1)
+                headers, embeddings = self._request(texts)
+            except Exception as err:
+                delay = self._retry_delay(err, attempt)
+                self._limiter.release()
+                if delay is None and len(batch) > 1 and self._splittable(err):
+                    middle = len(batch) // 2
+                    for half in (batch[:middle], batch[middle:]):
+                        self._limiter.acquire()
+                        self._send(half)
+                    return
+                if delay is None:
+                    for item in batch:
+                        item.future.set_exception(err)
+                    return
+                self._count(retries=1)
+                attempt += 1
+                time.sleep(delay)
+                self._limiter.acquire()
+                continue
+
+            self._limiter.on_success(headers, batch_tokens)
+            self._limiter.release()
+            self._count(texts=len(batch), tokens=batch_tokens)
+            for item, embedding in zip(batch, embeddings):
+                item.future.set_result(embedding)
+            return
+
+    def _retry_delay(self, err: Exception, attempt: int) -> Optional[float]:
+        """可重试的错误返回退避秒数，否则返回 None"""
+        if attempt >= self._max_retries:
+            return None
+        if isinstance(err, openai.RateLimitError):
+            # 额度耗尽（insufficient_quota）重试没有意义
+            if getattr(err, "code", None) == "insufficient_quota":
+                return None
+            delay = backoff_seconds(attempt, retry_after_seconds(err.response.headers))
+            self._limiter.on_rate_limited(delay)
+            self._count(rate_limited=1)
+            return delay
+        if isinstance(err, openai.InternalServerError):
+            return backoff_seconds(attempt, retry_after_seconds(err.response.headers))
+        if isinstance(err, openai.APIConnectionError):
+            return backoff_seconds(attempt)
+        return None
+
+    @staticmethod
+    def _splittable(err: Exception) -> bool:
+        return isinstance(err, openai.APIStatusError) and err.status_code in SPLITTABLE_STATUS_CODES
+
+    def _request(self, texts: List[str]) -> Tuple[Mapping[str, str], List[List[float]]]:
+        params: Dict[str, Any] = {"model": self._model, "input": texts}
+        if self._dimensions:
+            params["dimensions"] = self._dimensions
+        raw = self._openai_client().embeddings.with_raw_response.create(**params)
+        response = raw.parse()
+        ordered = sorted(response.data, key=lambda item: item.index)
+        if len(ordered) != len(texts):
+            raise ValueError(f"Embedding response has {len(ordered)} vectors for {len(texts)} inputs")
+        return raw.headers, [list(item.embedding) for item in ordered]
+
+    def _openai_client(self) -> Any:
+        # 首次请求时才创建（启动时可以没有 API key）；重试由调度器统一负责，关闭 SDK 自带的重试
+        with self._client_lock:
+            if self._client is None:
+                self._client = openai.OpenAI(max_retries=0, **self._client_kwargs)
+            return self._client
+
+    def _count(
+        self,
+        *,
+        requests: int = 0,
+        retries: int = 0,
+        rate_limited: int = 0,
+        texts: int = 0,
+        tokens: int = 0,
+    ) -> None:
+        with self._stats_lock:
+            self._requests += requests
+            self._retries += retries
+            self._rate_limited += rate_limited
+            self._embedded_texts += texts
+            self._embedded_tokens += tokens
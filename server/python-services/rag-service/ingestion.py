@@ -0,0 +1,266 @@
+"""流式摄取管线：page → chunk → embed → insert
+
+每一页 PDF 单独切分，节点按批次向量化，写库在有界窗口内异步进行。
+任一时刻内存中只保留当前页和不超过 `max_in_flight + 1` 个批次，峰值内存由
+批大小决定，而与 PDF 页数无关。向量化与写库在同一窗口内异步进行，
+embedding 请求的并发和限流由底层模型（EmbeddingScheduler）统一调度。
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import uuid
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Any, Callable, Container, ContextManager, Deque, Dict, Iterable, Iterator, List, Optional, TypeVar
+
+from llama_index.core.readers import SimpleDirectoryReader
+from llama_index.core.schema import BaseNode, Document, MetadataMode
+from pypdf import PdfReader
+
+from instrumentation import metrics
+from pdf_extraction import PdfPageExtractor
+
+T = TypeVar("T")
+
+StageTimer = Callable[[str], ContextManager[Any]]
+
+# 页码（从 1 开始的物理页序号）、chunk 在材料内的序号与内容哈希；只用于存储、
+# 排序和增量更新，不进入 embedding 文本和 LLM 上下文
+PAGE_NUMBER_KEY = "page"
+CHUNK_ORDINAL_KEY = "chunk"
+CONTENT_HASH_KEY = "hash"
+# 跨用户共享存储时 chunk 所属文档（整个文件的 sha256，即 rag_documents 的 _id）；
+# 不用 document_id，它是 LlamaIndex 写入的内部字段
+DOCUMENT_ID_KEY = "file_hash"
+STORAGE_METADATA_KEYS = (PAGE_NUMBER_KEY, CHUNK_ORDINAL_KEY, CONTENT_HASH_KEY, DOCUMENT_ID_KEY)
+
+# chunk _id = uuid5(命名空间, "<归属>/<内容哈希>/<第几次出现>")，归属为
+# "<user_id>/<material_id>@<向量版本>" 或共享文档的 file_hash（其中已含向量版本），见 embedding_version
+CHUNK_ID_NAMESPACE = uuid.UUID("5b0f8a52-3c1e-4d7a-9e2b-6f4c1d8a7e30")
+
+SERIAL_EXTRACTOR = PdfPageExtractor(workers=1)
+
+
+def _untimed_stage(_name: str) -> ContextManager[Any]:
+    return nullcontext()
+
+
+@dataclass
+class IngestStats:
+    page_count: int = 0
+    chunk_count: int = 0
+    char_count: int = 0
+    inserted_count: int = 0
+    # 本次切分出的全部 chunk：_id → 材料内序号，用于和库里已有的 chunk 比对
+    chunk_ordinals: Dict[str, int] = field(default_factory=dict)
+
+
+def iter_pages(
+    file_path: str,
+    metadata: Dict[str, Any],
+    extractor: Optional[PdfPageExtractor] = None,
+) -> Iterator[Document]:
+    """逐页产出 Document（与 PDFReader 相同：每页一个文档，带 page_label）
+
+    PDF 文本由 extractor 按页区间并行提取，产出顺序与页序一致；无法解析的页面产出空文本。
+
+    调用方传入的归属信息（user_id / material_id / filename / file_hash）不参与向量化：
+    向量只由页码标签和正文决定，同一文件被不同用户上传时 chunk 哈希与向量完全一致。
+    """
+    embed_excluded = [*STORAGE_METADATA_KEYS, *metadata]
+    if os.path.splitext(file_path)[1].lower() != ".pdf":
+        for document in SimpleDirectoryReader(input_files=[file_path]).load_data():
+            document.metadata.update(metadata)
+            document.excluded_embed_metadata_keys.extend(embed_excluded)
+            document.excluded_llm_metadata_keys.extend(STORAGE_METADATA_KEYS)
+            yield document
+        return
+
+    reader = PdfReader(file_path)
+    labels = reader.page_labels
+    extractor = extractor or SERIAL_EXTRACTOR
+    failed_pages: List[int] = []
+    for page_index, (text, extracted) in enumerate(extractor.extract(reader, file_path)):
+        page_label = labels[page_index] if page_index < len(labels) else str(page_index + 1)
+        if not extracted:
+            failed_pages.append(page_index + 1)
+        yield Document(
+            text=text,
+            metadata={"page_label": page_label, PAGE_NUMBER_KEY: page_index + 1, **metadata},
+            excluded_embed_metadata_keys=list(embed_excluded),
+            excluded_llm_metadata_keys=list(STORAGE_METADATA_KEYS),
+        )
+    if failed_pages:
+        metrics.log(
+            "rag.ingest.pages_without_text",
+            level=logging.WARNING,
+            file_path=file_path,
+            failed_pages=len(failed_pages),
+            first_failed_pages=failed_pages[:20],
+        )
+
+
+def iter_chunks(
+    pages: Iterable[Document],
+    node_parser: Any,
+    stage: StageTimer = _untimed_stage,
+) -> Iterator[BaseNode]:
+    """一次只切分一页，切分结果按顺序产出，并按顺序编上材料内的 chunk 序号"""
+    ordinal = 0
+    for page in pages:
+        with stage("chunk"):
+            nodes = node_parser.get_nodes_from_documents([page])
+        for node in nodes:
+            node.metadata[CHUNK_ORDINAL_KEY] = ordinal
+            ordinal += 1
+        yield from nodes
+
+
+def embedding_version(model_id: str, codec_signature: str) -> str:
+    """向量版本：embedding 模型标识 + 存储格式
+
+    进入 chunk _id（以及共享文档的 file_hash）。更换模型或截断 / 量化设置后，
+    未变化的文本也会得到新的 _id，重新处理材料时全部重新向量化，旧向量作为已不存在的 chunk 删除。
+    """
+    return f"{model_id}|{codec_signature}"
+
+
+def content_hash(node: BaseNode) -> str:
+    """chunk 的稳定内容哈希：向量只由 embedding 输入文本（正文 + 参与向量化的元数据）决定"""
+    text = node.get_content(metadata_mode=MetadataMode.EMBED)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+def assign_chunk_ids(chunks: Iterable[BaseNode], namespace: str) -> Iterator[BaseNode]:
+    """按内容哈希给 chunk 分配确定性的 _id，同一材料重新处理时未变化的 chunk 得到相同的 _id"""
+    occurrences: Counter = Counter()
+    for node in chunks:
+        digest = content_hash(node)
+        node.metadata[CONTENT_HASH_KEY] = digest
+        node.id_ = str(uuid.uuid5(CHUNK_ID_NAMESPACE, f"{namespace}/{digest}/{occurrences[digest]}"))
+        occurrences[digest] += 1
+        yield node
+
+
+def batched(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def timed(items: Iterable[T], stage: StageTimer, name: str) -> Iterator[T]:
+    """把生成器每次 next() 的耗时计入指定阶段"""
+    iterator = iter(items)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class StreamingIngestor:
+    """把页面流式写入向量库
+
+    embed_model 需提供 `get_text_embedding_batch`，vector_store 需提供 `add(nodes)`
+    （CompactMongoVectorStore.add 按 _id 一次批量 upsert）。
+    """
+
+    def __init__(
+        self,
+        *,
+        node_parser: Any,
+        embed_model: Any,
+        vector_store: Any,
+        batch_size: int = 64,
+        max_in_flight: int = 2,
+    ) -> None:
+        self._node_parser = node_parser
+        self._embed_model = embed_model
+        self._vector_store = vector_store
+        self._batch_size = max(1, batch_size)
+        self._max_in_flight = max(1, max_in_flight)
+
+    def run(
+        self,
+        pages: Iterable[Document],
+        *,
+        stage: Optional[StageTimer] = None,
+        on_inserted: Optional[Callable[[List[BaseNode]], Any]] = None,
+        namespace: Optional[str] = None,
+        existing_ids: Optional[Container[str]] = None,
+    ) -> IngestStats:
+        """on_inserted 在每个批次写库成功后于写库线程中调用（用于更新本地索引）
+
+        给出 namespace 时按内容哈希分配 chunk _id；_id 已在 existing_ids 中的 chunk
+        内容未变，跳过向量化和写库。
+        """
+        stage = stage or _untimed_stage
+        stats = IngestStats()
+
+        def count_page(page: Document) -> Document:
+            stats.page_count += 1
+            stats.char_count += len(page.text)
+            return page
+
+        def changed_only(chunks: Iterable[BaseNode]) -> Iterator[BaseNode]:
+            for node in chunks:
+                stats.chunk_count += 1
+                stats.chunk_ordinals[node.node_id] = node.metadata.get(CHUNK_ORDINAL_KEY)
+                if existing_ids is None or node.node_id not in existing_ids:
+                    yield node
+
+        page_stream = (count_page(page) for page in timed(pages, stage, "parse"))
+        chunk_stream = iter_chunks(page_stream, self._node_parser, stage)
+        if namespace is not None:
+            chunk_stream = assign_chunk_ids(chunk_stream, namespace)
+        chunk_stream = changed_only(chunk_stream)
+
+        # 向量化和写库都在窗口内异步进行：切分下一批的同时，前面的批次在等待 embedding 接口
+        in_flight: Deque[Future] = deque()
+        with ThreadPoolExecutor(max_workers=self._max_in_flight, thread_name_prefix="rag-insert") as executor:
+            try:
+                for batch in batched(chunk_stream, self._batch_size):
+                    # 窗口已满时等待最早的批次完成，限制内存中驻留的批次数
+                    while len(in_flight) >= self._max_in_flight:
+                        in_flight.popleft().result()
+
+                    in_flight.append(executor.submit(self._embed_and_insert, batch, stage, on_inserted))
+                    stats.inserted_count += len(batch)
+
+                while in_flight:
+                    in_flight.popleft().result()
+            finally:
+                for future in in_flight:
+                    future.cancel()
+
+        return stats
+
+    def _embed(self, nodes: List[BaseNode]) -> None:
+        embeddings = self._embed_model.get_text_embedding_batch(
+            [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        )
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+
+    def _embed_and_insert(
+        self,
+        nodes: List[BaseNode],
+        stage: StageTimer,
+        on_inserted: Optional[Callable[[List[BaseNode]], Any]],
+    ) -> None:
+        with stage("embed"):
+            self._embed(nodes)
+        with stage("insert"):
+            self._vector_store.add(nodes)
+        if on_inserted is not None:
+            on_inserted(nodes)
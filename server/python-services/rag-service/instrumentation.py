@@ -0,0 +1,86 @@
+"""rag-service 专有的 Prometheus 指标来源
+
+- metrics：rag-service 各模块共用的 ServiceMetrics（阶段耗时与结构化日志）
+
+- RagStatsCollector：抓取时读取 `RAGPipeline.cache_stats()`，把各缓存已有的 hits / misses
+  计数导出为 `study_assistant_cache_requests_total{cache,result}`，把摄取调度器的
+  embedded_tokens 导出为 `study_assistant_embedding_tokens_total{model}`；不在热路径上额外计数
+- LlmTokenHandler：LlamaIndex instrumentation 事件处理器，从 LLM 响应的 usage 中累计
+  prompt / completion token（流式响应不带 usage，不计入）
+"""
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events import BaseEvent
+from llama_index.core.instrumentation.events.llm import LLMChatEndEvent, LLMCompletionEndEvent
+from prometheus_client.core import CounterMetricFamily
+from pydantic import PrivateAttr
+
+from shared.metrics import ServiceMetrics
+
+metrics = ServiceMetrics("rag-service")
+
+
+def _hit_counters(stats: Dict[str, Any], prefix: str = "") -> Iterator[Tuple[str, int, int]]:
+    """遍历嵌套的统计字典，产出 (缓存名, hits, misses)"""
+    for name, value in stats.items():
+        if not isinstance(value, dict):
+            continue
+        label = f"{prefix}{name}"
+        if "hits" in value and "misses" in value:
+            yield label, int(value["hits"]), int(value["misses"])
+        else:
+            yield from _hit_counters(value, prefix=f"{label}.")
+
+
+class RagStatsCollector:
+    def __init__(self, service: str, stats: Callable[[], Dict[str, Any]], *, embedding_model: str) -> None:
+        self._service = service
+        self._stats = stats
+        self._embedding_model = embedding_model
+
+    def collect(self) -> Iterator[CounterMetricFamily]:
+        stats = self._stats()
+        caches = CounterMetricFamily(
+            "study_assistant_cache_requests",
+            "Cache lookups by result",
+            labels=["service", "cache", "result"],
+        )
+        for cache, hits, misses in _hit_counters(stats):
+            caches.add_metric([self._service, cache, "hit"], hits)
+            caches.add_metric([self._service, cache, "miss"], misses)
+        yield caches
+
+        scheduler: Optional[Dict[str, Any]] = stats.get("embedding_scheduler")
+        if scheduler is not None:
+            tokens = CounterMetricFamily(
+                "study_assistant_embedding_tokens",
+                "Tokens sent to the embedding API by ingestion",
+                labels=["service", "model"],
+            )
+            tokens.add_metric([self._service, self._embedding_model], scheduler["embedded_tokens"])
+            yield tokens
+
+    def describe(self) -> List[Any]:
+        # 避免注册时调用 collect()（此时管道可能尚未初始化完成）
+        return []
+
+
+class LlmTokenHandler(BaseEventHandler):
+    model: str
+
+    _metrics: ServiceMetrics = PrivateAttr()
+
+    def __init__(self, metrics: ServiceMetrics, **data: Any) -> None:
+        super().__init__(**data)
+        self._metrics = metrics
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LlmTokenHandler"
+
+    def handle(self, event: BaseEvent, **kwargs: Any) -> None:
+        if isinstance(event, (LLMChatEndEvent, LLMCompletionEndEvent)) and event.response is not None:
+            self._metrics.usage(self.model, event.response.additional_kwargs)
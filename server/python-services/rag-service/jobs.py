@@ -0,0 +1,241 @@
+"""后台摄取任务队列
+
+`/process` 只负责入队并立即返回 job_id，PDF 解析、切分、向量化和写库
+都在有界线程池中完成，避免阻塞事件循环上的 `/query` 请求。
+
+任务状态在入队、开始、结束时写入 MongoDB（MongoJobStore），`GET /process/{job_id}`
+落到其他 worker 或服务重启后也能查到；进程退出时未完成的任务记为失败，轮询方不会一直等待。
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from instrumentation import metrics
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the ingestion backlog is already at capacity."""
+
+
+@dataclass
+class IngestionJob:
+    job_id: str
+    material_id: str
+    user_id: str
+    filename: str
+    status: str = JOB_QUEUED
+    error: Optional[str] = None
+    result: Optional[Dict[str, Any]] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    stages: Dict[str, float] = field(default_factory=dict)
+    _stage_lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """记录一个处理阶段的耗时（秒），同名阶段累加；可在多个写库线程中并发调用"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._stage_lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JOB_DONE, JOB_FAILED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "material_id": self.material_id,
+            "user_id": self.user_id,
+            "filename": self.filename,
+            "error": self.error,
+            "result": self.result,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queue_seconds": (self.started_at - self.created_at) if self.started_at else None,
+            "stages": {name: round(seconds, 4) for name, seconds in list(self.stages.items())},
+        }
+
+
+class MongoJobStore:
+    """任务状态表 {_id: job_id, status, ..., expires_at}（同步集合，在线程中调用）
+
+    expires_at 上的 TTL 索引在任务结束 retention_seconds 后删除记录；排队 / 运行中的
+    记录按 max(retention_seconds, 1 天) 过期，进程被强制杀掉时也不会永久残留。
+    """
+
+    def __init__(self, collection: Any, *, retention_seconds: float = 3600.0) -> None:
+        self._collection = collection
+        self._retention_seconds = retention_seconds
+        self._index_ready = False
+
+    def save(self, job: IngestionJob) -> None:
+        self._ensure_index()
+        record = job.to_dict()
+        job_id = record.pop("job_id")
+        keep = self._retention_seconds if job.finished else max(self._retention_seconds, 86400.0)
+        record["expires_at"] = datetime.now(timezone.utc) + timedelta(seconds=keep)
+        self._collection.replace_one({"_id": job_id}, record, upsert=True)
+
+    def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        record = self._collection.find_one({"_id": job_id}, {"expires_at": 0})
+        if record is None:
+            return None
+        return {"job_id": record.pop("_id"), **record}
+
+    def _ensure_index(self) -> None:
+        if self._index_ready:
+            return
+        self._collection.create_index("expires_at", expireAfterSeconds=0)
+        self._index_ready = True
+
+
+class IngestionQueue:
+    """有界线程池 + 内存任务表（可选 MongoDB 持久化任务状态）
+
+    `max_pending` 限制排队和运行中的任务总数，超出时 `submit` 抛出 QueueFullError，
+    已结束的任务在 `retention_seconds` 之后从任务表中清除。本进程的任务直接读内存
+    （含实时的阶段耗时），其他 worker 或重启前提交的任务从 store 读取。
+    """
+
+    def __init__(
+        self,
+        *,
+        workers: int,
+        max_pending: int,
+        retention_seconds: float = 3600.0,
+        store: Optional[MongoJobStore] = None,
+    ) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="rag-ingest")
+        self._max_pending = max(1, max_pending)
+        self._retention_seconds = retention_seconds
+        self._store = store
+        self._jobs: Dict[str, IngestionJob] = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        handler: Callable[[IngestionJob], Dict[str, Any]],
+        *,
+        material_id: str,
+        user_id: str,
+        filename: str,
+    ) -> IngestionJob:
+        with self._lock:
+            self._prune_locked()
+            if self._pending >= self._max_pending:
+                raise QueueFullError(f"Ingestion queue is full ({self._max_pending} jobs pending)")
+
+            job = IngestionJob(
+                job_id=uuid.uuid4().hex,
+                material_id=material_id,
+                user_id=user_id,
+                filename=filename,
+            )
+            self._jobs[job.job_id] = job
+            self._pending += 1
+
+        # 先持久化再执行：客户端拿到 job_id 后立即轮询其他 worker 也能查到
+        self._save(job)
+        self._executor.submit(self._run, job, handler)
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """任务状态字典；不在本进程时查 store（阻塞调用）"""
+        job = self.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if self._store is None:
+            return None
+        return self._store.load(job_id)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counts = {JOB_QUEUED: 0, JOB_RUNNING: 0, JOB_DONE: 0, JOB_FAILED: 0}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            counts["pending"] = self._pending
+            counts["capacity"] = self._max_pending
+            return counts
+
+    def shutdown(self, wait: bool = False) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        if wait:
+            return
+        # 排队中的任务已取消，运行中的任务随进程退出中断：记为失败，由客户端重新提交
+        with self._lock:
+            unfinished: List[IngestionJob] = [job for job in self._jobs.values() if not job.finished]
+        for job in unfinished:
+            job.error = "Ingestion was interrupted by a service shutdown; please retry"
+            job.status = JOB_FAILED
+            job.finished_at = time.time()
+            self._save(job)
+
+    def _run(self, job: IngestionJob, handler: Callable[[IngestionJob], Dict[str, Any]]) -> None:
+        if job.finished:
+            return
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        self._save(job)
+        try:
+            job.result = handler(job)
+            job.status = JOB_DONE
+        except Exception as err:
+            job.error = str(err) or err.__class__.__name__
+            job.status = JOB_FAILED
+            metrics.log(
+                "rag.ingest.job_failed",
+                level=logging.ERROR,
+                job_id=job.job_id,
+                material_id=job.material_id,
+                error=job.error,
+            )
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._pending -= 1
+            self._save(job)
+
+    def _save(self, job: IngestionJob) -> None:
+        if self._store is None:
+            return
+        try:
+            self._store.save(job)
+        except Exception as err:
+            # 持久化失败不影响任务本身，本进程仍可查询
+            metrics.log("rag.ingest.job_store_failed", level=logging.WARNING, job_id=job.job_id, error=str(err))
+
+    def _prune_locked(self) -> None:
+        cutoff = time.time() - self._retention_seconds
+        expired = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.finished and job.finished_at is not None and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
@@ -0,0 +1,376 @@
+"""进程内 BM25 倒排索引与混合检索（BM25 + 向量，倒数排名融合）
+
+每个用户一个 UserLexicalIndex：倒排表按词项记录 (文档行号, 词频)，每行记录所属
+material；检索时先按词项累加 BM25 分数，再按 material 过滤。process_document
+写入 chunk 后增量追加；进程重启后第一次检索时从 MongoDB 的 chunk 文本重建。
+
+倒排表以 Python 列表追加，检索前按需冻结为 numpy 数组，单次查询只触及问题里
+出现的词项，几千到几万个 chunk 的用户也在亚毫秒级完成。
+"""
+from __future__ import annotations
+
+import asyncio
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core import QueryBundle
+from llama_index.core.schema import NodeWithScore
+
+from ingestion import DOCUMENT_ID_KEY
+from vector_backends import PrivateScopes, hydrate_nodes, row_key, top_k_indices
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 已删除行的 material 编号（倒排表不回收，检索时屏蔽）
+DELETED_ROW = -1
+
+# 拉丁字母 / 数字 / 标识符（保留 snake_case 与 a.b 形式），以及连续的中日韩字符
+_CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af"
+_WORD_RE = re.compile(rf"[a-z0-9_]+(?:\.[a-z0-9_]+)*|[{_CJK_CHARS}]+")
+_CJK_RE = re.compile(rf"[{_CJK_CHARS}]")
+
+
+def tokenize(text: str) -> List[str]:
+    """英文按词切分；中日韩文本没有空格，按单字 + 相邻双字切分"""
+    tokens: List[str] = []
+    for match in _WORD_RE.finditer(text.lower()):
+        word = match.group()
+        if _CJK_RE.match(word):
+            tokens.extend(word)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+            if "." in word or "_" in word:
+                tokens.extend(part for part in re.split(r"[._]", word) if part)
+    return tokens
+
+
+class _Postings:
+    __slots__ = ("rows", "freqs", "frozen")
+
+    def __init__(self) -> None:
+        self.rows: List[int] = []
+        self.freqs: List[int] = []
+        # (行号数组, 已按文档长度归一化的词频权重, 冻结时的索引版本)
+        self.frozen: Optional[Tuple[np.ndarray, np.ndarray, int]] = None
+
+    def weights(self, lengths: np.ndarray, average_length: float, version: int) -> Tuple[np.ndarray, np.ndarray]:
+        """BM25 的词频部分只依赖文档长度，随索引版本缓存，查询时只需乘 idf"""
+        if self.frozen is None or self.frozen[2] != version:
+            rows = np.asarray(self.rows, dtype=np.int64)
+            freqs = np.asarray(self.freqs, dtype=np.float32)
+            norm = BM25_K1 * (1.0 - BM25_B + BM25_B * lengths[rows] / average_length)
+            self.frozen = (rows, freqs * (BM25_K1 + 1.0) / (freqs + norm), version)
+        return self.frozen[0], self.frozen[1]
+
+
+class UserLexicalIndex:
+    """单个用户的 BM25 索引，文档行号按写入顺序递增"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._postings: Dict[str, _Postings] = {}
+        self._ids: List[Any] = []
+        self._id_rows: Dict[Any, int] = {}
+        self._material_codes: Dict[str, int] = {}
+        self._row_materials: List[int] = []
+        self._row_lengths: List[int] = []
+        self._total_length = 0
+        self._deleted_rows = 0
+        # 每次增删行时递增：缓存的词频权重依赖平均文档长度，增删后都要重算
+        self._version = 0
+        self._frozen_rows: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self.loaded = False
+        self.loaded_at = 0.0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, ids: Sequence[Any], material_ids: Sequence[str], texts: Sequence[str]) -> int:
+        added = 0
+        with self._lock:
+            for doc_id, material_id, text in zip(ids, material_ids, texts):
+                if doc_id in self._id_rows:
+                    continue
+                terms = Counter(tokenize(text or ""))
+                row = len(self._ids)
+                self._ids.append(doc_id)
+                self._id_rows[doc_id] = row
+                code = self._material_codes.setdefault(str(material_id), len(self._material_codes))
+                self._row_materials.append(code)
+                length = sum(terms.values())
+                self._row_lengths.append(length)
+                self._total_length += length
+                for term, freq in terms.items():
+                    postings = self._postings.get(term)
+                    if postings is None:
+                        postings = self._postings[term] = _Postings()
+                    postings.rows.append(row)
+                    postings.freqs.append(freq)
+                added += 1
+            if added:
+                self._version += 1
+        return added
+
+    def remove(self, ids: Sequence[Any]) -> int:
+        removed = 0
+        with self._lock:
+            for doc_id in ids:
+                row = self._id_rows.pop(doc_id, None)
+                if row is None:
+                    continue
+                self._row_materials[row] = DELETED_ROW
+                self._total_length -= self._row_lengths[row]
+                removed += 1
+            if removed:
+                self._deleted_rows += removed
+                self._version += 1
+                self._frozen_rows = None
+        return removed
+
+    def search(
+        self,
+        query: str,
+        *,
+        material_ids: Optional[Sequence[str]],
+        top_k: int,
+    ) -> List[Tuple[Any, float]]:
+        terms = set(tokenize(query))
+        with self._lock:
+            rows_count = len(self._ids)
+            if not terms or rows_count == 0 or top_k <= 0:
+                return []
+            lengths, materials = self._row_arrays()
+            live_rows = rows_count - self._deleted_rows
+            if live_rows <= 0:
+                return []
+            average_length = (self._total_length / live_rows) or 1.0
+            live = materials != DELETED_ROW if self._deleted_rows else None
+
+            accumulated = np.zeros(rows_count, dtype=np.float32)
+            matched = False
+            for term in terms:
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                rows, weights = postings.weights(lengths, average_length, self._version)
+                # 文档频率只计未删除的行
+                frequency = int(np.count_nonzero(live[rows])) if live is not None else rows.shape[0]
+                if frequency == 0:
+                    continue
+                idf = math.log(1.0 + (live_rows - frequency + 0.5) / (frequency + 0.5))
+                accumulated[rows] += idf * weights
+                matched = True
+
+            if not matched:
+                return []
+            if live is not None:
+                accumulated[~live] = 0.0
+            if material_ids:
+                codes = [self._material_codes[m] for m in material_ids if m in self._material_codes]
+                if not codes:
+                    return []
+                accumulated[~np.isin(materials, codes)] = 0.0
+            candidates = np.flatnonzero(accumulated)
+            if candidates.size == 0:
+                return []
+
+            candidate_scores = accumulated[candidates]
+            best = top_k_indices(candidate_scores, top_k)
+            ids = self._ids
+            return [(ids[int(candidates[i])], float(candidate_scores[i])) for i in best]
+
+    def _row_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        # remove() 会把缓存置空；追加行时按行数判断是否过期
+        if self._frozen_rows is None or self._frozen_rows[0].shape[0] != len(self._ids):
+            self._frozen_rows = (
+                np.asarray(self._row_lengths, dtype=np.float32),
+                np.asarray(self._row_materials, dtype=np.int32),
+            )
+        return self._frozen_rows
+
+
+class LexicalIndexStore:
+    """按用户保存 BM25 索引（LRU，超过 max_users 时淘汰最久未用的用户，下次检索重建）
+
+    本进程的写入经 add_nodes / remove_ids 同步；其他 worker 写入或删除的 chunk 只能靠重建
+    看到，索引载入超过 ttl_seconds 后下次检索从 MongoDB 重新构建。
+    """
+
+    def __init__(
+        self,
+        collection: Any,
+        *,
+        max_users: int = 256,
+        ttl_seconds: float = 300.0,
+        text_key: str = "text",
+        scopes: Optional[PrivateScopes] = None,
+    ) -> None:
+        self._collection = collection
+        self._scopes = scopes or PrivateScopes()
+        self._max_users = max(1, max_users)
+        self._ttl_seconds = ttl_seconds
+        self._text_key = text_key
+        self._indexes: "OrderedDict[str, UserLexicalIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, asyncio.Lock] = {}
+
+    def add_nodes(self, user_id: str, nodes: Sequence[Any]) -> int:
+        """摄取线程回调；用户索引还没载入时跳过，首次检索会从 MongoDB 完整构建"""
+        with self._lock:
+            index = self._indexes.get(user_id)
+        if index is None or not nodes:
+            return 0
+        return index.add(
+            [node.node_id for node in nodes],
+            [row_key(node.metadata) for node in nodes],
+            [node.get_content() for node in nodes],
+        )
+
+    def remove_ids(self, user_id: str, ids: Sequence[Any]) -> int:
+        """删除 chunk 后同步屏蔽；索引正在载入时直接丢弃，下次检索重新载入"""
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None and not index.loaded:
+                del self._indexes[user_id]
+                return 0
+        if index is None or not ids:
+            return 0
+        return index.remove([str(doc_id) for doc_id in ids])
+
+    async def search(
+        self,
+        user_id: str,
+        query: str,
+        *,
+        material_ids: Optional[Sequence[str]],
+        top_k: int,
+    ) -> List[Tuple[Any, float]]:
+        index = await self._user_index(user_id)
+        keys = await self._scopes.row_keys(user_id, material_ids)
+        return index.search(query, material_ids=keys, top_k=top_k)
+
+    async def _user_index(self, user_id: str) -> UserLexicalIndex:
+        index = self._fresh_index(user_id)
+        if index is not None:
+            return index
+
+        lock = self._load_locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            index = self._fresh_index(user_id)
+            if index is None:
+                with self._lock:
+                    index = self._indexes.get(user_id)
+                    if index is None:
+                        index = UserLexicalIndex()
+                        # 先登记再载入，载入期间写入的新 chunk 也会进入索引（按 _id 去重）
+                        self._indexes[user_id] = index
+                        while len(self._indexes) > self._max_users:
+                            self._indexes.popitem(last=False)
+                await self._load(user_id, index)
+                index.loaded_at = time.monotonic()
+                index.loaded = True
+            # 仍在等待这把锁的协程进入后会直接拿到已载入的索引
+            self._load_locks.pop(user_id, None)
+        return index
+
+    def _fresh_index(self, user_id: str) -> Optional[UserLexicalIndex]:
+        """已载入且未过期的索引；过期的索引直接丢弃，由调用方重新载入"""
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is None or not index.loaded:
+                return None
+            if time.monotonic() - index.loaded_at > self._ttl_seconds:
+                del self._indexes[user_id]
+                return None
+            self._indexes.move_to_end(user_id)
+            return index
+
+    async def _load(self, user_id: str, index: UserLexicalIndex) -> None:
+        cursor = self._collection.find(
+            await self._scopes.user_filter(user_id),
+            {self._text_key: 1, "metadata.material_id": 1, f"metadata.{DOCUMENT_ID_KEY}": 1},
+        )
+        ids: List[Any] = []
+        material_ids: List[str] = []
+        texts: List[str] = []
+        async for doc in cursor:
+            ids.append(str(doc["_id"]))
+            material_ids.append(row_key(doc.get("metadata") or {}))
+            texts.append(doc.get(self._text_key) or "")
+        if ids:
+            await asyncio.to_thread(index.add, ids, material_ids, texts)
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Any]], *, k: int = 60) -> List[Tuple[Any, float]]:
+    fused: Dict[Any, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+class HybridBackend:
+    """向量检索与 BM25 各取 top_k × candidate_factor 个候选，用 RRF 融合排序
+
+    只由 BM25 命中的 chunk 再按 `_id` 从 MongoDB 取回文本；返回节点的 score 保留
+    向量相似度（仅词法命中的为 None），顺序以融合结果为准。
+    """
+
+    def __init__(
+        self,
+        inner: Any,
+        lexical: LexicalIndexStore,
+        collection: Any,
+        *,
+        rrf_k: int = 60,
+        candidate_factor: int = 2,
+        text_key: str = "text",
+    ) -> None:
+        self._inner = inner
+        self._lexical = lexical
+        self._collection = collection
+        self._rrf_k = rrf_k
+        self._candidate_factor = max(1, candidate_factor)
+        self._text_key = text_key
+
+    @property
+    def inner(self) -> Any:
+        return self._inner
+
+    @property
+    def lexical(self) -> LexicalIndexStore:
+        return self._lexical
+
+    async def search(
+        self,
+        query_bundle: QueryBundle,
+        *,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+    ) -> List[NodeWithScore]:
+        candidate_k = top_k * self._candidate_factor
+        vector_nodes, lexical_hits = await asyncio.gather(
+            self._inner.search(query_bundle, user_id=user_id, material_ids=material_ids, top_k=candidate_k),
+            self._lexical.search(user_id, query_bundle.query_str, material_ids=material_ids, top_k=candidate_k),
+        )
+        if not lexical_hits:
+            return vector_nodes[:top_k]
+
+        nodes_by_id = {node.node.node_id: node for node in vector_nodes}
+        fused = reciprocal_rank_fusion(
+            [list(nodes_by_id), [str(doc_id) for doc_id, _ in lexical_hits]],
+            k=self._rrf_k,
+        )[:top_k]
+
+        missing = [(doc_id, None) for doc_id, _ in fused if doc_id not in nodes_by_id]
+        if missing:
+            for node in await hydrate_nodes(self._collection, missing, text_key=self._text_key):
+                nodes_by_id[node.node.node_id] = node
+        return [nodes_by_id[doc_id] for doc_id, _ in fused if doc_id in nodes_by_id]
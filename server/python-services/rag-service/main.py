@@ -4,9 +4,13 @@ RAG 服务 - 主入口
 """
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
+import asyncio
+import os
 import sys
+import tempfile
 from pathlib import Path
 
 # 添加当前服务目录和 shared 目录到 Python 路径，确保可作为脚本运行
@@ -18,8 +22,15 @@ for extra_path in (service_dir, python_services_dir):
     if path_str not in sys.path:
         sys.path.append(path_str)
 
+from prometheus_client import REGISTRY
+
 from shared.config import settings
-from service import rag_pipeline
+from shared.metrics import metrics_response
+from shared.sse import format_sse
+from instrumentation import RagStatsCollector
+from service import metrics, project_sources, rag_pipeline
+from jobs import IngestionJob, IngestionQueue, MongoJobStore, QueueFullError
+from shared.mongodb import MongoDBClient
 
 # 创建 FastAPI 应用
 app = FastAPI(
@@ -37,6 +48,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# /metrics 抓取时读取各缓存的命中统计与摄取 embedding token 数
+REGISTRY.register(RagStatsCollector(
+    metrics.service,
+    rag_pipeline.cache_stats,
+    embedding_model=settings.OPENAI_EMBEDDING_MODEL,
+))
+
+# 后台摄取队列：解析 / 向量化 / 写库不占用事件循环；任务状态存 MongoDB，任意 worker 都能查询
+ingestion_queue = IngestionQueue(
+    workers=settings.RAG_INGEST_WORKERS,
+    max_pending=settings.RAG_INGEST_MAX_PENDING,
+    retention_seconds=settings.RAG_INGEST_JOB_RETENTION,
+    store=MongoJobStore(
+        MongoDBClient.get_database(settings.MONGODB_VECTOR_DB)[settings.RAG_INGEST_JOBS_COLLECTION],
+        retention_seconds=settings.RAG_INGEST_JOB_RETENTION,
+    ),
+)
+
+
+# 向量索引的创建 / 校验在后台进行，不阻塞启动；/ready 在索引可查询后才返回 200
+search_index_task: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def provision_search_index():
+    global search_index_task
+    search_index_task = asyncio.create_task(rag_pipeline.ensure_search_index())
+
+
+@app.on_event("shutdown")
+def shutdown_ingestion_queue():
+    if search_index_task is not None:
+        search_index_task.cancel()
+    ingestion_queue.shutdown()
+    rag_pipeline.shutdown()
+
 
 # ===== 数据模型 =====
 
@@ -52,6 +99,25 @@ class QueryRequest(BaseModel):
     material_ids: Optional[List[str]] = None
     user_id: str
     top_k: int = 5
+    include_metadata: bool = True  # False 时 sources 不含 metadata
+    fields: Optional[List[str]] = None  # 只返回这些 metadata 键，如 ["filename", "page_label"]
+
+
+class BatchQueryRequest(BaseModel):
+    """批量 RAG 查询请求（同一用户 / 材料范围下的多个问题）"""
+    questions: List[str]
+    material_ids: Optional[List[str]] = None
+    user_id: str
+    top_k: int = 5
+    synthesize: bool = True  # False 时只检索，不调用 LLM
+    include_metadata: bool = True
+    fields: Optional[List[str]] = None
+
+
+class CompactRequest(BaseModel):
+    """清理请求：去除重复 chunk；给出 keep_material_ids 时删除其余材料的孤立 chunk"""
+    user_id: str
+    keep_material_ids: Optional[List[str]] = None
 
 
 class QueryResponse(BaseModel):
@@ -61,6 +127,34 @@ class QueryResponse(BaseModel):
     confidence: float
 
 
+class RetrieveResponse(BaseModel):
+    """纯检索响应（不含 LLM 生成的答案）"""
+    sources: List[dict]
+
+
+# ===== 工具函数 =====
+
+UPLOAD_SPOOL_CHUNK_BYTES = 1024 * 1024
+
+
+async def spool_upload(file: UploadFile, *, suffix: str) -> str:
+    """把上传内容分块写入临时文件，避免整个 PDF 常驻内存"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
+        while True:
+            chunk = await file.read(UPLOAD_SPOOL_CHUNK_BYTES)
+            if not chunk:
+                break
+            tmp_file.write(chunk)
+        return tmp_file.name
+
+
+def remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
 # ===== API 端点 =====
 
 @app.get("/health")
@@ -73,27 +167,46 @@ async def health_check():
     }
 
 
-@app.post("/process")
+@app.get("/ready")
+async def readiness_check():
+    """就绪检查：向量索引确认存在、定义匹配且可查询之前返回 503（附带索引状态与问题）"""
+    status = rag_pipeline.search_index_status()
+    if status["blocking"]:
+        raise HTTPException(status_code=503, detail=status)
+    return {"status": "ready", "search_index": status}
+
+
+@app.post("/process", status_code=202)
 async def process_document(
     file: UploadFile = File(...),
     material_id: str = Form(...),
     user_id: str = Form(...)
 ):
     """
-    处理上传的 PDF 文件
+    提交 PDF 处理任务（立即返回 job_id）
     - 提取文本
     - 切分文档
     - 向量化
     - 存储到 MongoDB Vector Store
+    进度通过 GET /process/{job_id} 查询
     """
-    try:
-        file_bytes = await file.read()
-        result = await rag_pipeline.process_document(
-            file_bytes=file_bytes,
-            filename=file.filename or "document.pdf",
-            material_id=material_id,
-            user_id=user_id,
-        )
+    filename = file.filename or "document.pdf"
+    tmp_file_path = await spool_upload(file, suffix=os.path.splitext(filename)[1] or ".pdf")
+    if os.path.getsize(tmp_file_path) == 0:
+        remove_quietly(tmp_file_path)
+        raise HTTPException(status_code=400, detail="Empty file content")
+
+    def run(job: IngestionJob) -> dict:
+        try:
+            result = rag_pipeline.process_document(
+                file_path=tmp_file_path,
+                filename=filename,
+                material_id=material_id,
+                user_id=user_id,
+                stage=job.stage,
+            )
+        finally:
+            remove_quietly(tmp_file_path)
 
         return {
             "status": "success",
@@ -102,9 +215,93 @@ async def process_document(
             "filename": result.filename,
             "documents": result.document_count,
             "chunk_size": result.chunk_count,
+            "new_chunks": result.new_chunks,
+            "removed_chunks": result.removed_chunks,
         }
+
+    try:
+        job = await asyncio.to_thread(
+            ingestion_queue.submit,
+            run,
+            material_id=material_id,
+            user_id=user_id,
+            filename=filename,
+        )
+    except QueueFullError as e:
+        remove_quietly(tmp_file_path)
+        raise HTTPException(status_code=503, detail=str(e))
+
+    return {
+        "status": job.status,
+        "job_id": job.job_id,
+        "material_id": material_id,
+        "user_id": user_id,
+        "filename": filename,
+    }
+
+
+@app.get("/process/{job_id}")
+async def process_status(job_id: str):
+    """查询 PDF 处理任务状态（queued / running / done / failed）及各阶段耗时
+
+    任务可能由其他 worker 执行，或在服务重启前提交：本进程查不到时读 MongoDB 中的任务记录
+    """
+    try:
+        status = await asyncio.to_thread(ingestion_queue.status, job_id)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Job status store unavailable: {e}")
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return status
+
+
+@app.delete("/materials/{material_id}")
+async def delete_material(material_id: str, user_id: str):
+    """删除材料在向量库中的全部 chunk（批量删除，并同步进程内索引与缓存）"""
+    try:
+        deleted = await asyncio.to_thread(
+            rag_pipeline.delete_material,
+            user_id=user_id,
+            material_id=material_id,
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "status": "success",
+        "material_id": material_id,
+        "user_id": user_id,
+        "deleted_chunks": deleted,
+    }
+
+
+@app.post("/compact")
+async def compact_vectors(request: CompactRequest):
+    """
+    清理用户的向量数据
+    - 删除同一材料内内容重复的 chunk
+    - 给出 keep_material_ids 时，删除不在其中的材料留下的孤立 chunk
+    """
+    try:
+        removed = await asyncio.to_thread(
+            rag_pipeline.compact,
+            user_id=request.user_id,
+            keep_material_ids=request.keep_material_ids,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "success", "user_id": request.user_id, **removed}
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """缓存命中 / 未命中计数"""
+    return rag_pipeline.cache_stats()
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 指标：各阶段耗时直方图、token 与缓存命中计数"""
+    return metrics_response()
 
 
 @app.post("/query", response_model=QueryResponse)
@@ -122,12 +319,107 @@ async def query_documents(request: QueryRequest):
             material_ids=request.material_ids,
             top_k=request.top_k,
         )
+        payload["sources"] = project_sources(
+            payload["sources"],
+            include_metadata=request.include_metadata,
+            fields=request.fields,
+        )
 
         return QueryResponse(**payload)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/query/stream")
+async def stream_query_documents(request: QueryRequest):
+    """
+    流式 RAG 查询（Server-Sent Events）
+    - event: sources  检索完成后立即返回来源片段
+    - event: token    逐段返回答案
+    - event: metadata 完整答案与置信度
+    - event: error    处理失败
+    """
+    stream = rag_pipeline.stream_query(
+        question=request.question,
+        user_id=request.user_id,
+        material_ids=request.material_ids,
+        top_k=request.top_k,
+        include_metadata=request.include_metadata,
+        fields=request.fields,
+    )
+    return StreamingResponse(stream, media_type="text/event-stream")
+
+
+@app.post("/query/batch")
+async def batch_query_documents(request: BatchQueryRequest):
+    """
+    批量 RAG 查询（Server-Sent Events）
+    - 全部问题一次批量向量化
+    - 检索 / 合成并发执行（RAG_BATCH_*_CONCURRENCY 限流）
+    - 每个问题完成即返回 event: result（带 index），失败的问题返回 event: error
+    - 全部完成后返回 event: done
+    """
+    if len(request.questions) > settings.RAG_BATCH_MAX_QUESTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.RAG_BATCH_MAX_QUESTIONS} questions per batch",
+        )
+
+    async def stream():
+        completed = failed = 0
+        try:
+            async for result in rag_pipeline.query_many(
+                questions=request.questions,
+                user_id=request.user_id,
+                material_ids=request.material_ids,
+                top_k=request.top_k,
+                synthesize=request.synthesize,
+            ):
+                if "error" in result:
+                    failed += 1
+                    yield format_sse("error", result)
+                else:
+                    completed += 1
+                    if "sources" in result:
+                        result["sources"] = project_sources(
+                            result["sources"],
+                            include_metadata=request.include_metadata,
+                            fields=request.fields,
+                        )
+                    yield format_sse("result", result)
+        except Exception as e:
+            yield format_sse("error", {"detail": str(e)})
+        yield format_sse("done", {"completed": completed, "failed": failed})
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+@app.post("/retrieve", response_model=RetrieveResponse)
+async def retrieve_documents(request: QueryRequest):
+    """
+    纯语义检索
+    - 向量化问题
+    - 返回排序后的片段、分数和元数据
+    - 不调用 LLM 生成答案
+    """
+    try:
+        payload = await rag_pipeline.retrieve(
+            question=request.question,
+            user_id=request.user_id,
+            material_ids=request.material_ids,
+            top_k=request.top_k,
+        )
+        payload["sources"] = project_sources(
+            payload["sources"],
+            include_metadata=request.include_metadata,
+            fields=request.fields,
+        )
+
+        return RetrieveResponse(**payload)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 # ===== 启动服务 =====
 
 if __name__ == "__main__":
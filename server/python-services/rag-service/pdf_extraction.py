@@ -0,0 +1,164 @@
+"""多进程 PDF 文本提取
+
+pypdf 的 `extract_text` 是纯 Python 实现，受 GIL 限制，几百页的讲义在单核上
+逐页提取是 `/process` 的主要耗时。PdfPageExtractor 把页码按区间分给进程池，
+每个工作进程自己打开 PDF（同一文件的 reader 在进程内复用），结果按页序逐页产出，
+下游的切分 / 向量化可以在后续区间提取时就开始。
+
+单页提取失败时依次尝试 pdfplumber、空文本；整个区间失败（工作进程崩溃等）时
+在当前线程逐页重新提取，不会让整份材料失败。
+"""
+from __future__ import annotations
+
+import math
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Deque, Iterator, List, Optional, Tuple
+
+from pypdf import PdfReader
+
+from pdf_worker import PageText, extract_page_range, extract_pages
+
+# 默认进程数上限：容器的 CPU 配额通常只有 0.5 ~ 2 核，多开进程只会增加内存占用
+DEFAULT_MAX_WORKERS = 2
+
+
+def available_cpus() -> int:
+    """可用的 CPU 数：优先按 cgroup CPU 配额计算（os.cpu_count() 返回的是宿主机核数）"""
+    count = os.cpu_count() or 1
+    try:
+        count = min(count, len(os.sched_getaffinity(0)))
+    except (AttributeError, OSError):
+        pass
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        count = min(count, max(1, math.ceil(quota)))
+    return count
+
+
+def _cgroup_cpu_quota() -> Optional[float]:
+    try:
+        # cgroup v2："<quota> <period>" 或 "max <period>"
+        with open("/sys/fs/cgroup/cpu.max", encoding="ascii") as handle:
+            quota, period = handle.read().split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", encoding="ascii") as handle:
+            quota_us = int(handle.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", encoding="ascii") as handle:
+            period_us = int(handle.read())
+        return None if quota_us <= 0 else quota_us / period_us
+    except (OSError, ValueError):
+        return None
+
+
+class PdfPageExtractor:
+    """按页区间并行提取 PDF 文本的共享进程池（所有摄取线程共用，总并行度由 workers 限制）
+
+    workers <= 1 或页数少于 min_pages 时在调用线程内逐页提取，避免小文件的进程间开销。
+    进程池在第一次需要并行提取时才创建。
+    """
+
+    def __init__(self, *, workers: int = 0, pages_per_task: int = 8, min_pages: int = 24) -> None:
+        self._workers = workers if workers > 0 else min(DEFAULT_MAX_WORKERS, available_cpus())
+        self._pages_per_task = max(1, pages_per_task)
+        self._min_pages = max(1, min_pages)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @property
+    def parallel(self) -> bool:
+        return self._workers > 1
+
+    def shutdown(self) -> None:
+        self._reset()
+
+    def extract(self, reader: PdfReader, file_path: str) -> Iterator[PageText]:
+        """按页序产出每页文本；reader 是调用方已打开的同一文件，用于串行路径和失败重试"""
+        page_count = len(reader.pages)
+        ranges = [
+            (start, min(start + self._pages_per_task, page_count))
+            for start in range(0, page_count, self._pages_per_task)
+        ]
+        if not self.parallel or page_count < self._min_pages:
+            for start, stop in ranges:
+                yield from extract_pages(reader, file_path, start, stop)
+            return
+
+        # 有界提交窗口：已提取但还没被下游消费的页数不超过 2 × workers 个区间
+        window = 2 * self._workers
+        pending: Deque[Tuple[int, int, Optional[Future]]] = deque()
+        remaining = iter(ranges)
+        try:
+            while True:
+                while len(pending) < window:
+                    next_range = next(remaining, None)
+                    if next_range is None:
+                        break
+                    pending.append((*next_range, self._submit(file_path, *next_range)))
+                if not pending:
+                    return
+                start, stop, future = pending.popleft()
+                yield from self._range_result(reader, file_path, start, stop, future)
+        finally:
+            for _, _, future in pending:
+                if future is not None:
+                    future.cancel()
+
+    def _submit(self, file_path: str, start: int, stop: int) -> Optional[Future]:
+        try:
+            return self._executor().submit(extract_page_range, file_path, start, stop)
+        except (BrokenProcessPool, RuntimeError):
+            self._reset()
+            return None
+
+    def _range_result(
+        self,
+        reader: PdfReader,
+        file_path: str,
+        start: int,
+        stop: int,
+        future: Optional[Future],
+    ) -> List[PageText]:
+        if future is not None:
+            try:
+                return future.result()
+            except BrokenProcessPool:
+                self._reset()
+            except Exception:
+                pass
+        return extract_pages(reader, file_path, start, stop)
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self._workers, mp_context=_pool_context())
+            return self._pool
+
+    def _reset(self) -> None:
+        """工作进程异常退出后丢弃整个池，下一次提交时重建"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _pool_context() -> Any:
+    # 服务进程里已有 MongoClient 等后台线程，fork 可能继承被持有的锁而死锁；
+    # forkserver 的服务进程只预加载 pdf_worker（不导入 pymongo / llama_index），工作进程从它派生
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["pdf_worker"])
+        return context
+    return multiprocessing.get_context("spawn")
@@ -0,0 +1,53 @@
+"""PDF 提取进程池的工作进程入口
+
+工作进程由 forkserver / spawn 启动，只导入本模块（pypdf，pdfplumber 按需导入）；
+不要在这里导入 pymongo、llama_index 或服务内的其他模块。
+"""
+from __future__ import annotations
+
+import os
+from typing import List, Optional, Tuple
+
+from pypdf import PdfReader
+
+# (页文本, 是否提取成功)
+PageText = Tuple[str, bool]
+
+# 每个工作进程缓存最近打开的一份 PDF：(路径, mtime_ns, 大小) → PdfReader
+_reader_cache: Optional[Tuple[Tuple[str, int, int], PdfReader]] = None
+
+
+def _cached_reader(file_path: str) -> PdfReader:
+    global _reader_cache
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_mtime_ns, stat.st_size)
+    if _reader_cache is None or _reader_cache[0] != key:
+        _reader_cache = (key, PdfReader(file_path))
+    return _reader_cache[1]
+
+
+def _fallback_page_text(file_path: str, page_index: int) -> PageText:
+    """pypdf 无法解析的页面改用 pdfplumber（pdfminer）提取"""
+    try:
+        import pdfplumber
+
+        with pdfplumber.open(file_path, pages=[page_index + 1]) as pdf:
+            return pdf.pages[0].extract_text() or "", True
+    except Exception:
+        return "", False
+
+
+def extract_pages(reader: PdfReader, file_path: str, start: int, stop: int) -> List[PageText]:
+    """提取 [start, stop) 页，单页失败不影响其他页"""
+    texts: List[PageText] = []
+    for page_index in range(start, stop):
+        try:
+            texts.append((reader.pages[page_index].extract_text() or "", True))
+        except Exception:
+            texts.append(_fallback_page_text(file_path, page_index))
+    return texts
+
+
+def extract_page_range(file_path: str, start: int, stop: int) -> List[PageText]:
+    """工作进程入口"""
+    return extract_pages(_cached_reader(file_path), file_path, start, stop)
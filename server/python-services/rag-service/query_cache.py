@@ -0,0 +1,357 @@
+"""查询侧缓存
+
+- TTLCache：进程内 LRU + TTL
+- QueryEmbeddingCache：问题向量缓存，键为 (embedding 模型, 归一化问题文本)，
+  可选 MongoDB 共享层，让多个 uvicorn worker 共享命中结果
+- ResponseCache：完整 /query 响应缓存，相同请求并发时只计算一次（single-flight），
+  材料写入新 chunk 后相关条目失效（写入代号存于 MongoDB，所有 worker 同时生效）
+"""
+from __future__ import annotations
+
+import asyncio
+import copy
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Generic, List, Optional, Sequence, Tuple, TypeVar
+
+from pymongo import UpdateOne
+
+from instrumentation import metrics
+
+V = TypeVar("V")
+
+_MISSING = object()
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.split())
+
+
+class TTLCache(Generic[V]):
+    """线程安全的 LRU 缓存，条目在 ttl_seconds 后过期"""
+
+    def __init__(self, *, max_entries: int, ttl_seconds: float) -> None:
+        self._max_entries = max(1, max_entries)
+        self._ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Any, Tuple[float, V]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Any, value: V) -> None:
+        expires_at = time.monotonic() + self._ttl_seconds
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Any) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self._max_entries,
+            }
+
+
+class MongoQueryEmbeddingStore:
+    """基于 MongoDB TTL 索引的共享问题向量缓存（motor 异步客户端）"""
+
+    def __init__(self, collection: Any, *, ttl_seconds: float) -> None:
+        self._collection = collection
+        self._ttl_seconds = ttl_seconds
+        self._index_ready = False
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[List[float]]:
+        await self._ensure_index()
+        doc = await self._collection.find_one(
+            {"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+            {"embedding": 1},
+        )
+        if doc is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return list(doc["embedding"])
+
+    async def set(self, key: str, embedding: List[float]) -> None:
+        await self._ensure_index()
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self._ttl_seconds)
+        await self._collection.replace_one(
+            {"_id": key},
+            {"_id": key, "embedding": embedding, "expires_at": expires_at},
+            upsert=True,
+        )
+
+    async def _ensure_index(self) -> None:
+        if self._index_ready:
+            return
+        await self._collection.create_index("expires_at", expireAfterSeconds=0)
+        self._index_ready = True
+
+
+class QueryEmbeddingCache:
+    """问题向量两级缓存：进程内 LRU+TTL → 可选共享层 → 调用 embedding 模型"""
+
+    def __init__(
+        self,
+        *,
+        model_name: str,
+        max_entries: int,
+        ttl_seconds: float,
+        shared: Optional[MongoQueryEmbeddingStore] = None,
+    ) -> None:
+        self._model_name = model_name
+        self._local: TTLCache[List[float]] = TTLCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self._shared = shared
+
+    def key(self, question: str) -> str:
+        normalized = normalize_question(question)
+        return hashlib.sha256(f"{self._model_name}\0{normalized}".encode("utf-8")).hexdigest()
+
+    async def get_or_compute(
+        self,
+        question: str,
+        compute: Callable[[], Awaitable[List[float]]],
+    ) -> List[float]:
+        key = self.key(question)
+        embedding = self._local.get(key, _MISSING)
+        if embedding is not _MISSING:
+            return embedding
+
+        if self._shared is not None:
+            try:
+                shared_embedding = await self._shared.get(key)
+            except Exception as err:
+                metrics.log("rag.query_cache.shared_lookup_failed", level=logging.WARNING, error=str(err))
+                shared_embedding = None
+            if shared_embedding is not None:
+                self._local.set(key, shared_embedding)
+                return shared_embedding
+
+        embedding = await compute()
+        self._local.set(key, embedding)
+        if self._shared is not None:
+            try:
+                await self._shared.set(key, embedding)
+            except Exception as err:
+                metrics.log("rag.query_cache.shared_store_failed", level=logging.WARNING, error=str(err))
+        return embedding
+
+    async def get_or_compute_many(
+        self,
+        questions: List[str],
+        compute_many: Callable[[List[str]], Awaitable[List[List[float]]]],
+    ) -> List[List[float]]:
+        """批量版本：未命中的问题（去重后）合并为一次 embedding 请求"""
+        keys = [self.key(question) for question in questions]
+        found: Dict[str, List[float]] = {}
+        for key in keys:
+            embedding = self._local.get(key, _MISSING)
+            if embedding is not _MISSING:
+                found[key] = embedding
+
+        if self._shared is not None:
+            for key in dict.fromkeys(key for key in keys if key not in found):
+                try:
+                    shared_embedding = await self._shared.get(key)
+                except Exception as err:
+                    metrics.log("rag.query_cache.shared_lookup_failed", level=logging.WARNING, error=str(err))
+                    shared_embedding = None
+                if shared_embedding is not None:
+                    self._local.set(key, shared_embedding)
+                    found[key] = shared_embedding
+
+        missing = {key: question for key, question in zip(keys, questions) if key not in found}
+        if missing:
+            embeddings = await compute_many(list(missing.values()))
+            for key, embedding in zip(missing, embeddings):
+                found[key] = embedding
+                self._local.set(key, embedding)
+                if self._shared is not None:
+                    try:
+                        await self._shared.set(key, embedding)
+                    except Exception as err:
+                        metrics.log("rag.query_cache.shared_store_failed", level=logging.WARNING, error=str(err))
+
+        return [found[key] for key in keys]
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {"local": self._local.stats()}
+        if self._shared is not None:
+            stats["shared"] = {"hits": self._shared.hits, "misses": self._shared.misses}
+        return stats
+
+
+def user_scope(user_id: str) -> str:
+    """用户的全部按用户存储的 chunk"""
+    return f"user:{user_id}"
+
+
+def material_scope(user_id: str, material_id: str) -> str:
+    return f"material:{user_id}/{material_id}"
+
+
+def refs_scope(user_id: str) -> str:
+    """用户的材料引用表（共享存储下材料 → 文档的映射）"""
+    return f"refs:{user_id}"
+
+
+def document_scope(document_id: str) -> str:
+    """共享存储的文档（document_id 即文件 sha256），引用同一文件的用户共用"""
+    return f"document:{document_id}"
+
+
+class LocalCacheGenerations:
+    """进程内写入代号（单进程 / 测试使用）"""
+
+    def __init__(self) -> None:
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def bump(self, scopes: Sequence[str]) -> None:
+        with self._lock:
+            for scope in scopes:
+                self._generations[scope] = self._generations.get(scope, 0) + 1
+
+    async def current(self, scopes: Sequence[str]) -> Tuple[int, ...]:
+        with self._lock:
+            return tuple(self._generations.get(scope, 0) for scope in scopes)
+
+
+class MongoCacheGenerations:
+    """所有 worker 共用的写入代号：每个范围一条 {_id: scope, generation}
+
+    摄取线程写入 / 删除 chunk 后用同步集合 $inc，查询时用 motor 集合一次读出请求涉及的
+    全部范围。代号只增不减（文档记录删除后重建也不会回到旧值），旧条目不会被误命中。
+    """
+
+    def __init__(self, collection: Any, async_collection: Any) -> None:
+        self._collection = collection
+        self._async_collection = async_collection
+
+    def bump(self, scopes: Sequence[str]) -> None:
+        self._collection.bulk_write(
+            [UpdateOne({"_id": scope}, {"$inc": {"generation": 1}}, upsert=True) for scope in dict.fromkeys(scopes)],
+            ordered=False,
+        )
+
+    async def current(self, scopes: Sequence[str]) -> Tuple[int, ...]:
+        docs = await self._async_collection.find({"_id": {"$in": list(scopes)}}).to_list(length=None)
+        generations = {doc["_id"]: int(doc.get("generation", 0)) for doc in docs}
+        return tuple(generations.get(scope, 0) for scope in scopes)
+
+
+class ResponseCache:
+    """/query 完整响应缓存
+
+    键为 (内容范围, 各范围的写入代号, 归一化问题, top_k, 模型)。内容范围由 scopes 解析：
+    按用户存储时是 (用户, 材料)，共享存储时是材料引用的文档（文件哈希），引用同一份
+    文件的用户命中同一条目。process_document / 删除 chunk 时递增相关范围的代号（存于
+    MongoDB，所有 worker 可见），代号变化后旧键不再被查到，随 LRU / TTL 淘汰。
+    """
+
+    def __init__(
+        self,
+        *,
+        model_name: str,
+        max_entries: int,
+        ttl_seconds: float,
+        scopes: Any,
+        generations: Optional[Any] = None,
+    ) -> None:
+        self._model_name = model_name
+        self._scopes = scopes
+        self._generations = generations or LocalCacheGenerations()
+        self._entries: TTLCache[Dict[str, Any]] = TTLCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self._in_flight: Dict[Tuple[Any, ...], "asyncio.Task[Dict[str, Any]]"] = {}
+        self.coalesced = 0
+
+    async def key(
+        self,
+        *,
+        question: str,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+    ) -> Optional[Tuple[Any, ...]]:
+        """计算开始前解析内容范围并读取代号；代号读取失败时返回 None（本次不走缓存）"""
+        scopes = tuple(await self._scopes.cache_scopes(user_id, material_ids))
+        try:
+            generations = await self._generations.current(scopes)
+        except Exception as err:
+            metrics.log("rag.response_cache.generation_lookup_failed", level=logging.WARNING, error=str(err))
+            return None
+        return (scopes, generations, normalize_question(question), top_k, self._model_name)
+
+    def invalidate(self, scopes: Sequence[str]) -> None:
+        """摄取线程在写入 / 删除 chunk 后调用"""
+        self._generations.bump(scopes)
+
+    async def get_or_compute(
+        self,
+        key: Tuple[Any, ...],
+        compute: Callable[[], Awaitable[Dict[str, Any]]],
+    ) -> Dict[str, Any]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            return copy.deepcopy(entry)
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            # 计算放在独立任务里：发起请求的客户端断开时，其他等待者不受影响
+            task = asyncio.ensure_future(self._compute(key, compute))
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            self._in_flight[key] = task
+        return copy.deepcopy(await asyncio.shield(task))
+
+    async def _compute(self, key: Tuple[Any, ...], compute: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        try:
+            value = await compute()
+            self._entries.set(key, value)
+            return value
+        finally:
+            self._in_flight.pop(key, None)
+
+    def peek(self, key: Tuple[Any, ...]) -> Optional[Dict[str, Any]]:
+        """只读命中（不参与 single-flight），供流式查询直接回放缓存的答案"""
+        entry = self._entries.get(key)
+        return copy.deepcopy(entry) if entry is not None else None
+
+    def put(self, key: Tuple[Any, ...], value: Dict[str, Any]) -> None:
+        self._entries.set(key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self._entries.stats()
+        stats["coalesced"] = self.coalesced
+        stats["in_flight"] = len(self._in_flight)
+        return stats
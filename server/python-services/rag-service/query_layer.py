@@ -0,0 +1,40 @@
+"""可复用的检索 / 查询引擎层
+
+VectorStoreIndex 和响应合成器在进程内只构建一次；每次请求只创建轻量的
+VectorIndexRetriever，并在其上应用本次的 top_k 和 MetadataFilters。检索结果经
+上下文打包后直接交给合成器（见 RAGPipeline._synthesize），不经过 RetrieverQueryEngine。
+"""
+from __future__ import annotations
+
+from typing import Any, Optional
+
+from llama_index.core import Settings, VectorStoreIndex, get_response_synthesizer
+from llama_index.core.response_synthesizers import BaseSynthesizer
+from llama_index.core.retrievers import VectorIndexRetriever
+from llama_index.core.vector_stores import MetadataFilters
+
+
+class QueryLayer:
+    def __init__(self, vector_store: Any, *, llm: Optional[Any] = None) -> None:
+        self._index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
+        self._synthesizer = get_response_synthesizer(llm=llm or Settings.llm)
+        self._streaming_synthesizer = get_response_synthesizer(llm=llm or Settings.llm, streaming=True)
+
+    @property
+    def index(self) -> VectorStoreIndex:
+        return self._index
+
+    @property
+    def synthesizer(self) -> BaseSynthesizer:
+        return self._synthesizer
+
+    @property
+    def streaming_synthesizer(self) -> BaseSynthesizer:
+        return self._streaming_synthesizer
+
+    def retriever(self, *, top_k: int, filters: Optional[MetadataFilters] = None) -> VectorIndexRetriever:
+        return VectorIndexRetriever(
+            index=self._index,
+            similarity_top_k=top_k,
+            filters=filters,
+        )
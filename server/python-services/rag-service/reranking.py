@@ -0,0 +1,130 @@
+"""最大边际相关性（MMR）重排与合成前的上下文打包"""
+from __future__ import annotations
+
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from llama_index.core import QueryBundle
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from shared.context_packing import pack_sources
+from vector_backends import normalize_rows
+from vector_codec import vector_to_array
+
+
+def mmr_select(query: np.ndarray, candidates: np.ndarray, k: int, *, diversity_lambda: float = 0.5) -> List[int]:
+    """贪心 MMR：每轮选 λ·sim(q, d) − (1−λ)·max sim(d, 已选) 最大的候选
+
+    候选两两相似度一次矩阵乘算好，每轮只做一次向量化的 max 更新。
+    """
+    count = candidates.shape[0]
+    if count == 0 or k <= 0:
+        return []
+    relevance = candidates @ query
+    pairwise = candidates @ candidates.T
+
+    selected: List[int] = []
+    redundancy = np.full(count, -np.inf, dtype=np.float32)
+    available = np.ones(count, dtype=bool)
+    for _ in range(min(k, count)):
+        penalty = np.where(np.isneginf(redundancy), 0.0, redundancy)
+        scores = diversity_lambda * relevance - (1.0 - diversity_lambda) * penalty
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, pairwise[best])
+    return selected
+
+
+class MmrBackend:
+    """取 top_k × candidate_factor 个候选，读取其向量后用 MMR 选出 top_k 个互不重复的片段"""
+
+    def __init__(
+        self,
+        inner: Any,
+        collection: Any,
+        *,
+        diversity_lambda: float = 0.5,
+        candidate_factor: int = 3,
+        embedding_key: str = "embedding",
+    ) -> None:
+        self._inner = inner
+        self._collection = collection
+        self._diversity_lambda = diversity_lambda
+        self._candidate_factor = max(1, candidate_factor)
+        self._embedding_key = embedding_key
+
+    @property
+    def inner(self) -> Any:
+        return self._inner
+
+    async def search(
+        self,
+        query_bundle: QueryBundle,
+        *,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+    ) -> List[NodeWithScore]:
+        nodes = await self._inner.search(
+            query_bundle,
+            user_id=user_id,
+            material_ids=material_ids,
+            top_k=top_k * self._candidate_factor,
+        )
+        if len(nodes) <= top_k or query_bundle.embedding is None:
+            return nodes[:top_k]
+
+        ids = [node.node.node_id for node in nodes]
+        docs = await self._collection.find(
+            {"_id": {"$in": ids}},
+            {self._embedding_key: 1},
+        ).to_list(length=len(ids))
+        vectors_by_id = {
+            str(doc["_id"]): vector_to_array(doc[self._embedding_key])
+            for doc in docs
+            if doc.get(self._embedding_key) is not None
+        }
+        with_vectors = [node for node in nodes if node.node.node_id in vectors_by_id]
+        if len(with_vectors) <= top_k:
+            return nodes[:top_k]
+
+        matrix = normalize_rows(np.stack([vectors_by_id[node.node.node_id] for node in with_vectors]))
+        # 紧凑存储下库里是截断后的向量：问题向量同样截断到相同维度再归一化
+        query = np.asarray(query_bundle.embedding, dtype=np.float32)[: matrix.shape[1]]
+        query_norm = np.linalg.norm(query)
+        if query_norm:
+            query = query / query_norm
+        order = mmr_select(query, matrix, top_k, diversity_lambda=self._diversity_lambda)
+        return [with_vectors[index] for index in order]
+
+
+def pack_nodes(nodes: List[NodeWithScore], *, token_budget: int, model: Optional[str] = None) -> List[NodeWithScore]:
+    """合并同一材料中首尾重叠的片段，并在 token 预算内打包，作为 LLM 合成的上下文"""
+    if not nodes or token_budget <= 0:
+        return nodes
+
+    sources: List[Dict[str, Any]] = [
+        {"snippet": node.node.get_content(), "metadata": node.node.metadata, "score": node.score, "node": node}
+        for node in nodes
+    ]
+    packed = pack_sources(
+        sources,
+        token_budget=token_budget,
+        render=lambda _, source: source["snippet"],
+        model=model,
+        separator="\n\n",
+    )
+
+    packed_nodes: List[NodeWithScore] = []
+    for source in packed:
+        original: NodeWithScore = source["node"]
+        if source["snippet"] == original.node.get_content():
+            packed_nodes.append(original)
+            continue
+        packed_nodes.append(NodeWithScore(
+            node=TextNode(id_=original.node.node_id, text=source["snippet"], metadata=original.node.metadata),
+            score=original.score,
+        ))
+    return packed_nodes
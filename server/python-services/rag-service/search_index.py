@@ -0,0 +1,238 @@
+"""Atlas Vector Search 索引的创建、校验与就绪检查
+
+`$vectorSearch` 的 filter 只能使用在索引定义中声明为 `filter` 类型的字段；
+缺少 metadata.user_id / material_id / file_hash 时 Atlas 会拒绝带过滤的查询，
+检索只能走慢速回退路径。启动时 VectorIndexProvisioner 按当前配置生成索引定义：
+
+    vector   embedding（维度 = 截断后的维度或模型维度，相似度与量化方式匹配）
+    filter   metadata.user_id、metadata.material_id、metadata.file_hash
+
+create 模式下索引不存在时创建、定义不一致时更新，之后轮询 `$listSearchIndexes`
+直到索引状态为 READY 且可查询；verify 模式（默认）只校验，不修改索引。两种模式下
+`/ready` 都返回 503，直到确认索引存在、定义匹配且可查询——否则带过滤的 `$vectorSearch`
+会被拒绝或退化为后过滤。无法使用 Atlas 索引的部署显式设置 off 跳过检查。
+
+索引构建中时按 poll_seconds 轮询；缺失、定义不符或出错时轮询间隔逐次翻倍，
+最长 max_poll_seconds，等待运维修复期间不会持续高频调用 `$listSearchIndexes`。
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from pymongo.errors import CollectionInvalid, OperationFailure
+from pymongo.operations import SearchIndexModel
+
+from ingestion import DOCUMENT_ID_KEY
+from instrumentation import metrics
+
+INDEX_PROVISION_MODES = ("create", "verify", "off")
+# 这些状态表示索引正在创建 / 构建，短时间内会变为可查询，期间阻塞就绪
+TRANSIENT_STATUSES = ("pending", "creating", "updating", "building")
+SIMILARITY_FUNCTIONS = ("cosine", "dotProduct", "euclidean")
+
+FILTER_PATHS = ("metadata.user_id", "metadata.material_id", f"metadata.{DOCUMENT_ID_KEY}")
+
+# OpenAI embedding 模型的原生维度；其他模型在启动时实际计算一次探测文本得到
+OPENAI_EMBEDDING_DIMENSIONS = {
+    "text-embedding-3-large": 3072,
+    "text-embedding-3-small": 1536,
+    "text-embedding-ada-002": 1536,
+}
+
+
+def vector_index_definition(
+    *,
+    dimensions: int,
+    similarity: str,
+    embedding_key: str = "embedding",
+    filter_paths: Sequence[str] = FILTER_PATHS,
+) -> Dict[str, Any]:
+    return {
+        "fields": [
+            {"type": "vector", "path": embedding_key, "numDimensions": dimensions, "similarity": similarity},
+            *({"type": "filter", "path": path} for path in filter_paths),
+        ]
+    }
+
+
+def definition_problems(actual: Optional[Dict[str, Any]], expected: Dict[str, Any]) -> List[str]:
+    """列出现有定义与期望定义的差异（多出的 filter 字段不算差异）"""
+    if not actual:
+        return ["index definition is missing"]
+    fields = actual.get("fields") or []
+    problems: List[str] = []
+    for wanted in expected["fields"]:
+        if wanted["type"] == "filter":
+            if not any(field.get("type") == "filter" and field.get("path") == wanted["path"] for field in fields):
+                problems.append(f"{wanted['path']} is not declared as a filter field")
+            continue
+        vector = next(
+            (field for field in fields if field.get("type") == "vector" and field.get("path") == wanted["path"]),
+            None,
+        )
+        if vector is None:
+            problems.append(f"{wanted['path']} is not declared as a vector field")
+            continue
+        for key in ("numDimensions", "similarity"):
+            if vector.get(key) != wanted[key]:
+                problems.append(f"{wanted['path']}.{key} is {vector.get(key)!r}, expected {wanted[key]!r}")
+    return problems
+
+
+def default_similarity(quantization: str) -> str:
+    # 二值向量只支持 euclidean（汉明距离）；float / int8 向量按余弦比较
+    return "euclidean" if quantization == "binary" else "cosine"
+
+
+class VectorIndexProvisioner:
+    """启动时确保向量索引存在且定义正确，并记录就绪状态供 `/ready` 使用"""
+
+    def __init__(
+        self,
+        database: Any,
+        collection_name: str,
+        *,
+        index_name: str,
+        similarity: str,
+        dimensions: Callable[[], Awaitable[int]],
+        embedding_key: str = "embedding",
+        mode: str = "verify",
+        poll_seconds: float = 5.0,
+        max_poll_seconds: float = 300.0,
+    ) -> None:
+        if mode not in INDEX_PROVISION_MODES:
+            raise ValueError(f"Unknown RAG_VECTOR_INDEX_PROVISION: {mode}")
+        if similarity not in SIMILARITY_FUNCTIONS:
+            raise ValueError(f"Unknown RAG_VECTOR_INDEX_SIMILARITY: {similarity}")
+        self._database = database
+        self._collection_name = collection_name
+        self._collection = database[collection_name]
+        self._index_name = index_name
+        self._similarity = similarity
+        self._dimensions = dimensions
+        self._embedding_key = embedding_key
+        self._mode = mode
+        self._poll_seconds = max(0.5, poll_seconds)
+        self._max_poll_seconds = max(self._poll_seconds, max_poll_seconds)
+        self._ready = mode == "off"
+        self._state: Dict[str, Any] = {
+            "index": index_name,
+            "mode": mode,
+            "status": "unchecked" if self._ready else "pending",
+        }
+
+    @property
+    def ready(self) -> bool:
+        return self._ready
+
+    @property
+    def blocking(self) -> bool:
+        """是否应让 `/ready` 返回 503：确认索引可查询之前一直阻塞（off 模式不阻塞）"""
+        return not self._ready
+
+    def status(self) -> Dict[str, Any]:
+        return {"ready": self._ready, "blocking": self.blocking, **self._state}
+
+    async def run(self) -> None:
+        """后台任务：出错（如网络抖动）时记录原因并在下一轮重试，直到索引可查询"""
+        if self._ready:
+            return
+        expected: Optional[Dict[str, Any]] = None
+        delay = self._poll_seconds
+        while True:
+            try:
+                if expected is None:
+                    expected = vector_index_definition(
+                        dimensions=await self._dimensions(),
+                        similarity=self._similarity,
+                        embedding_key=self._embedding_key,
+                    )
+                if await self._check(expected):
+                    return
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                self._update(status="error", error=f"{type(err).__name__}: {err}")
+            if self._state.get("status") in TRANSIENT_STATUSES:
+                delay = self._poll_seconds
+            wait = delay
+            # 需要人工处理的状态（缺失 / 定义不符 / 出错）：逐次拉长轮询间隔
+            delay = min(self._max_poll_seconds, delay * 2)
+            self._update(next_check_seconds=wait)
+            await asyncio.sleep(wait)
+
+    async def _check(self, expected: Dict[str, Any]) -> bool:
+        index = await self._find_index()
+        if index is None:
+            if self._mode == "verify":
+                self._update(status="missing", error=f"search index {self._index_name!r} does not exist")
+                return False
+            await self._create(expected)
+            self._update(status="creating", error=None)
+            return False
+
+        problems = definition_problems(index.get("latestDefinition"), expected)
+        if problems:
+            if self._mode == "verify":
+                self._update(status="mismatch", error="; ".join(problems))
+                return False
+            await self._collection.update_search_index(self._index_name, self._merged(index, expected))
+            metrics.log("rag.index.updating", level=logging.WARNING, index=self._index_name, problems=problems)
+            self._update(status="updating", error=None, problems=problems)
+            return False
+
+        # 定义更新后旧版本仍可查询，但新 filter 字段要等重建完成（status=READY）才生效
+        status = index.get("status")
+        queryable = bool(index.get("queryable"))
+        self._update(status=str(status).lower(), queryable=queryable, error=None, problems=None)
+        if status == "READY" and queryable:
+            self._ready = True
+            self._update(ready_at=time.time(), next_check_seconds=None)
+            metrics.log("rag.index.ready", sample=False, index=self._index_name)
+            return True
+        return False
+
+    async def _find_index(self) -> Optional[Dict[str, Any]]:
+        try:
+            cursor = self._collection.list_search_indexes(self._index_name)
+            indexes = await cursor.to_list(length=None)
+        except OperationFailure as err:
+            # 集合尚不存在（NamespaceNotFound）时视为没有索引
+            if err.code == 26:
+                return None
+            raise
+        return indexes[0] if indexes else None
+
+    async def _create(self, expected: Dict[str, Any]) -> None:
+        try:
+            await self._database.create_collection(self._collection_name)
+        except CollectionInvalid:
+            pass
+        model = SearchIndexModel(definition=expected, name=self._index_name, type="vectorSearch")
+        await self._collection.create_search_index(model)
+        metrics.log(
+            "rag.index.created",
+            sample=False,
+            index=self._index_name,
+            collection=self._collection_name,
+        )
+
+    @staticmethod
+    def _merged(index: Dict[str, Any], expected: Dict[str, Any]) -> Dict[str, Any]:
+        """保留现有定义中额外的 filter 字段"""
+        extra = [
+            field
+            for field in (index.get("latestDefinition") or {}).get("fields", [])
+            if field.get("type") == "filter" and field not in expected["fields"]
+        ]
+        return {"fields": [*expected["fields"], *extra]}
+
+    def _update(self, **values: Any) -> None:
+        for key, value in values.items():
+            if value is None:
+                self._state.pop(key, None)
+            else:
+                self._state[key] = value
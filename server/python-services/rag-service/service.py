@@ -2,21 +2,95 @@
 from __future__ import annotations
 
 import asyncio
+import logging
 import os
-import tempfile
+import time
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Tuple
 
-from llama_index.core import Settings, StorageContext, VectorStoreIndex
-from llama_index.core.node_parser import SentenceSplitter
-from llama_index.core.readers import SimpleDirectoryReader
-from llama_index.core.vector_stores import MetadataFilter, MetadataFilters
-from llama_index.embeddings.openai import OpenAIEmbedding
+from llama_index.core import QueryBundle, Settings
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.schema import TextNode
 from llama_index.llms.openai import OpenAI
-from llama_index.vector_stores.mongodb import MongoDBAtlasVectorSearch
+import numpy as np
 from pymongo import MongoClient
 
 from shared.config import settings
+from shared.mongodb import MongoDBClient
+from shared.sse import format_sse
+from chunking import create_node_parser
+from embedding_backends import create_embed_model, embedding_model_id, query_embedding_batch
+from embedding_cache import CachedEmbeddingModel, create_embedding_cache
+from embedding_scheduler import EmbeddingScheduler, MongoLimiterState
+from instrumentation import LlmTokenHandler, metrics
+from ingestion import DOCUMENT_ID_KEY, IngestStats, StageTimer, StreamingIngestor, embedding_version, iter_pages
+from lexical_index import HybridBackend, LexicalIndexStore
+from pdf_extraction import PdfPageExtractor
+from query_cache import (
+    MongoCacheGenerations,
+    MongoQueryEmbeddingStore,
+    QueryEmbeddingCache,
+    ResponseCache,
+    document_scope,
+    material_scope,
+    user_scope,
+)
+from query_layer import QueryLayer
+from reranking import MmrBackend, pack_nodes
+from search_index import OPENAI_EMBEDDING_DIMENSIONS, VectorIndexProvisioner, default_similarity
+from ann_index import AnnIndexStore, AnnVectorBackend
+from chunk_maintenance import (
+    delete_chunks,
+    document_filter,
+    find_duplicate_chunks,
+    find_orphan_chunks,
+    load_chunk_ordinals,
+    load_document_chunks,
+    material_filter,
+    renumber_chunks,
+)
+from chunk_schema import CHUNK_SCHEMAS, CompactMongoVectorStore
+from document_store import (
+    DOCUMENT_READY,
+    DOCUMENT_STORAGE_MODES,
+    DocumentRegistry,
+    MaterialScopes,
+    ScopedBackend,
+    document_key,
+    file_digest,
+)
+from vector_backends import (
+    LEAN_CHUNK_PROJECTION,
+    AtlasAggregationBackend,
+    LlamaIndexBackend,
+    LocalNumpyBackend,
+    PrivateScopes,
+    VectorBackend,
+    public_metadata,
+    row_key,
+)
+from vector_codec import RescoringBackend, VectorCodec, vector_to_array
+
+
+def project_sources(
+    sources: List[Dict[str, Any]],
+    *,
+    include_metadata: bool = True,
+    fields: Optional[List[str]] = None,
+) -> List[Dict[str, Any]]:
+    """按调用方需要裁剪 source：include_metadata=False 去掉元数据，fields 只保留指定的元数据键"""
+    if include_metadata and fields is None:
+        return sources
+    projected: List[Dict[str, Any]] = []
+    for source in sources:
+        source = dict(source)
+        if not include_metadata:
+            source.pop("metadata", None)
+        else:
+            metadata = source.get("metadata") or {}
+            source["metadata"] = {key: metadata[key] for key in fields if key in metadata}
+        projected.append(source)
+    return projected
 
 
 @dataclass
@@ -24,6 +98,8 @@ class ProcessResult:
     document_count: int
     chunk_count: int
     filename: str
+    new_chunks: int = 0
+    removed_chunks: int = 0
 
 
 class RAGPipeline:
@@ -33,140 +109,943 @@ class RAGPipeline:
         self._init_models()
         self._mongo_client = MongoClient(settings.MONGODB_URI)
         self._collection = self._mongo_client[settings.MONGODB_VECTOR_DB][settings.MONGODB_VECTOR_COLLECTION]
+        self._init_document_store()
         self._init_vector_store()
+        self._init_search_index()
+        self._init_ingestor()
+        self._init_query_cache()
 
     def _init_models(self) -> None:
         """初始化 Embedding / LLM / 切分器"""
-        Settings.embed_model = OpenAIEmbedding(model=settings.OPENAI_EMBEDDING_MODEL)
+        # 批量查询的全部问题放进同一个 embedding 请求（OpenAI 单次最多 2048 条输入）
+        Settings.embed_model = create_embed_model(
+            settings,
+            query_batch_size=min(2048, max(100, settings.RAG_BATCH_MAX_QUESTIONS)),
+        )
+        self._embed_model_id = embedding_model_id(Settings.embed_model)
         Settings.llm = OpenAI(model=settings.OPENAI_COMPLETION_MODEL, temperature=0)
-        Settings.node_parser = SentenceSplitter(chunk_size=1024, chunk_overlap=200)
+        get_dispatcher().add_event_handler(LlmTokenHandler(metrics, model=settings.OPENAI_COMPLETION_MODEL))
+        Settings.node_parser = create_node_parser(settings.RAG_CHUNKER, chunk_size=1024, chunk_overlap=200)
+
+    def _init_document_store(self) -> None:
+        """RAG_DOCUMENT_STORAGE=shared 时同一文件跨用户只存一份，检索范围经引用表解析"""
+        if settings.RAG_DOCUMENT_STORAGE not in DOCUMENT_STORAGE_MODES:
+            raise ValueError(f"Unknown RAG_DOCUMENT_STORAGE: {settings.RAG_DOCUMENT_STORAGE}")
+        self._registry: Optional[DocumentRegistry] = None
+        self._scopes = PrivateScopes()
+        if settings.RAG_DOCUMENT_STORAGE != "shared":
+            return
+        if settings.RAG_VECTOR_BACKEND == "llamaindex":
+            # LlamaIndex 的 MetadataFilters 无法表达“按用户存储 或 共享文档”的 $or 过滤
+            raise ValueError("RAG_DOCUMENT_STORAGE=shared requires the atlas, local or ann backend")
+        database = self._mongo_client[settings.MONGODB_VECTOR_DB]
+        self._registry = DocumentRegistry(
+            database[settings.RAG_DOCUMENTS_COLLECTION],
+            database[settings.RAG_MATERIAL_REFS_COLLECTION],
+        )
+        async_database = MongoDBClient.get_database(settings.MONGODB_VECTOR_DB, async_mode=True)
+        generations = settings.RAG_RESPONSE_CACHE_GENERATIONS_COLLECTION
+        # 引用表的写入代号与回答缓存共用集合：删除 / 改指材料后所有 worker 重新读取引用
+        self._scopes = MaterialScopes(
+            async_database[settings.RAG_MATERIAL_REFS_COLLECTION],
+            ttl_seconds=settings.RAG_MATERIAL_REF_CACHE_TTL,
+            generations=MongoCacheGenerations(database[generations], async_database[generations]),
+        )
 
     def _init_vector_store(self) -> None:
-        self._vector_store = MongoDBAtlasVectorSearch(
-            mongo_client=self._mongo_client,
-            db_name=settings.MONGODB_VECTOR_DB,
-            collection_name=settings.MONGODB_VECTOR_COLLECTION,
+        self._vector_codec = VectorCodec(
+            dimensions=settings.RAG_VECTOR_DIMENSIONS,
+            quantization=settings.RAG_VECTOR_QUANTIZATION,
+            keep_full=settings.RAG_VECTOR_RESCORE_FACTOR > 1,
+        )
+        # 模型或存储格式变化后，重新处理材料时未变化的文本也重新向量化
+        self._embedding_version = embedding_version(self._embed_model_id, self._vector_codec.signature)
+        store_kwargs: Dict[str, Any] = {
+            "mongo_client": self._mongo_client,
+            "db_name": settings.MONGODB_VECTOR_DB,
+            "collection_name": settings.MONGODB_VECTOR_COLLECTION,
+            "index_name": settings.MONGODB_VECTOR_INDEX,
+            "text_key": "text",
+            "embedding_key": "embedding",
+        }
+        if settings.RAG_CHUNK_SCHEMA not in CHUNK_SCHEMAS:
+            raise ValueError(f"Unknown RAG_CHUNK_SCHEMA: {settings.RAG_CHUNK_SCHEMA}")
+        if self._vector_codec.enabled and settings.RAG_VECTOR_BACKEND == "llamaindex":
+            raise ValueError("RAG_VECTOR_DIMENSIONS / RAG_VECTOR_QUANTIZATION require the atlas, local or ann backend")
+        self._vector_store = CompactMongoVectorStore(
+            codec=self._vector_codec,
+            compact_schema=settings.RAG_CHUNK_SCHEMA == "compact",
+            **store_kwargs,
+        )
+        self._query_layer = QueryLayer(self._vector_store)
+        self._vector_backend = self._create_vector_backend(settings.RAG_VECTOR_BACKEND)
+        if self._vector_codec.enabled:
+            async_collection = MongoDBClient.get_database(settings.MONGODB_VECTOR_DB, async_mode=True)[
+                settings.MONGODB_VECTOR_COLLECTION
+            ]
+            self._vector_backend = RescoringBackend(
+                self._vector_backend,
+                async_collection,
+                self._vector_codec,
+                rescore_factor=settings.RAG_VECTOR_RESCORE_FACTOR,
+            )
+        if settings.RAG_RETRIEVAL_MODE == "hybrid":
+            async_collection = MongoDBClient.get_database(settings.MONGODB_VECTOR_DB, async_mode=True)[
+                settings.MONGODB_VECTOR_COLLECTION
+            ]
+            self._vector_backend = HybridBackend(
+                self._vector_backend,
+                LexicalIndexStore(
+                    async_collection,
+                    max_users=settings.RAG_LEXICAL_MAX_USERS,
+                    ttl_seconds=settings.RAG_LEXICAL_INDEX_TTL,
+                    scopes=self._scopes,
+                ),
+                async_collection,
+                rrf_k=settings.RAG_RRF_K,
+            )
+        elif settings.RAG_RETRIEVAL_MODE != "vector":
+            raise ValueError(f"Unknown RAG_RETRIEVAL_MODE: {settings.RAG_RETRIEVAL_MODE}")
+        if settings.RAG_MMR_CANDIDATE_FACTOR > 1:
+            async_collection = MongoDBClient.get_database(settings.MONGODB_VECTOR_DB, async_mode=True)[
+                settings.MONGODB_VECTOR_COLLECTION
+            ]
+            self._vector_backend = MmrBackend(
+                self._vector_backend,
+                async_collection,
+                diversity_lambda=settings.RAG_MMR_LAMBDA,
+                candidate_factor=settings.RAG_MMR_CANDIDATE_FACTOR,
+            )
+        if self._registry is not None:
+            self._vector_backend = ScopedBackend(self._vector_backend, self._scopes)
+
+    def _init_search_index(self) -> None:
+        """atlas / llamaindex 后端依赖 Atlas 向量索引（含 user_id / material_id / file_hash 过滤字段）"""
+        self._index_provisioner: Optional[VectorIndexProvisioner] = None
+        if settings.RAG_VECTOR_BACKEND not in ("atlas", "llamaindex"):
+            return
+        self._index_provisioner = VectorIndexProvisioner(
+            MongoDBClient.get_database(settings.MONGODB_VECTOR_DB, async_mode=True),
+            settings.MONGODB_VECTOR_COLLECTION,
             index_name=settings.MONGODB_VECTOR_INDEX,
-            text_key="text",
-            embedding_key="embedding",
+            similarity=settings.RAG_VECTOR_INDEX_SIMILARITY or default_similarity(self._vector_codec.quantization),
+            dimensions=self._index_dimensions,
+            mode=settings.RAG_VECTOR_INDEX_PROVISION,
+            poll_seconds=settings.RAG_VECTOR_INDEX_POLL_SECONDS,
+            max_poll_seconds=settings.RAG_VECTOR_INDEX_MAX_POLL_SECONDS,
         )
 
-    async def process_document(self, *, file_bytes: bytes, filename: str, material_id: str, user_id: str) -> ProcessResult:
-        """读取 PDF，切分并写入向量库"""
-        if not file_bytes:
+    async def _index_dimensions(self) -> int:
+        """索引维度：显式配置 > 已知 OpenAI 模型维度 / 实际计算一次探测文本，再按截断维度取较小值"""
+        if settings.RAG_VECTOR_INDEX_DIMENSIONS > 0:
+            return settings.RAG_VECTOR_INDEX_DIMENSIONS
+        dimensions: Optional[int] = None
+        if settings.RAG_EMBED_BACKEND == "openai":
+            dimensions = OPENAI_EMBEDDING_DIMENSIONS.get(self._embed_model_id)
+        if dimensions is None:
+            dimensions = len(await Settings.embed_model.aget_query_embedding("vector index dimension probe"))
+        if self._vector_codec.dimensions:
+            dimensions = min(dimensions, self._vector_codec.dimensions)
+        return dimensions
+
+    async def ensure_search_index(self) -> None:
+        """启动后台任务：创建 / 校验向量索引，直到可查询"""
+        if self._index_provisioner is not None:
+            await self._index_provisioner.run()
+
+    def search_index_status(self) -> Dict[str, Any]:
+        if self._index_provisioner is None:
+            return {"ready": True, "blocking": False, "status": "not_required", "backend": settings.RAG_VECTOR_BACKEND}
+        return self._index_provisioner.status()
+
+    def _create_vector_backend(self, name: str) -> VectorBackend:
+        if name == "llamaindex":
+            return LlamaIndexBackend(self._query_layer)
+        if name == "atlas":
+            async_collection = MongoDBClient.get_database(settings.MONGODB_VECTOR_DB, async_mode=True)[
+                settings.MONGODB_VECTOR_COLLECTION
+            ]
+            return AtlasAggregationBackend(
+                async_collection,
+                index_name=settings.MONGODB_VECTOR_INDEX,
+                num_candidates_factor=settings.RAG_VECTOR_NUM_CANDIDATES_FACTOR,
+                query_encoder=self._vector_codec.atlas_query_vector if self._vector_codec.enabled else None,
+                scopes=self._scopes,
+            )
+        if name == "local":
+            async_collection = MongoDBClient.get_database(settings.MONGODB_VECTOR_DB, async_mode=True)[
+                settings.MONGODB_VECTOR_COLLECTION
+            ]
+            return LocalNumpyBackend(
+                async_collection,
+                max_users=settings.RAG_LOCAL_VECTOR_MAX_USERS,
+                ttl_seconds=settings.RAG_LOCAL_VECTOR_TTL,
+                scopes=self._scopes,
+            )
+        if name == "ann":
+            async_collection = MongoDBClient.get_database(settings.MONGODB_VECTOR_DB, async_mode=True)[
+                settings.MONGODB_VECTOR_COLLECTION
+            ]
+            return AnnVectorBackend(
+                async_collection,
+                AnnIndexStore(settings.RAG_ANN_INDEX_DIR, min_train_rows=settings.RAG_ANN_MIN_TRAIN_ROWS),
+                nprobe=settings.RAG_ANN_NPROBE,
+                ttl_seconds=settings.RAG_ANN_INDEX_TTL,
+                vector_transform=self._vector_codec.first_pass_vector if self._vector_codec.enabled else None,
+                scopes=self._scopes,
+            )
+        raise ValueError(f"Unknown RAG_VECTOR_BACKEND: {name}")
+
+    def _init_ingestor(self) -> None:
+        # OpenAI 后端的摄取走限流感知的批量调度器（所有摄取线程共用），问题向量仍由 Settings.embed_model 计算；
+        # 本地 / hash 后端没有网络限流，摄取直接使用同一个模型
+        self._embedding_scheduler: Optional[EmbeddingScheduler] = None
+        ingest_embed_model: Any = Settings.embed_model
+        if settings.RAG_EMBED_BACKEND == "openai":
+            shared_state: Optional[MongoLimiterState] = None
+            if settings.RAG_EMBED_LIMITS_COLLECTION:
+                # 各 worker / Pod 共用并发上限与限流暂停（同一组织 + 模型的额度）
+                shared_state = MongoLimiterState(
+                    self._mongo_client[settings.MONGODB_VECTOR_DB][settings.RAG_EMBED_LIMITS_COLLECTION],
+                    key=settings.OPENAI_EMBEDDING_MODEL,
+                    initial=settings.RAG_EMBED_CONCURRENCY,
+                    maximum=settings.RAG_EMBED_MAX_CONCURRENCY,
+                )
+            self._embedding_scheduler = EmbeddingScheduler(
+                model=settings.OPENAI_EMBEDDING_MODEL,
+                api_key=settings.OPENAI_API_KEY or None,
+                max_batch_tokens=settings.RAG_EMBED_BATCH_MAX_TOKENS,
+                max_batch_inputs=settings.RAG_EMBED_BATCH_MAX_INPUTS,
+                concurrency=settings.RAG_EMBED_CONCURRENCY,
+                max_concurrency=settings.RAG_EMBED_MAX_CONCURRENCY,
+                max_retries=settings.RAG_EMBED_MAX_RETRIES,
+                result_timeout=settings.RAG_EMBED_RESULT_TIMEOUT,
+                shared_state=shared_state,
+            )
+            ingest_embed_model = self._embedding_scheduler
+        self._embedding_cache = create_embedding_cache(
+            settings.RAG_EMBED_CACHE_PATH,
+            settings.RAG_EMBED_CACHE_MAX_MB,
+        )
+        if self._embedding_cache is not None:
+            ingest_embed_model = CachedEmbeddingModel(
+                ingest_embed_model,
+                self._embedding_cache,
+                model_name=self._embed_model_id,
+            )
+
+        # PDF 文本提取进程池：第一次并行提取时才创建工作进程，所有摄取线程共用
+        self._pdf_extractor = PdfPageExtractor(
+            workers=settings.RAG_PDF_EXTRACT_WORKERS,
+            pages_per_task=settings.RAG_PDF_PAGES_PER_TASK,
+            min_pages=settings.RAG_PDF_PARALLEL_MIN_PAGES,
+        )
+
+        self._ingestor = StreamingIngestor(
+            node_parser=Settings.node_parser,
+            embed_model=ingest_embed_model,
+            vector_store=self._vector_store,
+            batch_size=settings.RAG_INGEST_BATCH_SIZE,
+            max_in_flight=settings.RAG_INGEST_MAX_IN_FLIGHT,
+        )
+
+    def _init_query_cache(self) -> None:
+        shared_store = None
+        if settings.RAG_QUERY_EMBED_CACHE_BACKEND == "mongo":
+            collection = MongoDBClient.get_database(settings.MONGODB_VECTOR_DB, async_mode=True)[
+                settings.RAG_QUERY_EMBED_CACHE_COLLECTION
+            ]
+            shared_store = MongoQueryEmbeddingStore(collection, ttl_seconds=settings.RAG_QUERY_EMBED_CACHE_TTL)
+
+        self._query_embeddings = QueryEmbeddingCache(
+            model_name=self._embed_model_id,
+            max_entries=settings.RAG_QUERY_EMBED_CACHE_SIZE,
+            ttl_seconds=settings.RAG_QUERY_EMBED_CACHE_TTL,
+            shared=shared_store,
+        )
+        self._response_cache = None
+        if settings.RAG_RESPONSE_CACHE_SIZE > 0:
+            # 写入代号存于 MongoDB：任一 worker 摄取 / 删除 chunk 后，所有 worker 的相关条目同时失效
+            generations = settings.RAG_RESPONSE_CACHE_GENERATIONS_COLLECTION
+            self._response_cache = ResponseCache(
+                model_name=f"{settings.OPENAI_COMPLETION_MODEL}/{self._embed_model_id}",
+                max_entries=settings.RAG_RESPONSE_CACHE_SIZE,
+                ttl_seconds=settings.RAG_RESPONSE_CACHE_TTL,
+                scopes=self._scopes,
+                generations=MongoCacheGenerations(
+                    self._mongo_client[settings.MONGODB_VECTOR_DB][generations],
+                    MongoDBClient.get_database(settings.MONGODB_VECTOR_DB, async_mode=True)[generations],
+                ),
+            )
+
+    def process_document(
+        self,
+        *,
+        file_path: str,
+        filename: str,
+        material_id: str,
+        user_id: str,
+        stage: Optional[StageTimer] = None,
+    ) -> ProcessResult:
+        """逐页读取 PDF，流式切分、向量化并分批写入向量库（阻塞调用，由后台摄取队列执行）"""
+        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
             raise ValueError("Empty file content")
+        if self._registry is not None:
+            return self._process_shared(
+                file_path=file_path,
+                filename=filename,
+                material_id=material_id,
+                user_id=user_id,
+                stage=stage,
+            )
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1] or ".pdf") as tmp_file:
-            tmp_file.write(file_bytes)
-            tmp_file_path = tmp_file.name
+        pages = iter_pages(file_path, {
+            "material_id": material_id,
+            "user_id": user_id,
+            "filename": filename,
+        }, self._pdf_extractor)
+        stats, removed = self._ingest(
+            pages,
+            user_id=user_id,
+            material_id=material_id,
+            query=material_filter(user_id, material_id),
+            namespace=f"{user_id}/{material_id}@{self._embedding_version}",
+            stage=stage,
+        )
+        return ProcessResult(
+            document_count=stats.page_count,
+            chunk_count=stats.char_count,
+            filename=filename,
+            new_chunks=stats.inserted_count,
+            removed_chunks=removed,
+        )
 
-        try:
-            documents = SimpleDirectoryReader(input_files=[tmp_file_path]).load_data()
-        finally:
+    def _process_shared(
+        self,
+        *,
+        file_path: str,
+        filename: str,
+        material_id: str,
+        user_id: str,
+        stage: Optional[StageTimer],
+    ) -> ProcessResult:
+        """按文件哈希共享存储：已有用户处理过的同一文件只新增一条引用，不再解析和向量化"""
+        document_id = document_key(file_digest(file_path), self._embedding_version)
+        previous = self._registry.get_ref(user_id, material_id)
+        # 先写引用再检查文档：并发清理复查到引用时不会删除这份文档的 chunk
+        self._registry.put_ref(user_id, material_id, document_id, filename)
+        self._scopes.invalidate(user_id)
+
+        new_chunks = removed = 0
+        if self._registry.wait_ready(document_id) == DOCUMENT_READY:
+            document = self._registry.get_document(document_id) or {}
+            page_count = int(document.get("page_count", 0))
+            char_count = int(document.get("char_count", 0))
+            self._index_document(user_id, document_id)
+        else:
             try:
-                os.remove(tmp_file_path)
-            except OSError:
-                pass
+                stats, removed = self._ingest(
+                    iter_pages(file_path, {DOCUMENT_ID_KEY: document_id}, self._pdf_extractor),
+                    user_id=user_id,
+                    material_id=material_id,
+                    query=document_filter(document_id),
+                    namespace=document_id,
+                    stage=stage,
+                    document_id=document_id,
+                    on_batch=lambda: self._registry.renew(document_id),
+                )
+            except Exception:
+                self._registry.release(document_id)
+                raise
+            self._registry.mark_ready(
+                document_id,
+                page_count=stats.page_count,
+                chunk_count=stats.chunk_count,
+                char_count=stats.char_count,
+            )
+            page_count, char_count, new_chunks = stats.page_count, stats.char_count, stats.inserted_count
+
+        # 该材料以前按用户存储的 chunk（切换到共享存储之前写入）由共享文档取代
+        legacy = list(load_chunk_ordinals(self._collection, material_filter(user_id, material_id)))
+        removed += self._remove_chunks(user_id, {material_id: legacy})
+        if previous is not None and previous["document_id"] != document_id:
+            removed += self._release_document(user_id, previous["document_id"])
+        # 材料改为引用这份文档：按材料和按用户建键的缓存条目失效
+        self._invalidate_responses(user_id, [material_id])
+
+        return ProcessResult(
+            document_count=page_count,
+            chunk_count=char_count,
+            filename=filename,
+            new_chunks=new_chunks,
+            removed_chunks=removed,
+        )
+
+    def _ingest(
+        self,
+        pages: Any,
+        *,
+        user_id: str,
+        material_id: str,
+        query: Dict[str, Any],
+        namespace: str,
+        stage: Optional[StageTimer],
+        document_id: Optional[str] = None,
+        on_batch: Optional[Callable[[], Any]] = None,
+    ) -> Tuple[IngestStats, int]:
+        """写入内容变化的 chunk，更新位置变化的序号并删除已不存在的 chunk，返回 (统计, 删除条数)"""
+        # 写库成功后同步更新进程内索引（ANN 分区 / BM25 倒排表）
+        index_updaters = [
+            backend.add_nodes
+            for backend in self._backend_chain()
+            if isinstance(backend, AnnVectorBackend)
+        ]
+        for backend in self._backend_chain():
+            if isinstance(backend, HybridBackend):
+                index_updaters.append(backend.lexical.add_nodes)
 
-        if not documents:
+        def on_inserted(nodes: List[Any]) -> None:
+            for add_nodes in index_updaters:
+                add_nodes(user_id, nodes)
+            self._invalidate_responses(user_id, [material_id], document_id)
+            if on_batch is not None:
+                on_batch()
+
+        # 重新处理同一材料时只向量化、写入内容变化的 chunk
+        existing = load_chunk_ordinals(self._collection, query)
+        stats = self._ingestor.run(
+            pages,
+            stage=stage,
+            on_inserted=on_inserted,
+            namespace=namespace,
+            existing_ids=existing,
+        )
+        for backend in self._backend_chain():
+            if isinstance(backend, LocalNumpyBackend):
+                backend.invalidate(user_id)
+
+        if stats.chunk_count == 0:
             raise ValueError("No text extracted from PDF")
 
-        for doc in documents:
-            doc.metadata.update({
-                "material_id": material_id,
-                "user_id": user_id,
-                "filename": filename,
-            })
+        # 保留下来的 chunk 位置变化时只改序号；新版本里已不存在的 chunk 整批删除
+        moved = {
+            doc_id: ordinal
+            for doc_id, ordinal in stats.chunk_ordinals.items()
+            if doc_id in existing and existing[doc_id] != ordinal
+        }
+        if moved:
+            renumber_chunks(self._collection, moved)
+            self._invalidate_responses(user_id, [material_id], document_id)
+        stale = [doc_id for doc_id in existing if doc_id not in stats.chunk_ordinals]
+        return stats, self._remove_chunks(user_id, {material_id: stale}, document_id=document_id)
 
-        storage_context = StorageContext.from_defaults(vector_store=self._vector_store)
-        VectorStoreIndex.from_documents(documents, storage_context=storage_context)
+    def _index_document(self, user_id: str, document_id: str) -> None:
+        """引用已有的共享文档：把它的 chunk 加入该用户的进程内索引（向量直接取库中存储的值）"""
+        docs = load_document_chunks(self._collection, document_id)
+        if not docs:
+            return
+        ids = [str(doc["_id"]) for doc in docs]
+        keys = [row_key(doc.get("metadata") or {}) for doc in docs]
+        for backend in self._backend_chain():
+            if isinstance(backend, AnnVectorBackend) and all(doc.get("embedding") is not None for doc in docs):
+                backend.store.add(user_id, ids, keys, np.stack([vector_to_array(doc["embedding"]) for doc in docs]))
+            elif isinstance(backend, HybridBackend):
+                backend.lexical.add_nodes(user_id, [
+                    TextNode(id_=doc_id, text=doc.get("text") or "", metadata=doc.get("metadata") or {})
+                    for doc_id, doc in zip(ids, docs)
+                ])
+            elif isinstance(backend, LocalNumpyBackend):
+                backend.invalidate(user_id)
 
-        chunk_count = sum(len(doc.text) for doc in documents)
-        return ProcessResult(
-            document_count=len(documents),
-            chunk_count=chunk_count,
-            filename=filename,
+    def _release_document(self, user_id: str, document_id: str) -> int:
+        """用户不再引用某个共享文档：从其进程内索引移除；没有任何用户引用时删除 chunk"""
+        if self._registry.user_references(user_id, document_id):
+            return 0
+        ids = list(load_chunk_ordinals(self._collection, document_filter(document_id)))
+        self._forget_chunks(user_id, ids)
+        if not self._registry.delete_if_unreferenced(document_id):
+            return 0
+        deleted = delete_chunks(self._collection, ids)
+        self._invalidate_responses(user_id, [], document_id)
+        return deleted
+
+    def delete_material(self, *, user_id: str, material_id: str) -> int:
+        """删除材料的全部 chunk，返回删除条数（阻塞调用）
+
+        共享存储下只删除引用，文档的 chunk 在最后一个引用删除后才删除。
+        """
+        ids = list(load_chunk_ordinals(self._collection, material_filter(user_id, material_id)))
+        deleted = self._remove_chunks(user_id, {material_id: ids})
+        if self._registry is not None:
+            ref = self._registry.remove_ref(user_id, material_id)
+            self._scopes.invalidate(user_id)
+            if ref is not None:
+                deleted += self._release_document(user_id, ref["document_id"])
+            self._invalidate_responses(user_id, [material_id])
+        return deleted
+
+    def compact(self, *, user_id: str, keep_material_ids: Optional[List[str]] = None) -> Dict[str, int]:
+        """清理用户名下的重复 chunk；给出 keep_material_ids 时，其余材料的 chunk（及共享文档引用）视为孤立数据一并删除"""
+        orphaned = 0
+        if keep_material_ids is not None:
+            orphaned = self._remove_chunks(
+                user_id,
+                find_orphan_chunks(self._collection, user_id, keep_material_ids),
+            )
+            if self._registry is not None:
+                keep = set(keep_material_ids)
+                for ref in self._registry.user_refs(user_id):
+                    if ref["material_id"] not in keep:
+                        orphaned += self.delete_material(user_id=user_id, material_id=ref["material_id"])
+        duplicates = self._remove_chunks(
+            user_id,
+            find_duplicate_chunks(self._collection, user_id, keep_material_ids),
         )
+        return {"orphaned": orphaned, "duplicates": duplicates}
+
+    def _remove_chunks(
+        self,
+        user_id: str,
+        ids_by_material: Dict[str, List[Any]],
+        *,
+        document_id: Optional[str] = None,
+    ) -> int:
+        """批量删除 chunk，并同步进程内索引与回答缓存"""
+        ids = [doc_id for material_ids in ids_by_material.values() for doc_id in material_ids]
+        if not ids:
+            return 0
+        deleted = delete_chunks(self._collection, ids)
+        self._forget_chunks(user_id, ids)
+        self._invalidate_responses(user_id, list(ids_by_material), document_id)
+        return deleted
+
+    def _invalidate_responses(self, user_id: str, material_ids: List[str], document_id: Optional[str] = None) -> None:
+        """递增受影响内容范围的写入代号（用户全部材料、各材料，以及共享文档）"""
+        if self._response_cache is None:
+            return
+        scopes = [user_scope(user_id), *(material_scope(user_id, material_id) for material_id in material_ids)]
+        if document_id is not None:
+            scopes.append(document_scope(document_id))
+        self._response_cache.invalidate(scopes)
+
+    def _forget_chunks(self, user_id: str, ids: List[Any]) -> None:
+        """从用户的进程内索引中移除 chunk"""
+        if not ids:
+            return
+        str_ids = [str(doc_id) for doc_id in ids]
+        for backend in self._backend_chain():
+            if isinstance(backend, AnnVectorBackend):
+                backend.store.remove(user_id, str_ids)
+            elif isinstance(backend, HybridBackend):
+                backend.lexical.remove_ids(user_id, str_ids)
+            elif isinstance(backend, LocalNumpyBackend):
+                backend.invalidate(user_id)
+
+    def _backend_chain(self) -> List[VectorBackend]:
+        """由外到内列出检索后端（混合检索 / 重排包装及最内层的向量后端）"""
+        chain = [self._vector_backend]
+        while isinstance(chain[-1], (ScopedBackend, MmrBackend, HybridBackend, RescoringBackend)):
+            chain.append(chain[-1].inner)
+        return chain
+
+    def shutdown(self) -> None:
+        self._pdf_extractor.shutdown()
+        if self._embedding_scheduler is not None:
+            self._embedding_scheduler.shutdown()
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return {
+            "embedding_cache": self._embedding_cache.stats() if self._embedding_cache else None,
+            "embedding_scheduler": self._embedding_scheduler.stats() if self._embedding_scheduler else None,
+            "query_embedding_cache": self._query_embeddings.stats(),
+            "response_cache": self._response_cache.stats() if self._response_cache else None,
+        }
 
     async def query(self, *, question: str, user_id: str, material_ids: Optional[List[str]] = None, top_k: int = 5):
         if not question:
             raise ValueError("Question cannot be empty")
 
-        filters_list = [MetadataFilter(key="user_id", value=user_id)]
-        if material_ids:
-            filters_list.append(MetadataFilter(key="material_id", value=material_ids, operator="in"))
-
-        metadata_filters = MetadataFilters(filters=filters_list)
+        key = None
+        if self._response_cache is not None:
+            key = await self._response_cache.key(
+                question=question,
+                user_id=user_id,
+                material_ids=material_ids,
+                top_k=top_k,
+            )
+        if key is None:
+            return await self._answer(question=question, user_id=user_id, material_ids=material_ids, top_k=top_k)
 
-        storage_context = StorageContext.from_defaults(vector_store=self._vector_store)
-        index = VectorStoreIndex.from_vector_store(
-            vector_store=self._vector_store,
-            storage_context=storage_context,
-        )
-        query_engine = index.as_query_engine(
-            similarity_top_k=top_k,
-            filters=metadata_filters,
+        result = await self._response_cache.get_or_compute(
+            key,
+            lambda: self._answer(question=question, user_id=user_id, material_ids=material_ids, top_k=top_k),
         )
+        return await self._own_sources(result, user_id, material_ids)
 
-        response = await asyncio.to_thread(query_engine.query, question)
+    async def _own_sources(
+        self,
+        result: Dict[str, Any],
+        user_id: str,
+        material_ids: Optional[List[str]],
+    ) -> Dict[str, Any]:
+        """共享文档的缓存条目可能由引用同一文件的其他用户写入：按当前用户的引用重新填写材料信息"""
+        shared = [
+            source["metadata"]
+            for source in result.get("sources") or []
+            if DOCUMENT_ID_KEY in (source.get("metadata") or {})
+        ]
+        if shared:
+            for metadata in shared:
+                for key in ("user_id", "material_id", "filename"):
+                    metadata.pop(key, None)
+            await self._scopes.annotate_metadata(user_id, material_ids, shared)
+        return result
 
-        sources: List[Dict[str, str]] = []
-        for node in response.source_nodes:
-            node_score = getattr(node, "score", None)
-            sources.append({
-                "snippet": node.get_content(),
-                "score": node_score,
-                "metadata": node.metadata,
-            })
+    async def _answer(self, *, question: str, user_id: str, material_ids: Optional[List[str]], top_k: int) -> Dict[str, Any]:
+        """检索 + LLM 合成（不经过响应缓存）"""
+        query_bundle = await self._query_bundle(question)
+        nodes = await self._search(
+            query_bundle,
+            user_id=user_id,
+            material_ids=material_ids,
+            top_k=top_k,
+        )
+        return await self._synthesize(query_bundle, nodes, user_id=user_id, material_ids=material_ids, top_k=top_k)
+
+    async def _synthesize(
+        self,
+        query_bundle: QueryBundle,
+        nodes: List[Any],
+        *,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+    ) -> Dict[str, Any]:
+        # sources 保持检索到的原始 chunk，合并 / 截断只作用于交给 LLM 的上下文
+        sources = self._nodes_to_sources(nodes)
+        with metrics.time("llm_synthesis"):
+            response = await self._query_layer.synthesizer.asynthesize(query_bundle, self._pack_context(nodes))
 
         answer_text = str(response)
         confidence = float(getattr(response, "score", 0.0) or 0.0)
-        print(f"[RAG Query Debug] question={question[:100]}, user_id={user_id}, material_ids={material_ids}")
-        print(f"[RAG Query Debug] Found {len(sources)} sources")
-        if sources:
-            print(f"[RAG Query Debug] First source metadata: {sources[0].get('metadata', {})}")
-        else:
-            print(f"[RAG Query Debug] ⚠️  NO SOURCES RETURNED!")
-            print(f"[RAG Query Debug] This usually means:")
-            print(f"[RAG Query Debug]   1. MongoDB Atlas Vector Search Index is missing")
-            print(f"[RAG Query Debug]   2. Index name doesn't match: {settings.MONGODB_VECTOR_INDEX}")
-            print(f"[RAG Query Debug]   3. Index is still building (not Active)")
-            print(f"[RAG Query Debug] See ATLAS_VECTOR_SEARCH_SETUP.md for instructions")
-            fallback_sources, fallback_summary = await asyncio.to_thread(
-                self._fallback_documents,
-                user_id,
-                material_ids,
-                top_k,
-            )
+        self._log_sources(query_bundle.query_str, user_id, material_ids, sources)
+        if not sources:
+            fallback_sources, fallback_summary = await self._fallback(user_id, material_ids, top_k)
             if fallback_sources:
-                print(f"[RAG Query Debug] ✅ Using MongoDB fallback (no vector index)")
                 sources = fallback_sources
                 if fallback_summary:
                     answer_text = fallback_summary
                 confidence = 0.0
-            else:
-                print(f"[RAG Query Debug] ❌ MongoDB fallback also returned 0 documents")
-        
+
         return {
             "answer": answer_text,
             "sources": sources,
             "confidence": confidence,
         }
 
-    def _fallback_documents(
+    async def stream_query(
+        self,
+        *,
+        question: str,
+        user_id: str,
+        material_ids: Optional[List[str]] = None,
+        top_k: int = 5,
+        include_metadata: bool = True,
+        fields: Optional[List[str]] = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """SSE 流式查询：检索完成后先发 `sources`，再逐个发 `token`，最后发 `metadata`"""
+        def sources_event(sources: List[Dict[str, Any]]) -> bytes:
+            return format_sse("sources", {
+                "sources": project_sources(sources, include_metadata=include_metadata, fields=fields),
+            })
+
+        try:
+            if not question:
+                raise ValueError("Question cannot be empty")
+
+            cache_key = None
+            if self._response_cache is not None:
+                cache_key = await self._response_cache.key(
+                    question=question,
+                    user_id=user_id,
+                    material_ids=material_ids,
+                    top_k=top_k,
+                )
+            cached = self._response_cache.peek(cache_key) if cache_key is not None else None
+            if cached is not None:
+                cached = await self._own_sources(cached, user_id, material_ids)
+                yield sources_event(cached["sources"])
+                yield format_sse("token", {"delta": cached["answer"]})
+                yield format_sse("metadata", {
+                    "answer": cached["answer"],
+                    "confidence": cached["confidence"],
+                    "cached": True,
+                })
+                return
+
+            query_bundle = await self._query_bundle(question)
+            nodes = await self._search(
+                query_bundle,
+                user_id=user_id,
+                material_ids=material_ids,
+                top_k=top_k,
+            )
+            sources = self._nodes_to_sources(nodes)
+            self._log_sources(question, user_id, material_ids, sources)
+
+            if sources:
+                yield sources_event(sources)
+                started = time.perf_counter()
+                response = await self._query_layer.streaming_synthesizer.asynthesize(
+                    query_bundle,
+                    self._pack_context(nodes),
+                )
+                chunks: List[str] = []
+                async for delta in response.async_response_gen():
+                    if delta:
+                        if not chunks:
+                            metrics.time_to_first_token(time.perf_counter() - started)
+                        chunks.append(delta)
+                        yield format_sse("token", {"delta": delta})
+                metrics.observe("llm_synthesis", time.perf_counter() - started)
+                answer_text = "".join(chunks)
+            else:
+                # 与 /query 一致：没有检索结果时不调用 LLM，改用 MongoDB 回退片段
+                fallback_sources, fallback_summary = await self._fallback(user_id, material_ids, top_k)
+                sources = fallback_sources
+                answer_text = fallback_summary or "Empty Response"
+                yield sources_event(sources)
+                yield format_sse("token", {"delta": answer_text})
+
+            if cache_key is not None:
+                self._response_cache.put(cache_key, {
+                    "answer": answer_text,
+                    "sources": sources,
+                    "confidence": 0.0,
+                })
+            yield format_sse("metadata", {"answer": answer_text, "confidence": 0.0, "cached": False})
+        except Exception as err:
+            yield format_sse("error", {"detail": str(err)})
+
+    async def retrieve(
+        self,
+        *,
+        question: str,
+        user_id: str,
+        material_ids: Optional[List[str]] = None,
+        top_k: int = 5,
+    ) -> Dict[str, Any]:
+        """只做向量检索，返回排序后的片段、分数和元数据，不调用 LLM 生成答案"""
+        if not question:
+            raise ValueError("Question cannot be empty")
+
+        query_bundle = await self._query_bundle(question)
+        nodes = await self._search(
+            query_bundle,
+            user_id=user_id,
+            material_ids=material_ids,
+            top_k=top_k,
+        )
+        sources = await self._retrieved_sources(nodes, user_id=user_id, material_ids=material_ids, top_k=top_k)
+
+        return {"sources": sources}
+
+    async def query_many(
+        self,
+        *,
+        questions: List[str],
+        user_id: str,
+        material_ids: Optional[List[str]] = None,
+        top_k: int = 5,
+        synthesize: bool = True,
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """批量查询：一次 embedding 请求向量化全部问题，检索与合成分别限制并发，
+        每个问题完成后立即产出 `{"index", "question", ...}`（顺序不保证）"""
+        if not questions:
+            return
+        if any(not question for question in questions):
+            raise ValueError("Question cannot be empty")
+
+        embed_batch = query_embedding_batch(Settings.embed_model)
+
+        async def embed_questions(texts: List[str]) -> List[List[float]]:
+            with metrics.time("embed"):
+                return await embed_batch(texts)
+
+        embeddings = await self._query_embeddings.get_or_compute_many(questions, embed_questions)
+        search_slots = asyncio.Semaphore(max(1, settings.RAG_BATCH_SEARCH_CONCURRENCY))
+        synthesis_slots = asyncio.Semaphore(max(1, settings.RAG_BATCH_SYNTHESIS_CONCURRENCY))
+
+        async def run_one(index: int, question: str, embedding: List[float]) -> Dict[str, Any]:
+            cache_key = None
+            if synthesize and self._response_cache is not None:
+                cache_key = await self._response_cache.key(
+                    question=question,
+                    user_id=user_id,
+                    material_ids=material_ids,
+                    top_k=top_k,
+                )
+            cached = self._response_cache.peek(cache_key) if cache_key is not None else None
+            if cached is not None:
+                cached = await self._own_sources(cached, user_id, material_ids)
+                return {"index": index, "question": question, **cached}
+
+            query_bundle = QueryBundle(query_str=question, embedding=embedding)
+            async with search_slots:
+                nodes = await self._search(
+                    query_bundle,
+                    user_id=user_id,
+                    material_ids=material_ids,
+                    top_k=top_k,
+                )
+            if not synthesize:
+                sources = await self._retrieved_sources(nodes, user_id=user_id, material_ids=material_ids, top_k=top_k)
+                return {"index": index, "question": question, "sources": sources}
+
+            async with synthesis_slots:
+                result = await self._synthesize(
+                    query_bundle,
+                    nodes,
+                    user_id=user_id,
+                    material_ids=material_ids,
+                    top_k=top_k,
+                )
+            if cache_key is not None:
+                self._response_cache.put(cache_key, result)
+            return {"index": index, "question": question, **result}
+
+        async def run_safely(index: int, question: str, embedding: List[float]) -> Dict[str, Any]:
+            try:
+                return await run_one(index, question, embedding)
+            except Exception as err:
+                return {"index": index, "question": question, "error": str(err)}
+
+        tasks = [
+            asyncio.ensure_future(run_safely(index, question, embedding))
+            for index, (question, embedding) in enumerate(zip(questions, embeddings))
+        ]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield await finished
+        finally:
+            # 调用方提前停止读取（如客户端断开）时取消剩余问题
+            for task in tasks:
+                task.cancel()
+
+    async def _retrieved_sources(
+        self,
+        nodes: List[Any],
+        *,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+    ) -> List[Dict[str, Any]]:
+        sources = self._nodes_to_sources(nodes)
+        if not sources:
+            metrics.log(
+                "rag.retrieve.no_vector_matches",
+                level=logging.WARNING,
+                user_id=user_id,
+                material_ids=material_ids,
+            )
+            sources, _ = await self._scoped_fallback_documents(user_id, material_ids, top_k)
+        return sources
+
+    def _pack_context(self, nodes: List[Any]) -> List[Any]:
+        """合成前合并重叠片段并按 token 预算打包"""
+        return pack_nodes(
+            nodes,
+            token_budget=settings.RAG_CONTEXT_TOKEN_BUDGET,
+            model=settings.OPENAI_COMPLETION_MODEL,
+        )
+
+    def _log_sources(
+        self,
+        question: str,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        sources: List[Dict[str, Any]],
+    ) -> None:
+        if sources:
+            metrics.log(
+                "rag.query.sources",
+                question=question[:100],
+                user_id=user_id,
+                material_ids=material_ids,
+                sources=len(sources),
+                first_source=sources[0].get("metadata", {}),
+            )
+            return
+        # 通常说明向量索引不存在、名称不符或仍在构建（见 GET /ready）
+        metrics.log(
+            "rag.query.no_sources",
+            level=logging.WARNING,
+            question=question[:100],
+            user_id=user_id,
+            material_ids=material_ids,
+            index=settings.MONGODB_VECTOR_INDEX,
+        )
+
+    async def _fallback(
         self,
         user_id: str,
         material_ids: Optional[List[str]],
         top_k: int,
     ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
-        """Return raw MongoDB chunks when Atlas Vector Search index is unavailable."""
-        query: Dict[str, Any] = {"metadata.user_id": user_id}
-        if material_ids:
-            query["metadata.material_id"] = {"$in": material_ids}
+        fallback_sources, fallback_summary = await self._scoped_fallback_documents(user_id, material_ids, top_k)
+        metrics.log(
+            "rag.query.fallback",
+            level=logging.WARNING,
+            user_id=user_id,
+            material_ids=material_ids,
+            sources=len(fallback_sources),
+        )
+        return fallback_sources, fallback_summary
+
+    async def _scoped_fallback_documents(
+        self,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        query = await self._scopes.vector_filter(user_id, material_ids)
+        with metrics.time("fallback"):
+            sources, summary = await asyncio.to_thread(self._fallback_documents, query, top_k)
+        await self._scopes.annotate_metadata(user_id, material_ids, [source["metadata"] for source in sources])
+        return sources, summary
+
+    async def _query_bundle(self, question: str) -> QueryBundle:
+        query_embedding = await self._query_embeddings.get_or_compute(question, lambda: self._embed_query(question))
+        return QueryBundle(query_str=question, embedding=query_embedding)
+
+    async def _embed_query(self, question: str) -> List[float]:
+        with metrics.time("embed"):
+            return await Settings.embed_model.aget_query_embedding(question)
+
+    async def _search(self, query_bundle: QueryBundle, **kwargs: Any) -> List[Any]:
+        with metrics.time("vector_search"):
+            return await self._vector_backend.search(query_bundle, **kwargs)
+
+    def _nodes_to_sources(self, nodes: List[Any]) -> List[Dict[str, Any]]:
+        sources: List[Dict[str, Any]] = []
+        for node in nodes:
+            node_score = getattr(node, "score", None)
+            sources.append({
+                "snippet": node.get_content(),
+                "score": node_score,
+                "metadata": public_metadata(node.metadata),
+            })
+        return sources
 
+    def _fallback_documents(
+        self,
+        query: Dict[str, Any],
+        top_k: int,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Return raw MongoDB chunks when Atlas Vector Search index is unavailable."""
         cursor = (
             self._collection
-            .find(query)
+            .find(query, LEAN_CHUNK_PROJECTION)
             .sort("metadata.material_id", 1)
             .limit(max(top_k * 3, top_k))
         )
@@ -175,16 +1054,14 @@ class RAGPipeline:
         snippets: List[str] = []
 
         for doc in cursor:
-            metadata = doc.get("metadata", {}) or {}
-            raw_snippet = metadata.get("_node_content") or doc.get("text") or ""
-            snippet = str(raw_snippet).strip()
+            snippet = str(doc.get("text") or "").strip()
             if not snippet:
                 continue
 
             sources.append({
                 "snippet": snippet,
                 "score": None,
-                "metadata": metadata,
+                "metadata": public_metadata(doc.get("metadata", {}) or {}),
             })
             snippets.append(snippet)
 
@@ -0,0 +1,419 @@
+"""向量检索后端
+
+RAGPipeline 通过 `search()` 取回带分数的节点，再决定是否交给 LLM 合成答案：
+- LlamaIndexBackend：MongoDBAtlasVectorSearch（同步 pymongo，放到线程池执行）
+- AtlasAggregationBackend：通过 motor 异步客户端直接发出 `$vectorSearch` 聚合
+- LocalNumpyBackend：把用户的向量载入内存矩阵做精确余弦 top-k，用于没有 Atlas 的部署
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Protocol, Sequence, Tuple
+
+import numpy as np
+from llama_index.core import QueryBundle
+from llama_index.core.schema import NodeWithScore, TextNode
+from llama_index.core.vector_stores import MetadataFilter, MetadataFilters
+
+from chunk_schema import expand_page_label
+from ingestion import DOCUMENT_ID_KEY
+from query_cache import material_scope, user_scope
+from vector_codec import vector_to_array
+
+# LlamaIndex 写入 metadata 的内部字段，不属于业务元数据
+NODE_INTERNAL_METADATA_KEYS = ("doc_id", "document_id", "ref_doc_id")
+
+# 只读文本和元数据时排除的大字段：向量（含紧凑存储的全精度副本）和 LlamaIndex
+# 序列化的整个节点 `_node_content`（与 text 重复）
+LEAN_CHUNK_PROJECTION: Dict[str, int] = {
+    "embedding": 0,
+    "embedding_full": 0,
+    "metadata._node_content": 0,
+}
+
+
+class VectorBackend(Protocol):
+    async def search(
+        self,
+        query_bundle: QueryBundle,
+        *,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+    ) -> List[NodeWithScore]:
+        ...
+
+
+def metadata_filters(user_id: str, material_ids: Optional[List[str]]) -> MetadataFilters:
+    filters_list = [MetadataFilter(key="user_id", value=user_id)]
+    if material_ids:
+        filters_list.append(MetadataFilter(key="material_id", value=material_ids, operator="in"))
+    return MetadataFilters(filters=filters_list)
+
+
+def vector_search_filter(user_id: str, material_ids: Optional[List[str]]) -> Dict[str, Any]:
+    """`$vectorSearch` 预过滤条件（字段需在 Atlas 索引中声明为 filter 类型）"""
+    mql: Dict[str, Any] = {"metadata.user_id": {"$eq": user_id}}
+    if material_ids:
+        mql["metadata.material_id"] = {"$in": list(material_ids)}
+    return mql
+
+
+def row_key(metadata: Dict[str, Any]) -> str:
+    """进程内索引（BM25 / ANN / numpy 矩阵）里每行的过滤键：共享 chunk 用 file_hash，按用户存储的 chunk 用 material_id"""
+    return str(metadata.get(DOCUMENT_ID_KEY) or metadata.get("material_id", ""))
+
+
+class PrivateScopes:
+    """chunk 直接带 user_id / material_id 的按用户存储（RAG_DOCUMENT_STORAGE=private）"""
+
+    async def vector_filter(self, user_id: str, material_ids: Optional[Sequence[str]]) -> Dict[str, Any]:
+        """`$vectorSearch` / find 的过滤条件"""
+        return vector_search_filter(user_id, list(material_ids) if material_ids else None)
+
+    async def user_filter(self, user_id: str) -> Dict[str, Any]:
+        """用户可访问的全部 chunk（载入进程内索引时使用）"""
+        return {"metadata.user_id": user_id}
+
+    async def row_keys(self, user_id: str, material_ids: Optional[Sequence[str]]) -> Optional[List[str]]:
+        """进程内索引按 row_key 过滤时允许的键"""
+        return list(material_ids) if material_ids else None
+
+    async def cache_scopes(self, user_id: str, material_ids: Optional[Sequence[str]]) -> List[str]:
+        """回答缓存的内容范围：这些范围内写入 / 删除 chunk 时相关缓存条目失效"""
+        if material_ids:
+            return [material_scope(user_id, material_id) for material_id in sorted(set(material_ids))]
+        return [user_scope(user_id)]
+
+    async def annotate(
+        self,
+        user_id: str,
+        material_ids: Optional[Sequence[str]],
+        nodes: List[NodeWithScore],
+    ) -> List[NodeWithScore]:
+        await self.annotate_metadata(user_id, material_ids, [node.node.metadata for node in nodes])
+        return nodes
+
+    async def annotate_metadata(
+        self,
+        user_id: str,
+        material_ids: Optional[Sequence[str]],
+        metadatas: List[Dict[str, Any]],
+    ) -> None:
+        """就地补全检索结果的业务元数据"""
+
+    def invalidate(self, user_id: str) -> None:
+        pass
+
+
+def public_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    return expand_page_label({
+        key: value
+        for key, value in metadata.items()
+        if not key.startswith("_") and key not in NODE_INTERNAL_METADATA_KEYS
+    })
+
+
+def doc_to_node(doc: Dict[str, Any], *, text_key: str = "text") -> NodeWithScore:
+    node = TextNode(
+        id_=str(doc.get("_id")),
+        text=doc.get(text_key) or "",
+        metadata=public_metadata(doc.get("metadata") or {}),
+    )
+    return NodeWithScore(node=node, score=doc.get("score"))
+
+
+class LlamaIndexBackend:
+    def __init__(self, query_layer: Any) -> None:
+        self._query_layer = query_layer
+
+    async def search(
+        self,
+        query_bundle: QueryBundle,
+        *,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+    ) -> List[NodeWithScore]:
+        retriever = self._query_layer.retriever(
+            top_k=top_k,
+            filters=metadata_filters(user_id, material_ids),
+        )
+        return await asyncio.to_thread(retriever.retrieve, query_bundle)
+
+
+class AtlasAggregationBackend:
+    """motor + `$vectorSearch`，不占用线程池，也不经过 LlamaIndex 的节点反序列化"""
+
+    def __init__(
+        self,
+        collection: Any,
+        *,
+        index_name: str,
+        embedding_key: str = "embedding",
+        text_key: str = "text",
+        num_candidates_factor: int = 10,
+        query_encoder: Optional[Callable[[List[float]], Any]] = None,
+        scopes: Optional[PrivateScopes] = None,
+    ) -> None:
+        self._collection = collection
+        self._index_name = index_name
+        self._embedding_key = embedding_key
+        self._text_key = text_key
+        self._num_candidates_factor = max(1, num_candidates_factor)
+        # 索引字段是量化向量时，queryVector 需编码为同类型的 BSON vector
+        self._query_encoder = query_encoder or list
+        self._scopes = scopes or PrivateScopes()
+
+    def pipeline(
+        self,
+        query_vector: Any,
+        *,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+        search_filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Dict[str, Any]]:
+        return [
+            {
+                "$vectorSearch": {
+                    "index": self._index_name,
+                    "path": self._embedding_key,
+                    "queryVector": query_vector,
+                    "numCandidates": min(top_k * self._num_candidates_factor, 10000),
+                    "limit": top_k,
+                    "filter": search_filter if search_filter is not None else vector_search_filter(user_id, material_ids),
+                }
+            },
+            {
+                "$project": {
+                    self._text_key: 1,
+                    "metadata": 1,
+                    "score": {"$meta": "vectorSearchScore"},
+                }
+            },
+            {"$project": {"metadata._node_content": 0}},
+        ]
+
+    async def search(
+        self,
+        query_bundle: QueryBundle,
+        *,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+    ) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            raise ValueError("AtlasAggregationBackend requires a precomputed query embedding")
+
+        pipeline = self.pipeline(
+            self._query_encoder(query_bundle.embedding),
+            user_id=user_id,
+            material_ids=material_ids,
+            top_k=top_k,
+            search_filter=await self._scopes.vector_filter(user_id, material_ids),
+        )
+        docs = await self._collection.aggregate(pipeline).to_list(length=top_k)
+        return [doc_to_node(doc, text_key=self._text_key) for doc in docs]
+
+
+@dataclass
+class UserMatrix:
+    """单个用户全部 chunk 的连续 float32 矩阵（行已归一化）"""
+
+    ids: List[Any]
+    material_ids: np.ndarray
+    vectors: np.ndarray
+    loaded_at: float
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """argpartition 选出 top-k，再只对这 k 个排序"""
+    if scores.size <= top_k:
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+async def load_user_vectors(
+    collection: Any,
+    user_id: str,
+    *,
+    embedding_key: str = "embedding",
+    query: Optional[Dict[str, Any]] = None,
+) -> Tuple[List[Any], List[str], np.ndarray]:
+    """读取一个用户可访问的全部 chunk 向量，返回 (ids, 每行的 row_key, 行归一化的 float32 矩阵)"""
+    cursor = collection.find(
+        query if query is not None else {"metadata.user_id": user_id},
+        {embedding_key: 1, "metadata.material_id": 1, f"metadata.{DOCUMENT_ID_KEY}": 1},
+    )
+    ids: List[Any] = []
+    material_ids: List[str] = []
+    vectors: List[np.ndarray] = []
+    async for doc in cursor:
+        embedding = doc.get(embedding_key)
+        if not embedding:
+            continue
+        ids.append(doc["_id"])
+        material_ids.append(row_key(doc.get("metadata") or {}))
+        vectors.append(vector_to_array(embedding))
+
+    if not vectors:
+        return [], [], np.empty((0, 0), dtype=np.float32)
+
+    matrix = np.ascontiguousarray(normalize_rows(np.stack(vectors)))
+    return ids, material_ids, matrix
+
+
+async def hydrate_nodes(
+    collection: Any,
+    ranked: List[Tuple[Any, float]],
+    *,
+    text_key: str = "text",
+) -> List[NodeWithScore]:
+    """按 `_id` 取回排好序的 chunk 的文本和元数据，保持 ranked 的顺序"""
+    if not ranked:
+        return []
+
+    ranked_ids = [doc_id for doc_id, _ in ranked]
+    docs = await collection.find(
+        {"_id": {"$in": ranked_ids}},
+        LEAN_CHUNK_PROJECTION,
+    ).to_list(length=len(ranked_ids))
+    docs_by_id = {doc["_id"]: doc for doc in docs}
+
+    nodes: List[NodeWithScore] = []
+    for doc_id, score in ranked:
+        doc = docs_by_id.get(doc_id)
+        if doc is None:
+            continue
+        doc["score"] = score
+        nodes.append(doc_to_node(doc, text_key=text_key))
+    return nodes
+
+
+class LocalNumpyBackend:
+    """普通 MongoDB 上的精确向量检索
+
+    每个用户的向量按需载入一次并缓存（LRU + TTL）；检索时用 numpy 做矩阵-向量乘，
+    再按 `_id` 取回 top-k 的文本和元数据。
+    """
+
+    def __init__(
+        self,
+        collection: Any,
+        *,
+        embedding_key: str = "embedding",
+        text_key: str = "text",
+        max_users: int = 64,
+        ttl_seconds: float = 300.0,
+        scopes: Optional[PrivateScopes] = None,
+    ) -> None:
+        self._collection = collection
+        self._scopes = scopes or PrivateScopes()
+        self._embedding_key = embedding_key
+        self._text_key = text_key
+        self._max_users = max(1, max_users)
+        self._ttl_seconds = ttl_seconds
+        self._matrices: "OrderedDict[str, UserMatrix]" = OrderedDict()
+        self._load_locks: Dict[str, asyncio.Lock] = {}
+        # 摄取线程只写这个字典（单次赋值是原子的），事件循环在读取矩阵时比较时间戳
+        self._invalidated_at: Dict[str, float] = {}
+
+    def invalidate(self, user_id: str) -> None:
+        """新 chunk 写入后调用，下次检索时重新载入该用户的矩阵"""
+        self._invalidated_at[user_id] = time.monotonic()
+
+    async def search(
+        self,
+        query_bundle: QueryBundle,
+        *,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+    ) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            raise ValueError("LocalNumpyBackend requires a precomputed query embedding")
+
+        matrix = await self._user_matrix(user_id)
+        if matrix is None or top_k <= 0:
+            return []
+
+        query = np.asarray(query_bundle.embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm:
+            query = query / query_norm
+
+        keys = await self._scopes.row_keys(user_id, material_ids)
+        if keys:
+            rows = np.flatnonzero(np.isin(matrix.material_ids, keys))
+            if rows.size == 0:
+                return []
+            scores = matrix.vectors[rows] @ query
+        else:
+            rows = None
+            scores = matrix.vectors @ query
+
+        best = top_k_indices(scores, top_k)
+        if rows is not None:
+            best_rows = rows[best]
+        else:
+            best_rows = best
+        ranked = [(matrix.ids[row], float(score)) for row, score in zip(best_rows, scores[best])]
+        return await hydrate_nodes(self._collection, ranked, text_key=self._text_key)
+
+    async def _user_matrix(self, user_id: str) -> Optional[UserMatrix]:
+        matrix = self._fresh_matrix(user_id)
+        if matrix is not None:
+            return matrix
+
+        lock = self._load_locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            matrix = self._fresh_matrix(user_id)
+            if matrix is None:
+                matrix = await self._load_user_matrix(user_id)
+                if matrix is not None:
+                    self._matrices[user_id] = matrix
+                    while len(self._matrices) > self._max_users:
+                        self._matrices.popitem(last=False)
+            # 仍在等待这把锁的协程进入后会直接拿到已载入的矩阵
+            self._load_locks.pop(user_id, None)
+        return matrix
+
+    def _fresh_matrix(self, user_id: str) -> Optional[UserMatrix]:
+        matrix = self._matrices.get(user_id)
+        if matrix is None:
+            return None
+        expired = time.monotonic() - matrix.loaded_at > self._ttl_seconds
+        if expired or matrix.loaded_at <= self._invalidated_at.get(user_id, 0.0):
+            del self._matrices[user_id]
+            return None
+        self._matrices.move_to_end(user_id)
+        return matrix
+
+    async def _load_user_matrix(self, user_id: str) -> Optional[UserMatrix]:
+        loaded_at = time.monotonic()
+        ids, material_ids, vectors = await load_user_vectors(
+            self._collection,
+            user_id,
+            embedding_key=self._embedding_key,
+            query=await self._scopes.user_filter(user_id),
+        )
+        if not ids:
+            return None
+
+        return UserMatrix(
+            ids=ids,
+            material_ids=np.asarray(material_ids),
+            vectors=vectors,
+            loaded_at=loaded_at,
+        )
@@ -0,0 +1,195 @@
+"""紧凑向量存储：Matryoshka 截断 + int8 / 二值量化，可选全精度重排
+
+text-embedding-3 系列的向量可以直接截断前 N 维再归一化（Matryoshka 表示），
+召回损失很小。截断后的向量再按需量化：
+- none：float32
+- int8：每个向量按自身最大绝对值缩放到 [-127, 127]（余弦相似度与缩放无关，无需存 scale）
+- binary：只保留符号位，按位打包
+
+首轮检索字段 `embedding` 以 BSON vector（Binary subtype 9）存储，Atlas `$vectorSearch`
+可以直接索引；需要重排时额外存一份全精度 float32 的 `embedding_full`，只在取回
+top 候选时读取。
+"""
+from __future__ import annotations
+
+import struct
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+from bson.binary import Binary
+from llama_index.core import QueryBundle
+from llama_index.core.schema import NodeWithScore
+
+QUANTIZATION_MODES = ("none", "int8", "binary")
+
+# BSON vector 子类型及 dtype 头字节（BSON binary vector 规范）
+BSON_VECTOR_SUBTYPE = 9
+DTYPE_INT8 = 0x03
+DTYPE_FLOAT32 = 0x27
+DTYPE_PACKED_BIT = 0x10
+
+
+def bson_vector(values: np.ndarray, dtype: int, padding: int = 0) -> Binary:
+    return Binary(struct.pack("<BB", dtype, padding) + values.tobytes(), BSON_VECTOR_SUBTYPE)
+
+
+def vector_to_array(value: Any) -> np.ndarray:
+    """把存储的向量（BSON 数组或 BSON vector）还原为 float32 数组
+
+    int8 还原为量化码本身，二值向量还原为 ±1；两者都只用于余弦比较。
+    """
+    if isinstance(value, Binary) and value.subtype == BSON_VECTOR_SUBTYPE:
+        dtype, padding = struct.unpack_from("<BB", value, 0)
+        payload = bytes(value[2:])
+        if dtype == DTYPE_FLOAT32:
+            return np.frombuffer(payload, dtype="<f4").astype(np.float32)
+        if dtype == DTYPE_INT8:
+            return np.frombuffer(payload, dtype=np.int8).astype(np.float32)
+        if dtype == DTYPE_PACKED_BIT:
+            bits = np.unpackbits(np.frombuffer(payload, dtype=np.uint8))
+            if padding:
+                bits = bits[:-padding]
+            return bits.astype(np.float32) * 2.0 - 1.0
+        raise ValueError(f"Unsupported BSON vector dtype: {dtype:#x}")
+    return np.asarray(value, dtype=np.float32)
+
+
+def _normalize(vector: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class VectorCodec:
+    def __init__(self, *, dimensions: int = 0, quantization: str = "none", keep_full: bool = False) -> None:
+        if quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown RAG_VECTOR_QUANTIZATION: {quantization}")
+        self.dimensions = max(0, dimensions)
+        self.quantization = quantization
+        self.keep_full = keep_full
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.dimensions) or self.quantization != "none"
+
+    @property
+    def signature(self) -> str:
+        """存储格式标识（截断维度 / 量化方式 / 是否保留全精度副本），参与 chunk _id"""
+        return f"{self.dimensions or 'full'}-{self.quantization}{'+full' if self.keep_full else ''}"
+
+    def reduce(self, embedding: Sequence[float]) -> np.ndarray:
+        """Matryoshka 截断并重新归一化"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        if self.dimensions and vector.shape[0] > self.dimensions:
+            vector = vector[: self.dimensions]
+        return _normalize(vector)
+
+    def encode(self, embedding: Sequence[float]) -> Binary:
+        """首轮检索字段的存储值"""
+        vector = self.reduce(embedding)
+        if self.quantization == "int8":
+            return bson_vector(self._int8_codes(vector), DTYPE_INT8)
+        if self.quantization == "binary":
+            padding = (-vector.shape[0]) % 8
+            return bson_vector(np.packbits(vector > 0), DTYPE_PACKED_BIT, padding)
+        return bson_vector(vector.astype("<f4"), DTYPE_FLOAT32)
+
+    def encode_full(self, embedding: Sequence[float]) -> Binary:
+        return bson_vector(np.asarray(embedding, dtype="<f4"), DTYPE_FLOAT32)
+
+    def first_pass_vector(self, embedding: Sequence[float]) -> np.ndarray:
+        """与从库里读出的首轮向量一致的 float32 表示（供本地索引追加新 chunk）"""
+        return vector_to_array(self.encode(embedding))
+
+    def query_vector(self, embedding: Sequence[float]) -> List[float]:
+        """首轮检索的问题向量：只截断不量化（非对称比较，召回更好）"""
+        return self.reduce(embedding).tolist()
+
+    def atlas_query_vector(self, embedding: Sequence[float]) -> Any:
+        """`$vectorSearch` 的 queryVector 需要与索引字段同类型"""
+        vector = self.reduce(embedding)
+        if self.quantization == "int8":
+            return bson_vector(self._int8_codes(vector), DTYPE_INT8)
+        if self.quantization == "binary":
+            padding = (-vector.shape[0]) % 8
+            return bson_vector(np.packbits(vector > 0), DTYPE_PACKED_BIT, padding)
+        return vector.tolist()
+
+    @staticmethod
+    def _int8_codes(vector: np.ndarray) -> np.ndarray:
+        scale = float(np.max(np.abs(vector))) or 1.0
+        return np.clip(np.rint(vector / scale * 127.0), -127, 127).astype(np.int8)
+
+
+class RescoringBackend:
+    """在任一 VectorBackend 之上：用截断 / 量化向量取 top_k × factor 个候选，
+    再用全精度向量重新打分，只返回 top_k"""
+
+    def __init__(
+        self,
+        inner: Any,
+        collection: Any,
+        codec: VectorCodec,
+        *,
+        rescore_factor: int = 0,
+        full_embedding_key: str = "embedding_full",
+    ) -> None:
+        self._inner = inner
+        self._collection = collection
+        self._codec = codec
+        self._rescore_factor = rescore_factor if codec.keep_full else 0
+        self._full_embedding_key = full_embedding_key
+
+    @property
+    def inner(self) -> Any:
+        return self._inner
+
+    async def search(
+        self,
+        query_bundle: QueryBundle,
+        *,
+        user_id: str,
+        material_ids: Optional[List[str]],
+        top_k: int,
+    ) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            raise ValueError("RescoringBackend requires a precomputed query embedding")
+
+        full_query = query_bundle.embedding
+        first_pass = QueryBundle(
+            query_str=query_bundle.query_str,
+            embedding=self._codec.query_vector(full_query),
+        )
+        candidate_k = top_k * self._rescore_factor if self._rescore_factor > 1 else top_k
+        nodes = await self._inner.search(
+            first_pass,
+            user_id=user_id,
+            material_ids=material_ids,
+            top_k=candidate_k,
+        )
+        if candidate_k == top_k or len(nodes) <= 1:
+            return nodes[:top_k]
+        return (await self._rescore(full_query, nodes))[:top_k]
+
+    async def _rescore(self, full_query: Sequence[float], nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        ids = [node.node.node_id for node in nodes]
+        docs = await self._collection.find(
+            {"_id": {"$in": ids}},
+            {self._full_embedding_key: 1},
+        ).to_list(length=len(ids))
+        full_by_id = {
+            str(doc["_id"]): doc[self._full_embedding_key]
+            for doc in docs
+            if doc.get(self._full_embedding_key) is not None
+        }
+
+        query = _normalize(np.asarray(full_query, dtype=np.float32))
+        for node in nodes:
+            stored = full_by_id.get(node.node.node_id)
+            if stored is not None:
+                node.score = float(_normalize(vector_to_array(stored)) @ query)
+        # 没有全精度向量的旧文档保留首轮分数，排在重排结果之后
+        return sorted(
+            nodes,
+            key=lambda node: (node.node.node_id in full_by_id, node.score or 0.0),
+            reverse=True,
+        )
@@ -30,6 +30,13 @@ class Settings:
     RAG_SERVICE_URL: str = os.getenv('RAG_SERVICE_URL', 'http://localhost:8001')
     AGENT_SERVICE_URL: str = os.getenv('AGENT_SERVICE_URL', 'http://localhost:8002')
     QUIZ_SERVICE_URL: str = os.getenv('QUIZ_SERVICE_URL', 'http://localhost:8003')
+
+    # 调用 RAG 服务的默认模式：retrieve（只检索，不调用 LLM）或 query（检索 + 生成摘要）
+    QUIZ_RAG_MODE: str = os.getenv('QUIZ_RAG_MODE', 'retrieve')
+    AGENT_RAG_MODE: str = os.getenv('AGENT_RAG_MODE', 'query')
+    # quiz / agent 提示词中课程片段的 token 预算（重叠片段合并后按排名填充）
+    QUIZ_CONTEXT_TOKEN_BUDGET: int = int(os.getenv('QUIZ_CONTEXT_TOKEN_BUDGET', '1500'))
+    AGENT_CONTEXT_TOKEN_BUDGET: int = int(os.getenv('AGENT_CONTEXT_TOKEN_BUDGET', '1000'))
     
     # Cloudflare R2（如果 Python 服务需要直接访问）
     R2_ACCOUNT_ID: str = os.getenv('R2_ACCOUNT_ID', '')
@@ -42,6 +49,129 @@ class Settings:
     MONGODB_VECTOR_DB: str = os.getenv('MONGODB_VECTOR_DB', 'AIAssistant')
     MONGODB_VECTOR_COLLECTION: str = os.getenv('MONGODB_VECTOR_COLLECTION', 'rag_vectors')
     MONGODB_VECTOR_INDEX: str = os.getenv('MONGODB_VECTOR_INDEX', 'vector_index')
+    # 启动时的向量索引管理：verify（只校验）、create（不存在则创建，缺少过滤字段或维度 / 相似度不符时更新，
+    # 需要 createSearchIndexes 权限）或 off（不检查，不阻塞就绪）；verify / create 下索引确认可查询之前 /ready 返回 503。
+    # 维度 0 = 按截断维度 / embedding 模型自动推断，相似度留空 = 按量化方式选择（binary 为 euclidean，其余 cosine）；
+    # 构建中按 POLL_SECONDS 轮询，缺失 / 定义不符时轮询间隔翻倍，最长 MAX_POLL_SECONDS
+    RAG_VECTOR_INDEX_PROVISION: str = os.getenv('RAG_VECTOR_INDEX_PROVISION', 'verify')
+    RAG_VECTOR_INDEX_DIMENSIONS: int = int(os.getenv('RAG_VECTOR_INDEX_DIMENSIONS', '0'))
+    RAG_VECTOR_INDEX_SIMILARITY: str = os.getenv('RAG_VECTOR_INDEX_SIMILARITY', '')
+    RAG_VECTOR_INDEX_POLL_SECONDS: float = float(os.getenv('RAG_VECTOR_INDEX_POLL_SECONDS', '5'))
+    RAG_VECTOR_INDEX_MAX_POLL_SECONDS: float = float(os.getenv('RAG_VECTOR_INDEX_MAX_POLL_SECONDS', '300'))
+
+    # 向量检索后端：atlas（motor 直接发出 $vectorSearch）、llamaindex（MongoDBAtlasVectorSearch）
+    # local（普通 MongoDB，进程内 numpy 精确检索）或 ann（按用户分区的 IVF 索引，memmap 持久化）
+    RAG_VECTOR_BACKEND: str = os.getenv('RAG_VECTOR_BACKEND', 'atlas')
+    RAG_VECTOR_NUM_CANDIDATES_FACTOR: int = int(os.getenv('RAG_VECTOR_NUM_CANDIDATES_FACTOR', '10'))
+    RAG_LOCAL_VECTOR_MAX_USERS: int = int(os.getenv('RAG_LOCAL_VECTOR_MAX_USERS', '64'))
+    RAG_LOCAL_VECTOR_TTL: int = int(os.getenv('RAG_LOCAL_VECTOR_TTL', '300'))
+    RAG_ANN_INDEX_DIR: str = os.getenv('RAG_ANN_INDEX_DIR', '.cache/ann')
+    RAG_ANN_NPROBE: int = int(os.getenv('RAG_ANN_NPROBE', '32'))
+    RAG_ANN_MIN_TRAIN_ROWS: int = int(os.getenv('RAG_ANN_MIN_TRAIN_ROWS', '5000'))
+    # 分区从 MongoDB 完整构建后的有效秒数，过期后下次检索重建（看到其他 pod 写入的 chunk；0 = 不过期）
+    RAG_ANN_INDEX_TTL: int = int(os.getenv('RAG_ANN_INDEX_TTL', '3600'))
+
+    # 紧凑向量存储：截断维度（0 = 保留模型原始维度）、量化方式（none / int8 / binary）
+    # 重排倍数 > 1 时额外保存全精度向量，首轮取 top_k × 倍数 个候选再用全精度重新打分
+    RAG_VECTOR_DIMENSIONS: int = int(os.getenv('RAG_VECTOR_DIMENSIONS', '0'))
+    RAG_VECTOR_QUANTIZATION: str = os.getenv('RAG_VECTOR_QUANTIZATION', 'none')
+    RAG_VECTOR_RESCORE_FACTOR: int = int(os.getenv('RAG_VECTOR_RESCORE_FACTOR', '4'))
+
+    # chunk 文档结构：compact（文本只存一份 + 精简类型化元数据 + chunk 序号）
+    # 或 llamaindex（MongoDBAtlasVectorSearch 默认结构）；旧数据用 scripts/migrate_rag_chunks_compact.py 迁移
+    RAG_CHUNK_SCHEMA: str = os.getenv('RAG_CHUNK_SCHEMA', 'compact')
+
+    # 文档存储：private（默认，每个材料各存一份）或 shared（同一文件跨用户只解析、向量化、
+    # 存储一次，用户/材料只保存引用）；shared 需要 Atlas 索引把 metadata.file_hash 设为过滤字段，
+    # 开启后重新处理的材料会删除其按用户存储的旧 chunk，迁移说明见 README
+    RAG_DOCUMENT_STORAGE: str = os.getenv('RAG_DOCUMENT_STORAGE', 'private')
+    RAG_DOCUMENTS_COLLECTION: str = os.getenv('RAG_DOCUMENTS_COLLECTION', 'rag_documents')
+    RAG_MATERIAL_REFS_COLLECTION: str = os.getenv('RAG_MATERIAL_REFS_COLLECTION', 'rag_material_refs')
+    RAG_MATERIAL_REF_CACHE_TTL: int = int(os.getenv('RAG_MATERIAL_REF_CACHE_TTL', '30'))
+
+    # 检索模式：vector（纯向量）或 hybrid（BM25 + 向量，倒数排名融合）
+    RAG_RETRIEVAL_MODE: str = os.getenv('RAG_RETRIEVAL_MODE', 'vector')
+    RAG_RRF_K: int = int(os.getenv('RAG_RRF_K', '60'))
+    RAG_LEXICAL_MAX_USERS: int = int(os.getenv('RAG_LEXICAL_MAX_USERS', '256'))
+    # BM25 索引载入后的有效秒数，过期后下次检索重建（看到其他 worker 写入的 chunk）
+    RAG_LEXICAL_INDEX_TTL: int = int(os.getenv('RAG_LEXICAL_INDEX_TTL', '300'))
+
+    # MMR 多样性重排（候选倍数 ≤ 1 表示关闭，默认关闭；λ 越大越偏向相关性）与 LLM 合成的上下文 token 预算（只作用于提示词）
+    RAG_MMR_CANDIDATE_FACTOR: int = int(os.getenv('RAG_MMR_CANDIDATE_FACTOR', '1'))
+    RAG_MMR_LAMBDA: float = float(os.getenv('RAG_MMR_LAMBDA', '0.5'))
+    RAG_CONTEXT_TOKEN_BUDGET: int = int(os.getenv('RAG_CONTEXT_TOKEN_BUDGET', '3000'))
+
+    # RAG 后台摄取队列
+    RAG_INGEST_WORKERS: int = int(os.getenv('RAG_INGEST_WORKERS', '2'))
+    RAG_INGEST_MAX_PENDING: int = int(os.getenv('RAG_INGEST_MAX_PENDING', '32'))
+    # 摄取任务状态集合（GET /process/{job_id} 跨 worker / 重启可查）与结束后保留秒数
+    RAG_INGEST_JOBS_COLLECTION: str = os.getenv('RAG_INGEST_JOBS_COLLECTION', 'rag_ingest_jobs')
+    RAG_INGEST_JOB_RETENTION: int = int(os.getenv('RAG_INGEST_JOB_RETENTION', '3600'))
+    RAG_INGEST_BATCH_SIZE: int = int(os.getenv('RAG_INGEST_BATCH_SIZE', '64'))
+    RAG_INGEST_MAX_IN_FLIGHT: int = int(os.getenv('RAG_INGEST_MAX_IN_FLIGHT', '2'))
+
+    # Embedding 后端：openai、local（本地 CPU 上的 ONNX 句向量模型）或 hash（确定性的测试 embedder，离线可用）
+    # 切换后端会改变向量空间与维度，需要重新处理材料（chunk _id 含模型标识，重新处理时全部重新向量化）
+    RAG_EMBED_BACKEND: str = os.getenv('RAG_EMBED_BACKEND', 'openai')
+    # local：模型目录（tokenizer.json + model_quantized.onnx / model.onnx）、ONNX 文件名（空 = 自动查找）、
+    # 池化方式（cls / mean）、最大 token 数、推理批大小、onnxruntime 线程数（0 = CPU 核数）、问题前缀
+    RAG_LOCAL_EMBED_MODEL_DIR: str = os.getenv('RAG_LOCAL_EMBED_MODEL_DIR', 'models/bge-small-en-v1.5')
+    RAG_LOCAL_EMBED_ONNX_FILE: str = os.getenv('RAG_LOCAL_EMBED_ONNX_FILE', '')
+    RAG_LOCAL_EMBED_POOLING: str = os.getenv('RAG_LOCAL_EMBED_POOLING', 'cls')
+    RAG_LOCAL_EMBED_MAX_LENGTH: int = int(os.getenv('RAG_LOCAL_EMBED_MAX_LENGTH', '512'))
+    RAG_LOCAL_EMBED_BATCH_SIZE: int = int(os.getenv('RAG_LOCAL_EMBED_BATCH_SIZE', '32'))
+    RAG_LOCAL_EMBED_THREADS: int = int(os.getenv('RAG_LOCAL_EMBED_THREADS', '0'))
+    RAG_LOCAL_EMBED_QUERY_PREFIX: str = os.getenv('RAG_LOCAL_EMBED_QUERY_PREFIX', '')
+    # hash：向量维度
+    RAG_HASH_EMBED_DIMENSIONS: int = int(os.getenv('RAG_HASH_EMBED_DIMENSIONS', '256'))
+
+    # 摄取切分器：fast（单遍句子边界扫描 + 下标计算重叠，输出与 SentenceSplitter 逐 chunk 一致）或 llamaindex
+    RAG_CHUNKER: str = os.getenv('RAG_CHUNKER', 'fast')
+
+    # chunk 向量化调度（RAG_EMBED_BACKEND=openai，进程内所有摄取线程共用）：单个请求的 token / 条数上限、初始与最大并发、
+    # 429 / 5xx / 连接错误的最大重试次数，以及摄取线程等待一批向量的最长秒数；并发在上下限之间按限流响应头和 429 自适应调整。
+    # 并发上限与限流暂停经 RAG_EMBED_LIMITS_COLLECTION 在所有 worker / Pod 间共享（各进程分得全局上限 / 存活进程数，
+    # 最大并发为全局上限）；留空时各进程独立调整，总并发最多为 RAG_EMBED_MAX_CONCURRENCY × 进程数
+    RAG_EMBED_BATCH_MAX_TOKENS: int = int(os.getenv('RAG_EMBED_BATCH_MAX_TOKENS', '100000'))
+    RAG_EMBED_BATCH_MAX_INPUTS: int = int(os.getenv('RAG_EMBED_BATCH_MAX_INPUTS', '2048'))
+    RAG_EMBED_CONCURRENCY: int = int(os.getenv('RAG_EMBED_CONCURRENCY', '4'))
+    RAG_EMBED_MAX_CONCURRENCY: int = int(os.getenv('RAG_EMBED_MAX_CONCURRENCY', '16'))
+    RAG_EMBED_MAX_RETRIES: int = int(os.getenv('RAG_EMBED_MAX_RETRIES', '8'))
+    RAG_EMBED_RESULT_TIMEOUT: int = int(os.getenv('RAG_EMBED_RESULT_TIMEOUT', '900'))
+    RAG_EMBED_LIMITS_COLLECTION: str = os.getenv('RAG_EMBED_LIMITS_COLLECTION', 'rag_embed_limits')
+
+    # PDF 文本提取进程池：进程数（0 = 按容器 CPU 配额自动选择，最多 2；1 = 在摄取线程内逐页提取）、每个任务的页数、
+    # 页数少于下限的 PDF 不走进程池
+    RAG_PDF_EXTRACT_WORKERS: int = int(os.getenv('RAG_PDF_EXTRACT_WORKERS', '0'))
+    RAG_PDF_PAGES_PER_TASK: int = int(os.getenv('RAG_PDF_PAGES_PER_TASK', '8'))
+    RAG_PDF_PARALLEL_MIN_PAGES: int = int(os.getenv('RAG_PDF_PARALLEL_MIN_PAGES', '24'))
+
+    # chunk embedding 持久化缓存（SQLite），RAG_EMBED_CACHE_MAX_MB=0 表示关闭
+    RAG_EMBED_CACHE_PATH: str = os.getenv('RAG_EMBED_CACHE_PATH', '.cache/rag_embeddings.sqlite3')
+    RAG_EMBED_CACHE_MAX_MB: int = int(os.getenv('RAG_EMBED_CACHE_MAX_MB', '1024'))
+
+    # 问题向量缓存：memory（进程内 LRU+TTL）或 mongo（额外的多 worker 共享层）
+    RAG_QUERY_EMBED_CACHE_BACKEND: str = os.getenv('RAG_QUERY_EMBED_CACHE_BACKEND', 'memory')
+    RAG_QUERY_EMBED_CACHE_SIZE: int = int(os.getenv('RAG_QUERY_EMBED_CACHE_SIZE', '1024'))
+    RAG_QUERY_EMBED_CACHE_TTL: int = int(os.getenv('RAG_QUERY_EMBED_CACHE_TTL', '3600'))
+    RAG_QUERY_EMBED_CACHE_COLLECTION: str = os.getenv('RAG_QUERY_EMBED_CACHE_COLLECTION', 'rag_query_embedding_cache')
+
+    # /query 完整响应缓存（相同请求合并计算；材料写入新 chunk 后失效），SIZE=0 表示关闭；
+    # 各内容范围的写入代号存于 GENERATIONS_COLLECTION，所有 worker 共用
+    RAG_RESPONSE_CACHE_SIZE: int = int(os.getenv('RAG_RESPONSE_CACHE_SIZE', '512'))
+    RAG_RESPONSE_CACHE_TTL: int = int(os.getenv('RAG_RESPONSE_CACHE_TTL', '600'))
+    RAG_RESPONSE_CACHE_GENERATIONS_COLLECTION: str = os.getenv(
+        'RAG_RESPONSE_CACHE_GENERATIONS_COLLECTION', 'rag_cache_generations'
+    )
+
+    # /query/batch 并发上限：向量检索与 LLM 合成分别限流
+    RAG_BATCH_SEARCH_CONCURRENCY: int = int(os.getenv('RAG_BATCH_SEARCH_CONCURRENCY', '8'))
+    RAG_BATCH_SYNTHESIS_CONCURRENCY: int = int(os.getenv('RAG_BATCH_SYNTHESIS_CONCURRENCY', '4'))
+    RAG_BATCH_MAX_QUESTIONS: int = int(os.getenv('RAG_BATCH_MAX_QUESTIONS', '500'))
+
+    # 可观测性：各服务 /metrics 导出 Prometheus 指标；热路径的结构化日志（JSON 行）中
+    # INFO 级事件按该比例采样输出（0 ~ 1），警告级事件（无检索结果、回退等）始终输出
+    LOG_SAMPLE_RATE: float = float(os.getenv('LOG_SAMPLE_RATE', '0.05'))
     
     @classmethod
     def validate(cls):
@@ -0,0 +1,124 @@
+"""检索片段的合并与 token 预算打包（rag / quiz / agent 服务共用）
+
+切分器使用 chunk_overlap，同一 PDF 的相邻命中首尾文本重复。打包前先把同一文件
+里首尾重叠或互相包含的片段合并，再按排名顺序放入片段，直到恰好填满 token 预算；
+最后一个放不下的片段在 token 边界截断，而不是按字符数截断。
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional
+
+import tiktoken
+
+# 判定首尾重叠时用后一片段开头的这么多字符去前一片段里定位
+OVERLAP_PROBE_CHARS = 48
+# 剩余预算少于这么多 token 时不再放入截断的片段
+MIN_PARTIAL_TOKENS = 32
+
+
+@lru_cache(maxsize=8)
+def get_encoding(model: Optional[str] = None) -> tiktoken.Encoding:
+    if model:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            pass
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: Optional[str] = None) -> str:
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max(0, max_tokens)])
+
+
+def _source_group(source: Dict[str, Any]) -> Any:
+    metadata = source.get("metadata") or {}
+    return metadata.get("material_id") or metadata.get("filename")
+
+
+def merge_overlap(first: str, second: str) -> Optional[str]:
+    """second 与 first 的结尾重叠（或被 first 包含）时返回合并后的文本，否则返回 None"""
+    if not first or not second:
+        return None
+    if second in first:
+        return first
+    if first in second:
+        return second
+
+    probe = second[:OVERLAP_PROBE_CHARS]
+    start = first.find(probe, max(0, len(first) - len(second)))
+    while start != -1:
+        overlap = len(first) - start
+        if second.startswith(first[start:]):
+            return first + second[overlap:]
+        start = first.find(probe, start + 1)
+    return None
+
+
+def merge_overlapping_sources(sources: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """把同一材料中首尾重叠的片段合并到排名更靠前的那个位置，保持其余顺序不变"""
+    merged: List[Dict[str, Any]] = []
+    for source in sources:
+        snippet = (source.get("snippet") or "").strip()
+        if not snippet:
+            continue
+        group = _source_group(source)
+        for existing in merged:
+            if group is None or _source_group(existing) != group:
+                continue
+            combined = merge_overlap(existing["snippet"], snippet) or merge_overlap(snippet, existing["snippet"])
+            if combined is not None:
+                existing["snippet"] = combined
+                break
+        else:
+            merged.append({**source, "snippet": snippet})
+    return merged
+
+
+def pack_sources(
+    sources: List[Dict[str, Any]],
+    *,
+    token_budget: int,
+    render: Callable[[int, Dict[str, Any]], str],
+    model: Optional[str] = None,
+    separator: str = "\n",
+) -> List[Dict[str, Any]]:
+    """按排名顺序挑选片段，使 render 后拼接的总 token 数不超过 token_budget
+
+    render(idx, source) 返回单个片段的完整文本（含编号、文件名等前缀），用于精确计数；
+    返回的 source 中 snippet 可能已在 token 边界截断。
+    """
+    packed: List[Dict[str, Any]] = []
+    remaining = token_budget
+    separator_tokens = count_tokens(separator, model)
+
+    for source in merge_overlapping_sources(sources):
+        cost = separator_tokens if packed else 0
+        idx = len(packed) + 1
+        rendered_tokens = count_tokens(render(idx, source), model) + cost
+        if rendered_tokens <= remaining:
+            packed.append(source)
+            remaining -= rendered_tokens
+            continue
+
+        overhead = count_tokens(render(idx, {**source, "snippet": ""}), model) + cost
+        available = remaining - overhead
+        if available >= MIN_PARTIAL_TOKENS:
+            snippet = truncate_to_tokens(source["snippet"], available, model)
+            # 解码后的文本重新编码可能多出 token，逐步收缩直到确实放得下
+            while snippet and count_tokens(render(idx, {**source, "snippet": snippet}), model) + cost > remaining:
+                available -= 1
+                snippet = truncate_to_tokens(source["snippet"], available, model)
+            if snippet:
+                packed.append({**source, "snippet": snippet})
+        break
+
+    return packed
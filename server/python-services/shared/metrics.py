@@ -0,0 +1,105 @@
+"""三个服务共用的 Prometheus 指标与采样结构化日志
+
+指标（`GET /metrics` 以 Prometheus 文本格式导出，`service` 标签区分服务）：
+
+    study_assistant_stage_seconds{stage}        热路径各阶段耗时直方图：
+                                                embed / vector_search / fallback / llm_synthesis /
+                                                rag_http / web_search
+    study_assistant_llm_ttft_seconds            流式生成从发出请求到第一个 token 的耗时
+    study_assistant_llm_tokens_total{model,kind}  LLM token 数（prompt / completion）
+
+各服务可另外注册读取自身统计的收集器（如 rag-service 的缓存命中与摄取 embedding token）。
+
+结构化日志每条一行 JSON（`{"event": ..., "service": ..., ...}`）：INFO 级事件按
+LOG_SAMPLE_RATE 采样输出（启动 / 索引就绪这类低频事件可用 sample=False 关闭采样），
+WARNING 及以上始终输出。
+"""
+from __future__ import annotations
+
+import json
+import logging
+import random
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+from starlette.responses import Response
+
+from shared.config import settings
+
+# 5ms ~ 60s：覆盖本地 embedding 到慢速 LLM 合成
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+STAGE_SECONDS = Histogram(
+    "study_assistant_stage_seconds",
+    "Latency of hot-path stages",
+    ["service", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TTFT_SECONDS = Histogram(
+    "study_assistant_llm_ttft_seconds",
+    "Time from sending a streaming LLM request to its first token",
+    ["service"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "study_assistant_llm_tokens",
+    "Tokens consumed by LLM calls",
+    ["service", "model", "kind"],
+)
+
+_event_logger = logging.getLogger("study_assistant.events")
+if not _event_logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    _event_logger.addHandler(_handler)
+    _event_logger.setLevel(logging.INFO)
+    _event_logger.propagate = False
+
+
+class ServiceMetrics:
+    """绑定 service 标签的指标与日志入口"""
+
+    def __init__(self, service: str) -> None:
+        self.service = service
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        """记录代码块耗时（异常退出也计入）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        STAGE_SECONDS.labels(self.service, stage).observe(seconds)
+
+    def time_to_first_token(self, seconds: float) -> None:
+        LLM_TTFT_SECONDS.labels(self.service).observe(seconds)
+
+    def tokens(self, model: str, kind: str, count: Optional[int]) -> None:
+        if count:
+            LLM_TOKENS.labels(self.service, model, kind).inc(count)
+
+    def usage(self, model: str, usage: Any) -> None:
+        """OpenAI 响应中的 usage（对象或 dict）"""
+        if usage is None:
+            return
+        read = usage.get if isinstance(usage, dict) else lambda key: getattr(usage, key, None)
+        self.tokens(model, "prompt", read("prompt_tokens"))
+        self.tokens(model, "completion", read("completion_tokens"))
+
+    def log(self, event: str, *, level: int = logging.INFO, sample: bool = True, **fields: Any) -> None:
+        """输出一行 JSON 事件；INFO 级按 LOG_SAMPLE_RATE 采样（sample=False 时始终输出）"""
+        if sample and level < logging.WARNING and random.random() >= settings.LOG_SAMPLE_RATE:
+            return
+        record = {"event": event, "service": self.service, **fields}
+        _event_logger.log(level, json.dumps(record, ensure_ascii=False, default=str))
+
+
+def metrics_response() -> Response:
+    """`GET /metrics` 的响应（默认注册表，含进程 / GC 指标）"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
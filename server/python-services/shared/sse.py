@@ -0,0 +1,8 @@
+"""Server-Sent Events 编码（agent-service / rag-service 共用）"""
+import json
+from typing import Any, Dict
+
+
+def format_sse(event: str, data: Dict[str, Any]) -> bytes:
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n".encode("utf-8")
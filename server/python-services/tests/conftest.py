@@ -0,0 +1,17 @@
+"""测试直接导入各服务模块：rag-service 的模块按服务目录内的顶层名互相导入，
+shared 按 python-services 下的包导入（与 `cd rag-service && python main.py` 的路径一致）"""
+import os
+import sys
+from pathlib import Path
+
+SERVICES_DIR = Path(__file__).resolve().parent.parent
+
+for path in (SERVICES_DIR, SERVICES_DIR / "rag-service"):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+# 指标日志只在 WARNING 及以上输出，避免 INFO 事件干扰测试输出
+os.environ.setdefault("LOG_SAMPLE_RATE", "0")
+
+# llama_index.core 导入时把 TIKTOKEN_CACHE_DIR 指向自带的 cl100k_base 缓存，离线也能取到编码
+import llama_index.core  # noqa: E402,F401
@@ -0,0 +1,153 @@
+import asyncio
+import os
+
+import numpy as np
+import pytest
+from llama_index.core import QueryBundle
+
+import ann_index
+from ann_index import MANIFEST_NAME, AnnIndexStore, AnnVectorBackend
+
+
+def unit_rows(count, dim=16, seed=0):
+    vectors = np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return AnnIndexStore(str(tmp_path), min_train_rows=64)
+
+
+def search_ids(store, query, *, material_ids=None, top_k=5, nprobe=64):
+    partition = store.open("u1")
+    return [doc_id for doc_id, _ in partition.search(query, material_ids=material_ids, top_k=top_k, nprobe=nprobe)]
+
+
+def test_build_and_exact_search(store):
+    vectors = unit_rows(200)
+    ids = [f"c{i}" for i in range(200)]
+    store.build("u1", ids, ["m1" if i % 2 else "m2" for i in range(200)], vectors)
+
+    partition = store.open("u1")
+    assert partition.count == 200
+    assert partition.nlist > 1
+    # 探测全部列表时等于精确检索
+    exact = [f"c{i}" for i in np.argsort(-(vectors @ vectors[7]))[:5]]
+    assert search_ids(store, vectors[7]) == exact
+    assert all(int(doc_id[1:]) % 2 for doc_id in search_ids(store, vectors[7], material_ids=["m1"]))
+
+
+def test_add_appends_and_dedupes(store):
+    vectors = unit_rows(110)
+    store.build("u1", [f"c{i}" for i in range(100)], ["m1"] * 100, vectors[:100])
+
+    assert store.add("u1", ["c5", "n1", "n1"], ["m1", "m2", "m2"], vectors[[5, 100, 100]]) == 1
+    assert store.add("u1", ["n1"], ["m2"], vectors[[100]]) == 0
+    assert store.open("u1").count == 101
+    assert search_ids(store, vectors[100], top_k=1) == ["n1"]
+    assert search_ids(store, vectors[100], material_ids=["m2"]) == ["n1"]
+
+
+def test_add_sees_rows_written_by_another_store(store, tmp_path):
+    vectors = unit_rows(103)
+    store.build("u1", [f"c{i}" for i in range(100)], ["m1"] * 100, vectors[:100])
+    assert store.add("u1", ["n1"], ["m1"], vectors[[100]]) == 1
+
+    other = AnnIndexStore(str(tmp_path), min_train_rows=64)
+    assert other.add("u1", ["n2"], ["m1"], vectors[[101]]) == 1
+    assert store.add("u1", ["n2", "n3"], ["m1", "m1"], vectors[[101, 102]]) == 1
+    assert store.open("u1").ids[-3:] == ["n1", "n2", "n3"]
+
+
+def test_add_retrains_after_doubling(store):
+    vectors = unit_rows(300)
+    store.build("u1", [f"c{i}" for i in range(100)], ["m1"] * 100, vectors[:100])
+    generation = store.open("u1").manifest["generation"]
+
+    assert store.add("u1", [f"c{i}" for i in range(100, 300)], ["m1"] * 200, vectors[100:]) == 200
+    partition = store.open("u1")
+    assert partition.manifest["generation"] != generation
+    assert partition.count == 300
+    assert search_ids(store, vectors[250], top_k=1) == ["c250"]
+
+
+def test_add_without_partition_is_skipped(store):
+    assert store.add("u1", ["c1"], ["m1"], unit_rows(1)) == 0
+    assert store.open("u1") is None
+
+
+def test_remove_rewrites_and_drops_empty_partition(store):
+    vectors = unit_rows(100)
+    store.build("u1", [f"c{i}" for i in range(100)], ["m1"] * 100, vectors)
+
+    assert store.remove("u1", ["c3", "missing"]) == 1
+    assert store.open("u1").count == 99
+    assert "c3" not in search_ids(store, vectors[3], top_k=10)
+    # 删除后重写的分区仍能继续追加
+    assert store.add("u1", ["c3"], ["m1"], vectors[[3]]) == 1
+    assert search_ids(store, vectors[3], top_k=1) == ["c3"]
+
+    assert store.remove("u1", [f"c{i}" for i in range(100)]) == 100
+    assert store.open("u1") is None
+
+
+def test_open_reloads_after_another_process_writes_within_the_same_mtime(store, tmp_path):
+    vectors = unit_rows(102)
+    store.build("u1", [f"c{i}" for i in range(100)], ["m1"] * 100, vectors[:100])
+    assert store.open("u1").count == 100
+
+    manifest_path = store.partition_dir("u1") / MANIFEST_NAME
+    stat = manifest_path.stat()
+    other = AnnIndexStore(str(tmp_path), min_train_rows=64)
+    assert other.add("u1", ["n1", "n2"], ["m1", "m1"], vectors[100:]) == 2
+    # 粗粒度文件系统上两次写入可能落在同一个 mtime 刻度内
+    os.utime(manifest_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    assert store.open("u1").count == 102
+    assert search_ids(store, vectors[101], top_k=1) == ["n2"]
+
+
+class FakeMongo:
+    def __init__(self, ids, vectors):
+        self.ids = ids
+        self.vectors = vectors
+        self.loads = 0
+
+    async def load_user_vectors(self, collection, user_id, *, embedding_key, query):
+        self.loads += 1
+        return list(self.ids), ["m1"] * len(self.ids), self.vectors
+
+    async def hydrate_nodes(self, collection, ranked, *, text_key):
+        return ranked
+
+
+def test_backend_rebuilds_stale_partition_from_mongo(store, monkeypatch):
+    vectors = unit_rows(120)
+    mongo = FakeMongo([f"c{i}" for i in range(100)], vectors[:100])
+    monkeypatch.setattr(ann_index, "load_user_vectors", mongo.load_user_vectors)
+    monkeypatch.setattr(ann_index, "hydrate_nodes", mongo.hydrate_nodes)
+    backend = AnnVectorBackend(None, store, nprobe=64, ttl_seconds=60)
+
+    def search(query):
+        bundle = QueryBundle(query_str="q", embedding=query.tolist())
+        ranked = asyncio.run(backend.search(bundle, user_id="u1", material_ids=None, top_k=1))
+        return [doc_id for doc_id, _ in ranked]
+
+    assert search(vectors[5]) == ["c5"]
+    assert search(vectors[6]) == ["c6"]
+    assert mongo.loads == 1
+
+    # 其他 pod 写入的 chunk 只在 MongoDB 中；过期后重新构建才可见
+    mongo.ids, mongo.vectors = [f"c{i}" for i in range(120)], vectors
+    assert search(vectors[110]) != ["c110"]
+    expired = store.open("u1").synced_at + 61
+    monkeypatch.setattr(ann_index.time, "time", lambda: expired)
+    assert search(vectors[110]) == ["c110"]
+    assert mongo.loads == 2
+
+    mongo.ids, mongo.vectors = [], vectors[:0]
+    expired = store.open("u1").synced_at + 61
+    monkeypatch.setattr(ann_index.time, "time", lambda: expired)
+    assert search(vectors[5]) == []
+    assert store.open("u1") is None
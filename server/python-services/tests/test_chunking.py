@@ -0,0 +1,42 @@
+import pytest
+from llama_index.core import Document
+from llama_index.core.utils import globals_helper
+
+from chunking import SentenceBoundaryScanner, create_node_parser
+
+SAMPLES = [
+    "Dr. Smith went to Washington. He said hello! The U.S. economy is big. " * 40,
+    "第一段内容。这是中文句子！还有问题吗？\n\n第二段。" * 60,
+    "Version 3.14 was released on Jan. 5 by J. R. R. Tolkien et al. (see p. 12). Next sentence here.\n" * 30,
+    "word " * 3000,
+    "x" * 9000,
+    "Short text.",
+    "",
+]
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_scanner_matches_punkt(text):
+    scanner = SentenceBoundaryScanner()
+    assert scanner.spans(text) == list(globals_helper.punkt_tokenizer.span_tokenize(text))
+
+
+@pytest.mark.parametrize("chunk_size,chunk_overlap", [(1024, 200), (128, 20), (64, 0)])
+@pytest.mark.parametrize("text", SAMPLES[:5])
+def test_fast_splitter_matches_sentence_splitter(text, chunk_size, chunk_overlap):
+    documents = [Document(text=text, metadata={"filename": "a.pdf", "page": 1})]
+    fast = create_node_parser("fast", chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    reference = create_node_parser("llamaindex", chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    fast_nodes = fast.get_nodes_from_documents(documents)
+    reference_nodes = reference.get_nodes_from_documents(documents)
+
+    assert [node.text for node in fast_nodes] == [node.text for node in reference_nodes]
+    assert [(node.start_char_idx, node.end_char_idx) for node in fast_nodes] == [
+        (node.start_char_idx, node.end_char_idx) for node in reference_nodes
+    ]
+
+
+def test_unknown_chunker():
+    with pytest.raises(ValueError):
+        create_node_parser("nltk")
@@ -0,0 +1,61 @@
+from shared.context_packing import count_tokens, merge_overlap, merge_overlapping_sources, pack_sources
+
+
+def render(idx, source):
+    return f"[{idx}] {source['metadata']['filename']}: {source['snippet']}"
+
+
+def source(snippet, material_id="m1", filename="a.pdf"):
+    return {"snippet": snippet, "metadata": {"material_id": material_id, "filename": filename}}
+
+
+def packed_tokens(packed):
+    return count_tokens("\n".join(render(idx, item) for idx, item in enumerate(packed, start=1)))
+
+
+# 与切分器的 chunk_overlap 一样，重叠部分长于定位用的探针
+OVERLAP = "the overlapping sentence shared by adjacent chunks of the same page"
+
+
+def test_merge_overlap():
+    assert merge_overlap(f"Intro. {OVERLAP}", f"{OVERLAP} Outro.") == f"Intro. {OVERLAP} Outro."
+    assert merge_overlap("alpha beta gamma", "beta") == "alpha beta gamma"
+    assert merge_overlap("alpha", "omega") is None
+
+
+def test_merges_only_within_same_material():
+    sources = [
+        source(f"{OVERLAP} Second half."),
+        source("Unrelated passage", material_id="m2"),
+        source(f"First half. {OVERLAP}"),
+        source(f"{OVERLAP} Other file.", material_id="m2"),
+    ]
+    merged = merge_overlapping_sources(sources)
+    assert [item["snippet"] for item in merged] == [
+        f"First half. {OVERLAP} Second half.",
+        "Unrelated passage",
+        f"{OVERLAP} Other file.",
+    ]
+
+
+def test_pack_sources_fits_budget_and_keeps_rank_order():
+    sources = [source(f"Passage {i} " + "lorem ipsum dolor sit amet " * 30, material_id=f"m{i}") for i in range(5)]
+    budget = 400
+    packed = pack_sources(sources, token_budget=budget, render=render)
+
+    assert packed_tokens(packed) <= budget
+    assert [item["metadata"]["material_id"] for item in packed] == [f"m{i}" for i in range(len(packed))]
+    # 最后一个放不下的片段在 token 边界截断
+    assert packed[-1]["snippet"] != sources[len(packed) - 1]["snippet"].strip()
+    assert sources[len(packed) - 1]["snippet"].startswith(packed[-1]["snippet"])
+
+
+def test_pack_sources_skips_partial_below_minimum():
+    sources = [source("word " * 50, material_id="m1"), source("other " * 200, material_id="m2")]
+    first_tokens = count_tokens(render(1, {**sources[0], "snippet": sources[0]["snippet"].strip()}))
+    packed = pack_sources(sources, token_budget=first_tokens + 10, render=render)
+    assert len(packed) == 1
+
+
+def test_pack_sources_drops_empty_snippets():
+    assert pack_sources([source("   "), source("")], token_budget=100, render=render) == []
@@ -0,0 +1,65 @@
+import asyncio
+
+from document_store import MaterialScopes, document_key
+from query_cache import LocalCacheGenerations
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    async def to_list(self, length=None):
+        return [dict(doc) for doc in self._docs]
+
+
+class FakeRefs:
+    def __init__(self):
+        self.docs = []
+        self.reads = 0
+
+    def find(self, query, projection=None):
+        self.reads += 1
+        return FakeCursor([doc for doc in self.docs if doc["user_id"] == query["user_id"]])
+
+
+def test_reference_changes_reach_other_workers():
+    refs = FakeRefs()
+    refs.docs.append({"user_id": "u1", "material_id": "m1", "document_id": "d1", "filename": "a.pdf"})
+    # 两个 worker 各有一份进程内引用缓存，写入代号共用（生产环境中存于 MongoDB）
+    generations = LocalCacheGenerations()
+    writer = MaterialScopes(refs, ttl_seconds=300, generations=generations)
+    reader = MaterialScopes(refs, ttl_seconds=300, generations=generations)
+
+    async def documents():
+        return await reader._documents("u1", None)
+
+    assert asyncio.run(documents()) == ["d1"]
+    assert asyncio.run(documents()) == ["d1"]
+    assert refs.reads == 1
+
+    refs.docs.clear()
+    writer.invalidate("u1")
+    assert asyncio.run(documents()) == []
+    assert refs.reads == 2
+
+
+def test_generation_lookup_failure_reads_references():
+    class BrokenGenerations(LocalCacheGenerations):
+        async def current(self, scopes):
+            raise ConnectionError("mongo down")
+
+    refs = FakeRefs()
+    refs.docs.append({"user_id": "u1", "material_id": "m1", "document_id": "d1", "filename": "a.pdf"})
+    scopes = MaterialScopes(refs, generations=BrokenGenerations())
+
+    async def lookups():
+        return [await scopes.user_refs("u1") for _ in range(2)]
+
+    assert [len(found) for found in asyncio.run(lookups())] == [1, 1]
+    assert refs.reads == 2
+
+
+def test_document_key_depends_on_embedding_version():
+    assert document_key("abc", "model-a|full-none") == document_key("abc", "model-a|full-none")
+    assert document_key("abc", "model-a|full-none") != document_key("abc", "model-b|full-none")
+    assert document_key("abc", "model-a|full-none").startswith("abc:")
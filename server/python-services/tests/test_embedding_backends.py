@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from embedding_backends import HashEmbedding, embedding_model_id
+
+
+def cosine(a, b):
+    return float(np.dot(a, b))
+
+
+def test_hash_embedding_is_deterministic_and_normalized():
+    model = HashEmbedding(dimensions=64)
+    first = model.get_text_embedding("Photosynthesis converts light energy")
+    second = HashEmbedding(dimensions=64).get_text_embedding("photosynthesis   converts LIGHT energy")
+
+    assert len(first) == 64
+    assert first == pytest.approx(second)
+    assert np.linalg.norm(first) == pytest.approx(1.0, abs=1e-6)
+
+
+def test_hash_embedding_ranks_word_overlap():
+    model = HashEmbedding(dimensions=256)
+    query = np.array(model.get_query_embedding("light energy conversion"))
+    related = np.array(model.get_text_embedding("plants convert light energy into sugar"))
+    unrelated = np.array(model.get_text_embedding("the french revolution began in 1789"))
+    assert cosine(query, related) > cosine(query, unrelated)
+
+
+def test_hash_embedding_batches_match_single_calls():
+    model = HashEmbedding(dimensions=32)
+    texts = ["alpha beta", "", "gamma"]
+    batch = model.get_text_embedding_batch(texts)
+    assert batch == [pytest.approx(model.get_text_embedding(text)) for text in texts]
+    # 没有任何词的文本也得到单位向量
+    assert batch[1][0] == 1.0
+
+
+def test_hash_embedding_model_id_includes_dimensions():
+    assert embedding_model_id(HashEmbedding(dimensions=128)) == "hash-128"
+    assert embedding_model_id(HashEmbedding(dimensions=128)) != embedding_model_id(HashEmbedding(dimensions=256))
@@ -0,0 +1,115 @@
+import sqlite3
+
+import pytest
+
+import embedding_cache
+from embedding_cache import EmbeddingCache
+
+VECTOR_BYTES = 4 * 4
+
+
+def vector(value):
+    return [float(value)] * 4
+
+
+def table_totals(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM embeddings").fetchone()
+
+
+def last_used(path, key):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT last_used FROM embeddings WHERE key = ?", (key,)).fetchone()[0]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "embeddings.sqlite3")
+
+
+def test_running_totals_follow_inserts_replacements_and_other_processes(path):
+    cache = EmbeddingCache(path, max_bytes=0)
+    cache.put_many([("a", vector(1)), ("b", vector(2))])
+    cache.put_many([("a", vector(3) * 2)])
+
+    other = EmbeddingCache(path, max_bytes=0)
+    other.put_many([("c", vector(4))])
+
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"]) == table_totals(path) == (3, 4 * VECTOR_BYTES)
+    assert cache.get_many(["a"])["a"] == vector(3) * 2
+    cache.close()
+    other.close()
+
+
+def test_existing_cache_file_is_counted_once_on_open(path):
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL,"
+        " size INTEGER NOT NULL, last_used REAL NOT NULL)"
+    )
+    conn.executemany(
+        "INSERT INTO embeddings VALUES (?, ?, ?, ?)",
+        [("old-1", b"\0" * VECTOR_BYTES, VECTOR_BYTES, 1.0), ("old-2", b"\0" * VECTOR_BYTES, VECTOR_BYTES, 2.0)],
+    )
+    conn.commit()
+    conn.close()
+
+    cache = EmbeddingCache(path, max_bytes=0)
+    assert (cache.stats()["entries"], cache.stats()["bytes"]) == (2, 2 * VECTOR_BYTES)
+    cache.close()
+
+
+def test_eviction_drops_least_recently_used_rows(path):
+    cache = EmbeddingCache(path, max_bytes=4 * VECTOR_BYTES)
+    cache.put_many([(f"k{i}", vector(i)) for i in range(4)])
+    with sqlite3.connect(path) as conn:
+        conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(i, f"k{i}") for i in range(4)])
+    # k0 最旧，但刚被读过：淘汰前写回的 last_used 让它留下
+    assert cache.get_many(["k0"])
+
+    cache.put_many([("k4", vector(4))])
+
+    remaining = set(cache.get_many([f"k{i}" for i in range(5)]))
+    assert remaining == {"k0", "k3", "k4"}
+    assert cache.stats()["bytes"] == table_totals(path)[1] == 3 * VECTOR_BYTES
+    assert cache.stats()["evictions"] == 2
+    cache.close()
+
+
+def test_reads_do_not_write_until_a_batch_is_due(path, monkeypatch):
+    cache = EmbeddingCache(path, max_bytes=0)
+    cache.put_many([(f"k{i}", vector(i)) for i in range(3)])
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE embeddings SET last_used = 1.0")
+
+    changes = cache._conn.total_changes
+    for _ in range(5):
+        assert len(cache.get_many(["k0", "k1", "k2"])) == 3
+    assert cache._conn.total_changes == changes
+    assert last_used(path, "k0") == 1.0
+
+    monkeypatch.setattr(embedding_cache, "TOUCH_FLUSH_SIZE", 3)
+    cache.get_many(["k0"])
+    assert cache._conn.total_changes == changes + 3
+    assert last_used(path, "k0") > 1.0
+    cache.close()
+
+
+def test_recent_hits_are_not_rewritten(path):
+    cache = EmbeddingCache(path, max_bytes=0)
+    cache.put_many([("k", vector(1))])
+    cache.get_many(["k"])
+    assert cache._touches == {}
+    cache.close()
+
+
+def test_close_flushes_pending_touches(path):
+    cache = EmbeddingCache(path, max_bytes=0)
+    cache.put_many([("k", vector(1))])
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE embeddings SET last_used = 1.0")
+    cache.get_many(["k"])
+    assert last_used(path, "k") == 1.0
+    cache.close()
+    assert last_used(path, "k") > 1.0
@@ -0,0 +1,191 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from embedding_scheduler import AdaptiveLimiter, EmbeddingScheduler, parse_reset_seconds
+
+
+def test_slow_start_then_additive_increase():
+    limiter = AdaptiveLimiter(initial=2, maximum=16)
+    limiter.on_success({}, 100)
+    limiter.on_success({}, 100)
+    assert limiter.limit == 4
+
+    limiter.on_rate_limited(0)
+    assert limiter.limit == 2
+    # 拥塞避免阶段每个成功请求 +1/limit，约一轮才 +1
+    limiter.on_success({}, 100)
+    assert limiter.limit == 2
+    for _ in range(2):
+        limiter.on_success({}, 100)
+    assert limiter.limit == 3
+
+
+def test_limit_is_capped():
+    limiter = AdaptiveLimiter(initial=8, maximum=10)
+    for _ in range(20):
+        limiter.on_success({}, 100)
+    assert limiter.limit == 10
+
+
+def test_decrease_once_per_interval():
+    limiter = AdaptiveLimiter(initial=16, maximum=16)
+    limiter.on_rate_limited(0)
+    limiter.on_rate_limited(0)
+    assert limiter.limit == 8
+
+
+def test_low_remaining_tokens_halves_limit():
+    limiter = AdaptiveLimiter(initial=8, maximum=16)
+    limiter.on_success({"x-ratelimit-remaining-tokens": "500", "x-ratelimit-reset-tokens": "0s"}, 1000)
+    assert limiter.limit == 4
+
+
+def test_acquire_blocks_at_limit_and_during_pause():
+    limiter = AdaptiveLimiter(initial=1, maximum=1)
+    limiter.acquire()
+    acquired = threading.Event()
+
+    def waiter():
+        limiter.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    assert not acquired.wait(0.05)
+    limiter.release()
+    assert acquired.wait(1)
+    thread.join()
+    limiter.release()
+
+    limiter.on_rate_limited(0.2)
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.15
+    limiter.release()
+
+
+
+class FakeSharedState:
+    """与 MongoLimiterState 相同接口的进程内共享状态"""
+
+    def __init__(self, limit, processes, paused_until=0.0):
+        self.limit = limit
+        self.processes = processes
+        self.paused_until = paused_until
+        self.increases = 0
+        self.decreases = []
+        self.fail = False
+
+    def snapshot(self):
+        if self.fail:
+            raise ConnectionError("mongo down")
+        return self.limit, self.processes, self.paused_until
+
+    def increase(self):
+        self.increases += 1
+
+    def decrease(self, pause_seconds):
+        self.decreases.append(pause_seconds)
+        self.limit = max(1.0, self.limit / 2)
+
+
+def test_shared_state_splits_global_limit_between_processes():
+    shared = FakeSharedState(limit=12.0, processes=3)
+    limiter = AdaptiveLimiter(initial=4, maximum=16, shared=shared)
+    limiter.sync(force=True)
+    assert limiter.limit == 4
+    assert limiter.processes == 3
+
+    limiter.on_success({}, 100)
+    assert shared.increases == 1
+
+    limiter.on_rate_limited(0.5)
+    assert shared.decreases == [0.5]
+    # 减半后立即按全局状态刷新：12 / 2 / 3
+    assert limiter.limit == 2
+
+
+def test_shared_pause_blocks_acquire():
+    shared = FakeSharedState(limit=4.0, processes=1, paused_until=time.time() + 0.2)
+    limiter = AdaptiveLimiter(initial=4, maximum=16, shared=shared)
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.15
+    limiter.release()
+
+
+def test_shared_state_failure_falls_back_to_local_limits():
+    shared = FakeSharedState(limit=12.0, processes=3)
+    shared.fail = True
+    limiter = AdaptiveLimiter(initial=4, maximum=16, shared=shared)
+    limiter.acquire()
+    limiter.release()
+    assert limiter.limit == 4
+
+    limiter.on_success({}, 100)
+    assert limiter.limit == 5
+    # 不可用期间不再写共享状态
+    assert shared.increases == 0
+
+    shared.fail = False
+    limiter.sync(force=True)
+    assert limiter.limit == 4
+    limiter.on_success({}, 100)
+    assert shared.increases == 1
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [("20ms", 0.02), ("1.5s", 1.5), ("6m0s", 360.0), ("1h2m", 3720.0), ("2", 2.0)],
+)
+def test_parse_reset_seconds(value, expected):
+    assert parse_reset_seconds(value) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("value", [None, "", "soon"])
+def test_parse_reset_seconds_invalid(value):
+    assert parse_reset_seconds(value) is None
+
+
+class FakeEmbeddings:
+    """把含 "bad" 的批次当作 400 拒绝，其余返回 [长度] 作为向量"""
+
+    def __init__(self):
+        self.batches = []
+        self.with_raw_response = self
+
+    def create(self, *, model, input):
+        self.batches.append(list(input))
+        if any("bad" in text for text in input):
+            request = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+            raise openai.BadRequestError(
+                "input too long", response=httpx.Response(400, request=request), body=None
+            )
+        data = [SimpleNamespace(index=i, embedding=[float(len(text))]) for i, text in enumerate(input)]
+        return SimpleNamespace(headers={}, parse=lambda: SimpleNamespace(data=data))
+
+
+def test_scheduler_splits_rejected_batches():
+    embeddings = FakeEmbeddings()
+    scheduler = EmbeddingScheduler(
+        model="text-embedding-3-small",
+        concurrency=1,
+        max_concurrency=1,
+        client=SimpleNamespace(embeddings=embeddings),
+    )
+    texts = ["a", "bb", "bad", "dddd"]
+    try:
+        with pytest.raises(openai.BadRequestError):
+            scheduler.get_text_embedding_batch(texts)
+        assert scheduler.get_text_embedding_batch(["eeeee"]) == [[5.0]]
+    finally:
+        scheduler.shutdown()
+
+    # 整批被拒后对半拆分，直到只剩出错的那条
+    assert embeddings.batches[:4] == [texts, ["a", "bb"], ["bad", "dddd"], ["bad"]]
+    assert ["dddd"] in embeddings.batches
+    assert scheduler.stats()["embedded_texts"] == 4
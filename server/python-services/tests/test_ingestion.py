@@ -0,0 +1,154 @@
+import threading
+import time
+import uuid
+
+from llama_index.core.schema import Document, TextNode
+
+from ingestion import (
+    CHUNK_ID_NAMESPACE,
+    CONTENT_HASH_KEY,
+    StreamingIngestor,
+    assign_chunk_ids,
+    batched,
+    content_hash,
+    embedding_version,
+)
+from vector_codec import VectorCodec
+
+
+def nodes(*texts):
+    return [TextNode(text=text, metadata={"filename": "a.pdf"}) for text in texts]
+
+
+def test_chunk_ids_are_deterministic():
+    first = [node.id_ for node in assign_chunk_ids(nodes("alpha", "beta"), "u1/m1")]
+    second = [node.id_ for node in assign_chunk_ids(nodes("alpha", "beta"), "u1/m1")]
+    assert first == second
+    assert first[0] == str(uuid.uuid5(CHUNK_ID_NAMESPACE, f"u1/m1/{content_hash(nodes('alpha')[0])}/0"))
+
+
+def test_unchanged_chunks_keep_ids_when_others_change():
+    before = {node.text: node.id_ for node in assign_chunk_ids(nodes("alpha", "beta", "gamma"), "u1/m1")}
+    after = {node.text: node.id_ for node in assign_chunk_ids(nodes("alpha", "BETA", "gamma"), "u1/m1")}
+    assert before["alpha"] == after["alpha"]
+    assert before["gamma"] == after["gamma"]
+    assert before["beta"] != after["BETA"]
+
+
+def test_duplicate_chunks_and_namespaces_get_distinct_ids():
+    duplicated = list(assign_chunk_ids(nodes("same", "same"), "u1/m1"))
+    assert duplicated[0].id_ != duplicated[1].id_
+    assert duplicated[0].metadata[CONTENT_HASH_KEY] == duplicated[1].metadata[CONTENT_HASH_KEY]
+
+    other = next(assign_chunk_ids(nodes("same"), "u1/m2"))
+    assert other.id_ != duplicated[0].id_
+
+
+def test_embedding_version_changes_chunk_ids():
+    versions = [
+        embedding_version("text-embedding-3-large", VectorCodec().signature),
+        embedding_version("text-embedding-3-small", VectorCodec().signature),
+        embedding_version("text-embedding-3-large", VectorCodec(dimensions=256).signature),
+        embedding_version("text-embedding-3-large", VectorCodec(quantization="int8").signature),
+        embedding_version("text-embedding-3-large", VectorCodec(quantization="int8", keep_full=True).signature),
+    ]
+    ids = {next(assign_chunk_ids(nodes("alpha"), f"u1/m1@{version}")).id_ for version in versions}
+    assert len(ids) == len(versions)
+
+
+def test_content_hash_covers_embedded_metadata():
+    plain = TextNode(text="alpha", metadata={"filename": "a.pdf"})
+    renamed = TextNode(text="alpha", metadata={"filename": "b.pdf"})
+    excluded = TextNode(text="alpha", metadata={"filename": "b.pdf"}, excluded_embed_metadata_keys=["filename"])
+    bare = TextNode(text="alpha")
+    assert content_hash(plain) != content_hash(renamed)
+    assert content_hash(excluded) == content_hash(bare)
+
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched([], 3)) == []
+
+
+class PageSplitter:
+    """每页切成固定数量的 chunk"""
+
+    def __init__(self, chunks_per_page):
+        self.chunks_per_page = chunks_per_page
+
+    def get_nodes_from_documents(self, documents):
+        return [
+            TextNode(text=f"{document.text} #{i}", metadata=dict(document.metadata))
+            for document in documents
+            for i in range(self.chunks_per_page)
+        ]
+
+
+class SlowEmbedding:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def get_text_embedding_batch(self, texts):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.002)
+        with self.lock:
+            self.active -= 1
+        return [[float(len(text))] for text in texts]
+
+
+class CountingStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inserted = 0
+
+    def add(self, nodes):
+        assert all(node.embedding is not None for node in nodes)
+        with self.lock:
+            self.inserted += len(nodes)
+
+
+def test_streaming_window_is_bounded_by_batch_size_not_page_count():
+    pages_total, chunks_per_page, batch_size, max_in_flight = 400, 3, 16, 2
+    embed_model = SlowEmbedding()
+    store = CountingStore()
+    ingestor = StreamingIngestor(
+        node_parser=PageSplitter(chunks_per_page),
+        embed_model=embed_model,
+        vector_store=store,
+        batch_size=batch_size,
+        max_in_flight=max_in_flight,
+    )
+    pending_peak = 0
+
+    def pages():
+        nonlocal pending_peak
+        for number in range(1, pages_total + 1):
+            # 读取下一页时，已切分但尚未写库的 chunk 不超过窗口内的批次加上正在组装的一批
+            with store.lock:
+                pending = (number - 1) * chunks_per_page - store.inserted
+            pending_peak = max(pending_peak, pending)
+            yield Document(text=f"page {number}", metadata={"page": number})
+
+    stats = ingestor.run(pages(), namespace="u1/m1")
+
+    assert stats.page_count == pages_total
+    assert stats.chunk_count == stats.inserted_count == store.inserted == pages_total * chunks_per_page
+    assert embed_model.max_active <= max_in_flight
+    assert pending_peak <= (max_in_flight + 1) * batch_size + chunks_per_page
+
+
+def test_streaming_skips_existing_chunks():
+    store = CountingStore()
+    ingestor = StreamingIngestor(node_parser=PageSplitter(2), embed_model=SlowEmbedding(), vector_store=store)
+    pages = [Document(text="page 1"), Document(text="page 2")]
+
+    first = ingestor.run(pages, namespace="u1/m1")
+    second = ingestor.run(pages, namespace="u1/m1", existing_ids=set(first.chunk_ordinals))
+
+    assert first.inserted_count == 4
+    assert second.chunk_count == 4 and second.inserted_count == 0
+    assert store.inserted == 4
@@ -0,0 +1,79 @@
+import pytest
+
+from lexical_index import UserLexicalIndex, reciprocal_rank_fusion, tokenize
+
+
+def build_index():
+    index = UserLexicalIndex()
+    index.add(
+        ["a", "b", "c"],
+        ["m1", "m1", "m2"],
+        [
+            "photosynthesis converts light energy into chemical energy",
+            "the mitochondria is the powerhouse of the cell",
+            "light travels faster than sound",
+        ],
+    )
+    return index
+
+
+def test_search_ranks_term_matches():
+    index = build_index()
+    results = index.search("light energy", material_ids=None, top_k=10)
+    assert [doc_id for doc_id, _ in results] == ["a", "c"]
+    assert results[0][1] > results[1][1] > 0
+
+
+def test_search_filters_by_material():
+    index = build_index()
+    assert [doc_id for doc_id, _ in index.search("light", material_ids=["m2"], top_k=10)] == ["c"]
+    assert index.search("light", material_ids=["unknown"], top_k=10) == []
+
+
+def test_add_skips_existing_ids_and_remove_hides_rows():
+    index = build_index()
+    assert index.add(["a"], ["m1"], ["light"]) == 0
+    assert index.remove(["a", "missing"]) == 1
+    assert [doc_id for doc_id, _ in index.search("light energy", material_ids=None, top_k=10)] == ["c"]
+    assert index.search("photosynthesis", material_ids=None, top_k=10) == []
+
+
+def test_scores_after_remove_match_a_fresh_index():
+    texts = {
+        "a": "light energy light",
+        "b": "light " + "filler " * 40,
+        "c": "energy storage",
+        "d": "light waves",
+    }
+    index = UserLexicalIndex()
+    index.add(list(texts), ["m1"] * 4, list(texts.values()))
+    index.search("light energy", material_ids=None, top_k=10)
+    index.remove(["b"])
+
+    fresh = UserLexicalIndex()
+    live = [doc_id for doc_id in texts if doc_id != "b"]
+    fresh.add(live, ["m1"] * 3, [texts[doc_id] for doc_id in live])
+
+    # 删除后平均长度与文档频率都只按剩余的行计算
+    expected = fresh.search("light energy", material_ids=None, top_k=10)
+    actual = index.search("light energy", material_ids=None, top_k=10)
+    assert [doc_id for doc_id, _ in actual] == [doc_id for doc_id, _ in expected]
+    assert [score for _, score in actual] == pytest.approx([score for _, score in expected])
+
+
+def test_search_without_matching_terms():
+    index = build_index()
+    assert index.search("quantum", material_ids=None, top_k=10) == []
+    assert index.search("", material_ids=None, top_k=10) == []
+    assert index.search("light", material_ids=None, top_k=0) == []
+
+
+def test_tokenize_is_case_insensitive():
+    assert tokenize("Light LIGHT light") == ["light"] * 3
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a"]], k=60)
+    assert [doc_id for doc_id, _ in fused] == ["a", "c", "b"]
+    assert fused[0][1] == 1 / 61 + 1 / 62
+    assert fused[2][1] == 1 / 62
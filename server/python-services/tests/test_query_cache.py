@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+from query_cache import LocalCacheGenerations, ResponseCache, TTLCache, document_scope, user_scope
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr("query_cache.time.monotonic", fake)
+    return fake
+
+
+def test_ttl_cache_expires_entries(clock):
+    cache = TTLCache(max_entries=4, ttl_seconds=10)
+    cache.set("a", 1)
+    clock.now += 9
+    assert cache.get("a") == 1
+    clock.now += 1
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(max_entries=2, ttl_seconds=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+class UserScopes:
+    async def cache_scopes(self, user_id, material_ids):
+        if material_ids:
+            return [document_scope(material_id) for material_id in material_ids]
+        return [user_scope(user_id)]
+
+
+def response_cache():
+    return ResponseCache(model_name="gpt", max_entries=16, ttl_seconds=60, scopes=UserScopes())
+
+
+def test_single_flight_and_copy_on_read():
+    cache = response_cache()
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return {"answer": "42", "sources": []}
+
+    async def run():
+        key = await cache.key(question="What  is it?", user_id="u1", material_ids=None, top_k=5)
+        assert key == await cache.key(question="What is it?", user_id="u1", material_ids=None, top_k=5)
+        results = await asyncio.gather(*(cache.get_or_compute(key, compute) for _ in range(5)))
+        results[0]["sources"].append("mutated")
+        return key, results, await cache.get_or_compute(key, compute)
+
+    key, results, cached = asyncio.run(run())
+    assert calls == 1
+    assert cache.coalesced == 4
+    assert cached == {"answer": "42", "sources": []}
+    assert cache.peek(key) == cached
+    assert cache.stats()["in_flight"] == 0
+
+
+def test_failed_compute_is_not_cached():
+    cache = response_cache()
+
+    async def fail():
+        raise RuntimeError("llm down")
+
+    async def ok():
+        return {"answer": "ok"}
+
+    async def run():
+        key = await cache.key(question="q", user_id="u1", material_ids=None, top_k=5)
+        with pytest.raises(RuntimeError):
+            await cache.get_or_compute(key, fail)
+        return await cache.get_or_compute(key, ok)
+
+    assert asyncio.run(run()) == {"answer": "ok"}
+
+
+def test_invalidate_changes_only_affected_keys():
+    cache = response_cache()
+
+    async def keys():
+        return (
+            await cache.key(question="q", user_id="u1", material_ids=["d1"], top_k=5),
+            await cache.key(question="q", user_id="u1", material_ids=["d2"], top_k=5),
+        )
+
+    before = asyncio.run(keys())
+    cache.invalidate([document_scope("d1")])
+    after = asyncio.run(keys())
+    assert before[0] != after[0]
+    assert before[1] == after[1]
+
+
+def test_local_generations():
+    generations = LocalCacheGenerations()
+    generations.bump(["a", "a", "b"])
+    assert asyncio.run(generations.current(["a", "b", "c"])) == (2, 1, 0)
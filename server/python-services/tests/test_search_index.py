@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+import search_index
+from search_index import VectorIndexProvisioner, vector_index_definition
+
+EXPECTED = vector_index_definition(dimensions=8, similarity="cosine")
+
+
+class FakeCursor:
+    def __init__(self, items):
+        self._items = items
+
+    async def to_list(self, length=None):
+        return list(self._items)
+
+
+class FakeCollection:
+    def __init__(self):
+        self.indexes = []
+        self.lookups = 0
+
+    def list_search_indexes(self, name):
+        self.lookups += 1
+        return FakeCursor(self.indexes)
+
+
+class FakeDatabase:
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getitem__(self, name):
+        return self._collection
+
+
+async def dimensions():
+    return 8
+
+
+def provisioner(collection, mode="verify"):
+    return VectorIndexProvisioner(
+        FakeDatabase(collection),
+        "rag_vectors",
+        index_name="vector_index",
+        similarity="cosine",
+        dimensions=dimensions,
+        mode=mode,
+        poll_seconds=5,
+        max_poll_seconds=60,
+    )
+
+
+def run_until(monkeypatch, target, collection, *, ready_after, index):
+    """每次 sleep 记录等待时长，第 ready_after 次之后让索引出现"""
+    waits = []
+
+    async def fake_sleep(seconds):
+        waits.append(seconds)
+        if len(waits) == ready_after:
+            collection.indexes = [index]
+
+    monkeypatch.setattr(search_index.asyncio, "sleep", fake_sleep)
+    asyncio.run(target.run())
+    return waits
+
+
+def test_missing_index_blocks_readiness_and_backs_off(monkeypatch):
+    collection = FakeCollection()
+    target = provisioner(collection)
+    assert target.blocking
+
+    ready_index = {"latestDefinition": EXPECTED, "status": "READY", "queryable": True}
+    waits = run_until(monkeypatch, target, collection, ready_after=6, index=ready_index)
+
+    assert waits == [5, 10, 20, 40, 60, 60]
+    assert not target.blocking
+    assert target.status()["status"] == "ready"
+
+
+def test_mismatched_definition_blocks_readiness(monkeypatch):
+    collection = FakeCollection()
+    collection.indexes = [{
+        "latestDefinition": vector_index_definition(dimensions=8, similarity="cosine", filter_paths=()),
+        "status": "READY",
+        "queryable": True,
+    }]
+    target = provisioner(collection)
+
+    async def check_once():
+        return await target._check(EXPECTED)
+
+    assert not asyncio.run(check_once())
+    status = target.status()
+    assert status["blocking"] and status["status"] == "mismatch"
+    assert "metadata.user_id is not declared as a filter field" in status["error"]
+
+
+def test_building_index_polls_at_base_interval(monkeypatch):
+    collection = FakeCollection()
+    collection.indexes = [{"latestDefinition": EXPECTED, "status": "BUILDING", "queryable": False}]
+    target = provisioner(collection)
+
+    ready_index = {"latestDefinition": EXPECTED, "status": "READY", "queryable": True}
+    assert run_until(monkeypatch, target, collection, ready_after=3, index=ready_index) == [5, 5, 5]
+
+
+def test_off_mode_does_not_block():
+    target = provisioner(FakeCollection(), mode="off")
+    assert not target.blocking
+    assert target.ready
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        provisioner(FakeCollection(), mode="degraded")
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from bson import BSON
+
+from vector_codec import VectorCodec, vector_to_array
+
+
+def cosine(a, b):
+    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+@pytest.fixture
+def embedding():
+    return np.random.default_rng(0).standard_normal(1536).astype(np.float32)
+
+
+def bson_round_trip(value):
+    return BSON.encode({"v": value}).decode()["v"]
+
+
+def test_float32_round_trip(embedding):
+    codec = VectorCodec()
+    decoded = vector_to_array(bson_round_trip(codec.encode(embedding)))
+    np.testing.assert_allclose(decoded, embedding / np.linalg.norm(embedding), rtol=1e-6)
+
+
+def test_matryoshka_truncation(embedding):
+    codec = VectorCodec(dimensions=256)
+    decoded = vector_to_array(codec.encode(embedding))
+    assert decoded.shape == (256,)
+    assert np.linalg.norm(decoded) == pytest.approx(1.0, abs=1e-5)
+    assert codec.query_vector(embedding) == pytest.approx(decoded.tolist(), abs=1e-6)
+
+
+def test_int8_preserves_direction(embedding):
+    codec = VectorCodec(quantization="int8")
+    decoded = vector_to_array(bson_round_trip(codec.encode(embedding)))
+    assert decoded.dtype == np.float32
+    assert np.abs(decoded).max() == 127
+    assert cosine(decoded, embedding) > 0.999
+    np.testing.assert_array_equal(codec.first_pass_vector(embedding), decoded)
+
+
+@pytest.mark.parametrize("dimensions", [256, 100])
+def test_binary_keeps_signs(embedding, dimensions):
+    codec = VectorCodec(dimensions=dimensions, quantization="binary")
+    decoded = vector_to_array(bson_round_trip(codec.encode(embedding)))
+    assert decoded.shape == (dimensions,)
+    np.testing.assert_array_equal(decoded, np.where(embedding[:dimensions] > 0, 1.0, -1.0))
+
+
+def test_full_precision_copy(embedding):
+    decoded = vector_to_array(VectorCodec(dimensions=256, quantization="binary").encode_full(embedding))
+    np.testing.assert_array_equal(decoded, embedding)
+
+
+def test_plain_arrays_and_unknown_mode():
+    np.testing.assert_array_equal(vector_to_array([1, 2, 3]), np.array([1, 2, 3], dtype=np.float32))
+    assert not VectorCodec().enabled
+    assert VectorCodec(dimensions=256).enabled
+    with pytest.raises(ValueError):
+        VectorCodec(quantization="fp16")
@@ -12,6 +12,17 @@ interface RagProcessResponse {
   chunk_size: number
 }
 
+interface RagProcessJob {
+  job_id: string
+  status: 'queued' | 'running' | 'done' | 'failed'
+  error?: string | null
+  result?: RagProcessResponse | null
+  stages?: Record<string, number>
+}
+
+const RAG_PROCESS_POLL_INTERVAL_MS = 1000
+const RAG_PROCESS_TIMEOUT_MS = 10 * 60 * 1000
+
 interface RagQueryResponse {
   answer: string
   sources: Array<{
@@ -43,11 +54,52 @@ export async function processMaterialWithRag(material: ILearningMaterial, fileBu
   formData.append('material_id', material._id?.toString() || '')
   formData.append('user_id', material.userId.toString())
 
-  return await $fetch<RagProcessResponse>(`${config.ragServiceUrl}/process`, {
+  const job = await $fetch<RagProcessJob>(`${config.ragServiceUrl}/process`, {
     method: 'POST',
     body: formData,
     timeout: 45000,
   })
+
+  return await waitForRagProcessJob(config.ragServiceUrl, job.job_id)
+}
+
+async function waitForRagProcessJob(ragServiceUrl: string, jobId: string): Promise<RagProcessResponse> {
+  const deadline = Date.now() + RAG_PROCESS_TIMEOUT_MS
+
+  while (Date.now() < deadline) {
+    const job = await $fetch<RagProcessJob>(`${ragServiceUrl}/process/${jobId}`, {
+      timeout: 10000,
+    })
+
+    if (job.status === 'done' && job.result) {
+      return job.result
+    }
+
+    if (job.status === 'failed') {
+      throw new Error(job.error || 'RAG processing failed')
+    }
+
+    await new Promise(resolve => setTimeout(resolve, RAG_PROCESS_POLL_INTERVAL_MS))
+  }
+
+  throw new Error(`RAG processing timed out (job ${jobId})`)
+}
+
+export async function deleteMaterialFromRag(materialId: string, userId: string) {
+  const config = useRuntimeConfig()
+
+  if (!config.ragServiceUrl) {
+    throw new Error('RAG service URL is not configured')
+  }
+
+  return await $fetch<{ status: string; deleted_chunks: number }>(
+    `${config.ragServiceUrl}/materials/${encodeURIComponent(materialId)}`,
+    {
+      method: 'DELETE',
+      query: { user_id: userId },
+      timeout: 30000,
+    }
+  )
 }
 
 export async function queryRag(params: { question: string; userId: string; materialIds?: string[]; topK?: number }) {